@@ -0,0 +1,58 @@
+"""
+Cost of crash-safe checkpoint writes (temp file + fsync + rename + dir fsync)
+compared to a raw torch.save, for a few checkpoint sizes.
+
+    python examples/benchmark_atomic_write.py [output_dir]
+
+Use an output dir on the filesystem you save checkpoints to.
+"""
+import os
+import sys
+import time
+import tempfile
+import torch
+import omlet.utils as U
+
+
+def _raw_save(obj, path):
+    torch.save(obj, path)
+
+
+def _raw_save_fsync(obj, path):
+    with open(path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _time(fn, obj, path, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(obj, path)
+        times.append(time.perf_counter() - start)
+        os.remove(path)
+    return min(times)
+
+
+def main(output_dir, sizes_mb=(16, 128, 512), repeats=3):
+    path = os.path.join(output_dir, 'bench.ckpt')
+    for size_mb in sizes_mb:
+        obj = {'state_dict': {'w': torch.randn(size_mb * 2 ** 20 // 4)}}
+        raw = _time(_raw_save, obj, path, repeats)
+        raw_fsync = _time(_raw_save_fsync, obj, path, repeats)
+        atomic = _time(U.atomic_torch_save, obj, path, repeats)
+        print(
+            f'{size_mb:>5} MB: raw {raw:.3f}s, raw+fsync {raw_fsync:.3f}s, '
+            f'atomic {atomic:.3f}s '
+            f'({(atomic / raw_fsync - 1) * 100:+.1f}% vs raw+fsync, '
+            f'{(atomic / raw - 1) * 100:+.1f}% vs raw)'
+        )
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            main(tmp_dir)
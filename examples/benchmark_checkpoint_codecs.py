@@ -0,0 +1,69 @@
+"""
+Save time, load time and size of the compressed checkpoint format per codec,
+compared to a raw torch.save. The default payload mimics an Adam checkpoint:
+weights plus two fp32 moment buffers, with mostly small weight magnitudes.
+
+    python examples/benchmark_checkpoint_codecs.py [output_dir] [size_mb]
+
+Use an output dir on the filesystem you save checkpoints to, the trade-off
+depends on its bandwidth.
+"""
+import os
+import sys
+import time
+import tempfile
+import torch
+import omlet.utils as U
+
+
+def _make_checkpoint(size_mb):
+    numel = size_mb * 2 ** 20 // 4 // 3
+    weight = torch.randn(numel) * 0.02
+    return {
+        'state_dict': {'weight': weight},
+        'optimizer_states': [{
+            'state': {0: {
+                'exp_avg': torch.randn(numel) * 1e-4,
+                'exp_avg_sq': torch.rand(numel) * 1e-8,
+            }},
+            'param_groups': [{'lr': 1e-3}],
+        }],
+    }
+
+
+def _time(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(output_dir, size_mb=256, repeats=3):
+    checkpoint = _make_checkpoint(size_mb)
+    path = os.path.join(output_dir, 'bench.ckpt')
+
+    save = _time(lambda: U.atomic_torch_save(checkpoint, path), repeats)
+    load = _time(lambda: U.load_checkpoint(path, mmap=False), repeats)
+    raw_size = os.path.getsize(path)
+    print(f'{"torch":>6}: save {save:.3f}s, load {load:.3f}s, size {raw_size / 2 ** 20:.1f} MB')
+
+    for codec in U.COMPRESSION_CODECS:
+        save = _time(lambda: U.save_compressed_checkpoint(checkpoint, path, codec=codec), repeats)
+        load = _time(lambda: U.load_checkpoint(path), repeats)
+        size = os.path.getsize(path)
+        print(
+            f'{codec:>6}: save {save:.3f}s, load {load:.3f}s, '
+            f'size {size / 2 ** 20:.1f} MB ({size / raw_size * 100:.1f}% of torch)'
+        )
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    if len(sys.argv) > 1:
+        main(sys.argv[1], size_mb)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            main(tmp_dir, size_mb)
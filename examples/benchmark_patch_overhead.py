@@ -0,0 +1,57 @@
+"""
+ExtendedModule patches [training|validation|test]_step once per subclass.
+The per-step wrapper overhead must stay constant no matter how many
+instances have been created.
+
+    python examples/benchmark_patch_overhead.py
+"""
+import timeit
+import torch
+from omegaconf import OmegaConf
+from omlet.lightning import ExtendedModule
+
+
+class BenchModule(ExtendedModule):
+    def training_step(self, batch, batch_idx):
+        return {'loss': batch}
+
+    def _after_step(self, stage, batch, output):
+        # skip the metrics book-keeping, which needs a trainer
+        self.__dict__['after_step_calls'] += 1
+        return output
+
+
+def wrapper_depth(fn):
+    depth = 0
+    while hasattr(fn, '__wrapped__'):
+        fn = fn.__wrapped__
+        depth += 1
+    return depth
+
+
+def main(steps=20000):
+    conf = OmegaConf.create({
+        'train_metrics': ['loss'],
+        'val_metrics': ['loss'],
+    })
+    batch = torch.zeros(())
+    num_created = 0
+    module = None
+    for num_instances in [1, 10, 100, 1000]:
+        while num_created < num_instances:
+            module = BenchModule(conf)
+            num_created += 1
+        module.__dict__['after_step_calls'] = 0
+        elapsed = timeit.timeit(
+            lambda: module.training_step(batch, 0), number=steps
+        )
+        print(
+            f'{num_instances:>5} instances: '
+            f'{elapsed / steps * 1e6:.2f} us/step, '
+            f'wrapper depth {wrapper_depth(BenchModule.training_step)}, '
+            f'_after_step calls/step {module.after_step_calls / steps:.0f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,18 @@
+import time
+import signal
 import logging
 import functools
-from typing import Union, Dict, List, Optional
+import threading
+from typing import Union, Dict, List, Optional, Tuple
 import omlet.utils as U
+import omlet.utils.distributed as dist
+import torch
 
-from pytorch_lightning.callbacks import Callback, ProgressBar
+from pytorch_lightning.callbacks import Callback, ProgressBar, ProgressBarBase
 from pytorch_lightning.utilities import rank_zero_warn, rank_zero_only
+from . import omlet_logger as _log
 from .extended import ExtendedModule, STAGES
+from .checkpoint import ExtendedCheckpoint
 
 
 class SummaryMessage(Callback):
@@ -57,6 +64,80 @@ class SummaryMessage(Callback):
         self._print_summary_message('test', pl_module)
 
 
+class StepTimeMonitor(Callback):
+    """
+    Tracks the distribution of training step time and of the time between
+    steps with bounded-memory QuantileMeters, and reports p50/p90/p99 every epoch.
+
+    - step time: from the start to the end of a batch (forward, backward, optimizer)
+    - inter step: from the end of the previous batch to the start of this one.
+      Mostly data loading, but it also covers the other callbacks, checkpoint
+      saves and mid-epoch validation, so it is an upper bound of the data wait
+    """
+    def __init__(self,
+                 quantiles=(0.5, 0.9, 0.99),
+                 relative_accuracy: float = 0.01,
+                 reduce_across_processes: bool = False,
+                 log_to_logger: bool = True):
+        """
+        Args:
+            reduce_across_processes: merge the sketches from all DDP processes
+                at epoch end (2 small collectives), otherwise rank 0 only
+        """
+        self.quantiles = quantiles
+        self.reduce_across_processes = reduce_across_processes
+        self.log_to_logger = log_to_logger
+        kwargs = dict(relative_accuracy=relative_accuracy, min_value=1e-6, max_value=1e5)
+        self.meters = {
+            'step_time': U.QuantileMeter('step_time', **kwargs),
+            'inter_step': U.QuantileMeter('inter_step', **kwargs),
+        }
+        self._batch_start = None
+        self._batch_end = None
+
+    def on_epoch_start(self, trainer, pl_module):
+        for meter in self.meters.values():
+            meter.reset()
+        self._batch_end = None
+
+    def on_batch_start(self, trainer, pl_module):
+        self._batch_start = time.perf_counter()
+        if self._batch_end is not None:
+            self.meters['inter_step'].update(self._batch_start - self._batch_end)
+
+    def on_batch_end(self, trainer, pl_module):
+        self._batch_end = time.perf_counter()
+        if self._batch_start is not None:
+            self.meters['step_time'].update(self._batch_end - self._batch_start)
+
+    def on_epoch_end(self, trainer, pl_module):
+        if self.reduce_across_processes and trainer.use_ddp:
+            for meter in self.meters.values():
+                meter.reduce_()
+        self._report(trainer, pl_module)
+
+    @rank_zero_only
+    def _report(self, trainer, pl_module):
+        log = {}
+        msg = []
+        for name, meter in self.meters.items():
+            if meter.size == 0:
+                continue
+            summary = meter.summary(self.quantiles)
+            for key, value in summary.items():
+                log[f'system/{name}_{key}'] = value
+            msg.append(name + ' ' + ' '.join(
+                f'{k}={U.Timer.pformat(summary[k])}'
+                for k in summary if k.startswith('p')
+            ))
+        if not log:
+            return
+        if self.log_to_logger and trainer.logger is not None:
+            trainer.logger.log_metrics(log, step=trainer.global_step)
+        if isinstance(pl_module, ExtendedModule):
+            pl_module.log_infov(f'Epoch {pl_module.current_epoch} ' + ', '.join(msg))
+
+
 class ExtendedProgressBar(ProgressBar):
     """
     Changes compared to the default one:
@@ -106,10 +187,13 @@ class ExtendedProgressBar(ProgressBar):
         return progress_dict
 
     def on_batch_end(self, trainer, pl_module):
-        progress_dict = self._process_progress_dict(trainer)
-        # super().on_batch_end(trainer, pl_module)
+        # skip ProgressBar.on_batch_end, but keep the batch counter of the base
+        # class, otherwise `train_batch_idx` never advances and we refresh every step
+        ProgressBarBase.on_batch_end(self, trainer, pl_module)
         # directly copied from pytorch_lightning/callbacks/progress
         if self.is_enabled and self.train_batch_idx % self.refresh_rate == 0:
+            # only build the dict when we render, reading metrics may sync with GPU
+            progress_dict = self._process_progress_dict(trainer)
             self.main_progress_bar.update(self.refresh_rate)
             self.main_progress_bar.set_postfix(**progress_dict)
 
@@ -155,3 +239,188 @@ class FileLogger(Callback):
         if trainer.proc_rank == 0:
             self.add_handler()
 
+
+class PreemptionHandler(Callback):
+    """
+    On SIGTERM / SIGUSR1 (preemption notice), stops training at the next step
+    boundary on all DDP ranks, writes a fast `last.ckpt` with
+    ExtendedCheckpoint.save_emergency() and exits training cleanly.
+    Relaunch with `configure_trainer(resume='auto')` to continue.
+
+    The signal handler only sets a flag. Ranks agree on stopping with a MAX
+    all-reduce of the flag, so it is enough for any rank to receive the signal.
+    The same all-reduce tells whether any rank expects the save not to finish
+    within the grace period. With DDP, the all-reduce is started at every
+    check without blocking and its result is read at the next check, so
+    training never waits for it. A signal is acted upon within two checks.
+    By default checks are spaced by time, not by a fixed number of steps:
+    each rank measures its step time and proposes how many steps fit in
+    `check_period` seconds. The proposals travel in the same all-reduce, and
+    all ranks take the shortest one, so they keep checking at the same step.
+    NOTE: with ddp spawn, send the signal to the training processes,
+        e.g. to the whole process group: `kill -TERM -<pgid>`
+
+    Local test: `kill -USR1 <pid>` a CPU training process.
+    """
+    def __init__(self,
+                 signals=('SIGTERM', 'SIGUSR1'),
+                 grace_period: float = 120.,
+                 check_period: Optional[float] = None,
+                 check_interval: Optional[int] = None):
+        """
+        Args:
+            signals: signal names to handle
+            grace_period: seconds between the signal and the forced kill by the
+                scheduler. The checkpoint is skipped if recent saves suggest it
+                cannot finish in the remaining time (never leaves a partial file)
+            check_period: with DDP, seconds between two checks for signals,
+                each check is a tiny asynchronous all-reduce.
+                None for grace_period / 8, so a signal is acted upon within
+                a quarter of the grace period plus one step
+            check_interval: check every N training steps instead of
+                every `check_period` seconds
+        """
+        self.signals = [getattr(signal, name) if isinstance(name, str) else name
+                        for name in signals]
+        self.grace_period = grace_period
+        self.check_period = grace_period / 8 if check_period is None else check_period
+        self.check_interval = check_interval
+        self._signal_time = None
+        self._signal_num = None
+        self._old_handlers = {}
+        # steps from the last check to the next one, agreed on by all ranks
+        self._next_check = 1 if check_interval is None else check_interval
+        self._steps_since_check = 0
+        self._check_time = None
+        # persistent storage and pending handle of the async flags all-reduce
+        self._flags_storage = None
+        self._pending_flags = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # handler objects may not be picklable, reinstalled in the child process
+        state['_old_handlers'] = {}
+        state['_flags_storage'] = state['_pending_flags'] = None
+        return state
+
+    def _handle_signal(self, signum, frame):
+        # only set a flag, the training loop is not interrupted here
+        if self._signal_time is None:
+            self._signal_time = time.time()
+            self._signal_num = signum
+
+    def on_train_start(self, trainer, pl_module):
+        assert isinstance(trainer.checkpoint_callback, ExtendedCheckpoint), \
+            'PreemptionHandler requires ExtendedCheckpoint'
+        if threading.current_thread() is not threading.main_thread():
+            rank_zero_warn('PreemptionHandler can only install signal handlers in the main thread')
+            return
+        for signum in self.signals:
+            self._old_handlers[signum] = signal.signal(signum, self._handle_signal)
+
+    def _restore_handlers(self):
+        for signum, handler in self._old_handlers.items():
+            # None if the previous handler was not installed from python
+            signal.signal(signum, handler if handler is not None else signal.SIG_DFL)
+        self._old_handlers = {}
+
+    def on_train_end(self, trainer, pl_module):
+        self._restore_handlers()
+        if self._pending_flags is not None:
+            self._pending_flags.wait()
+            self._pending_flags = None
+
+    @staticmethod
+    def _is_distributed():
+        return dist.is_initialized() and dist.get_world_size() > 1
+
+    def _cannot_save(self, checkpoint_callback) -> bool:
+        """
+        True if recent saves suggest the checkpoint cannot finish before the kill,
+        counted from now on the ranks that did not receive the signal
+        """
+        remaining = self.grace_period
+        if self._signal_time is not None:
+            remaining -= time.time() - self._signal_time
+        estimate = checkpoint_callback.mean_save_duration
+        return estimate is not None and estimate >= remaining
+
+    def _check_flags(self, checkpoint_callback) -> Tuple[bool, bool]:
+        """
+        With DDP, reads the result of the all-reduce started at the previous
+        check, then starts the next one with the current flags and the number
+        of steps this rank proposes until the check after
+
+        Returns:
+            (stop, cannot save), the latter is True if any rank cannot save
+        """
+        if not self._is_distributed():
+            return self._signal_time is not None, self._cannot_save(checkpoint_callback)
+        self._steps_since_check += 1
+        if self._steps_since_check < self._next_check:
+            return False, False
+        now = time.perf_counter()
+        if self._check_time is None:
+            # no step time measured yet, check again at the next step
+            proposed = 1
+        else:
+            step_time = (now - self._check_time) / self._steps_since_check
+            proposed = max(1, int(self.check_period / max(step_time, 1e-6)))
+        self._check_time = now
+        self._steps_since_check = 0
+        stop, cannot_save = False, False
+        if self._pending_flags is not None:
+            # started one interval ago, long finished by now
+            signaled, cannot, neg_interval = self._pending_flags.wait()
+            stop, cannot_save = signaled > 0, cannot > 0
+            if self.check_interval is None:
+                self._next_check = int(-neg_interval)
+            self._pending_flags = None
+        if not stop:
+            if self._flags_storage is None:
+                self._flags_storage = torch.zeros(3, device=dist.comm_device())
+            flags = [
+                float(self._signal_time is not None),
+                float(self._cannot_save(checkpoint_callback)),
+                # MAX of the negated proposals is the shortest interval
+                -float(proposed),
+            ]
+            # one collective for the flags and the next interval
+            self._pending_flags = dist.reduce_scalars(
+                flags, 'max',
+                storage=self._flags_storage, async_op=True
+            )
+        return stop, cannot_save
+
+    def on_batch_start(self, trainer, pl_module):
+        # pl updates the lr schedulers and global_step after the batch end
+        # callbacks, the next batch start is the first point where the
+        # checkpoint is consistent
+        if trainer.batch_idx % trainer.accumulate_grad_batches != 0:
+            # in the middle of a gradient accumulation window
+            return
+        checkpoint_callback = trainer.checkpoint_callback
+        stop, cannot_save = self._check_flags(checkpoint_callback)
+        if not stop:
+            return
+        if self._signal_time is None:
+            # another rank received the signal
+            self._signal_time = time.time()
+
+        if not cannot_save:
+            start = time.time()
+            path = checkpoint_callback.save_emergency(trainer, pl_module)
+            # any LightningModule, not only ExtendedModule
+            _log.info(
+                f'Preemption signal {self._signal_num}: saved {path} at step '
+                f'{trainer.global_step} in {time.time() - start:.1f}s, stopping training'
+            )
+        else:
+            remaining = self.grace_period - (time.time() - self._signal_time)
+            _log.warn(
+                f'Preemption signal {self._signal_num}: not enough time left '
+                f'({remaining:.1f}s) to save a checkpoint, stopping training'
+            )
+        self._restore_handlers()
+        # pl catches KeyboardInterrupt and shuts down gracefully (on_train_end)
+        raise KeyboardInterrupt
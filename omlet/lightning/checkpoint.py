@@ -1,11 +1,16 @@
 import os
 import re
-from pytorch_lightning.utilities import rank_zero_warn, rank_zero_only
-from pytorch_lightning.callbacks import ModelCheckpoint
+import time
+import functools
+import collections
+from pytorch_lightning.utilities import rank_zero_warn
+from pytorch_lightning.callbacks import Callback, ModelCheckpoint
 import torch
 import omlet.utils as U
-from typing import Optional
+import omlet.utils.distributed as dist
+from typing import Optional, Union, List, Dict
 from . import omlet_logger as _log
+from .extended import ExtendedModule
 
 
 class ExtendedCheckpoint(ModelCheckpoint):
@@ -13,11 +18,22 @@ class ExtendedCheckpoint(ModelCheckpoint):
                  save_dir,
                  filename_template: str = '{epoch}',
                  best_filename_template: str = 'best/{epoch}',
-                 monitor_metric: str = 'val/loss',
+                 monitor_metric: Union[str, List[str], Dict[str, str]] = 'val/loss',
                  monitor_metric_mode: str = 'auto',
                  save_top_k: int = 1,
                  save_epoch_interval: int = 1,
                  always_save_last: bool = True,
+                 async_save: bool = False,
+                 max_pending_saves: int = 1,
+                 pin_memory: bool = True,
+                 sharded: bool = False,
+                 save_format: str = 'torch',
+                 compression_codec: str = 'zlib',
+                 save_step_interval: int = 0,
+                 save_time_interval: float = 0,
+                 max_io_fraction: float = 0,
+                 sharded_sync_interval: int = 50,
+                 checksum: bool = False,
                  ):
         """
         Periodic checkpoint save every `period`, in addition to standard `best` save
@@ -25,6 +41,61 @@ class ExtendedCheckpoint(ModelCheckpoint):
 
         Verbose is controlled by global logging level.
             set logging level to INFOV (i.e. INFO - 2)
+
+        All saved checkpoints are recorded in `manifest.json` in `save_dir`
+        (see `U.CheckpointManifest`). Versioning, top-k eviction and resume
+        lookups read the manifest instead of probing the filesystem.
+        Checkpoints from before the manifest are imported by matching their
+        names against the filename templates.
+
+        Args:
+            monitor_metric: metric name, a list of metric names that share
+                `monitor_metric_mode`, or a dict of {metric name: mode}.
+                Each metric keeps its own top-k in a subfolder of the best dir,
+                e.g. `best/val_acc1/`. A checkpoint in the top-k of several
+                metrics is written once and hardlinked into the other folders,
+                it is deleted only when no metric keeps it. The first metric is
+                the primary one (`self.monitor`), e.g. for resume='best'
+            async_save: snapshot the checkpoint to host memory and write it in
+                a background thread, training continues during serialization.
+                Pending writes are flushed at the end of training
+            max_pending_saves: max number of async saves in flight,
+                further saves block until one finishes
+            pin_memory: reuse pinned host buffers for the async snapshots
+            sharded: every DDP rank writes its own slice of the checkpoint in
+                parallel, a checkpoint is then a directory of shards.
+                See `U.save_sharded_checkpoint`. Sharded saves are synchronous
+            save_format:
+                - 'torch': standard torch.save() file
+                - 'dedup': content-addressed tensor blobs shared across all
+                    checkpoints in `save_dir`, unchanged tensors (e.g. frozen
+                    layers) are written only once. See `U.DedupCheckpointStore`
+                - 'compressed': tensors compressed in parallel chunks,
+                    see `U.save_compressed_checkpoint`
+            compression_codec: 'zlib', 'bz2' or 'lzma' for save_format='compressed'
+            save_step_interval: also refresh `last.ckpt` every N training steps,
+                0 to disable
+            save_time_interval: also refresh `last.ckpt` every N seconds of
+                training, 0 to disable
+            max_io_fraction: cap the fraction of wall time training is blocked by
+                checkpoint saves (e.g. 0.03), measured from recent save durations.
+                Alone, saves `last.ckpt` as often as the budget allows;
+                with the intervals above, skips saves that would exceed it.
+                0 to disable
+            sharded_sync_interval: sharded saves need every rank, with
+                save_time_interval or max_io_fraction all ranks follow the
+                clock of rank 0. Its decision is broadcast without blocking
+                every N steps and applied at the next one, time-triggered saves
+                are delayed by up to 2 * N steps. Unused with save_step_interval
+                alone, every rank counts the steps on its own
+            checksum: record a CRC32 of every checkpoint in the manifest and
+                check it on resume. Off by default: reads every file again after
+                writing it (in the writer thread with async_save) and on resume
+
+        Mid-epoch saves need the `training_hooks()` callback in the trainer
+        callbacks, `configure_trainer()` adds it. They are decided at the end
+        of the last batch of an optimizer step and written at the start of the
+        next batch, after pl updated the step-wise lr schedulers and global_step.
         """
         self.save_dir = os.path.expanduser(save_dir)
         if not filename_template:
@@ -35,16 +106,67 @@ class ExtendedCheckpoint(ModelCheckpoint):
         self.best_ckpt_path = os.path.join(self.save_dir, best_filename_template)
         os.makedirs(self.save_dir, exist_ok=True)
         self.always_save_last = always_save_last
+        self.async_save = async_save
+        self.max_pending_saves = max_pending_saves
+        self.pin_memory = pin_memory
+        assert not (sharded and async_save), 'sharded save does not support async_save'
+        self.sharded = sharded
+        assert save_format in ['torch', 'dedup', 'compressed'], \
+            f'invalid save_format: {save_format}'
+        assert not (sharded and save_format != 'torch'), \
+            f'sharded save does not support save_format={save_format}'
+        self.save_format = save_format
+        assert compression_codec in U.COMPRESSION_CODECS, \
+            f'invalid compression_codec: {compression_codec}'
+        self.compression_codec = compression_codec
+        self._store: Optional[U.DedupCheckpointStore] = None
+        assert max_io_fraction < 1, 'max_io_fraction should be a fraction, e.g. 0.03'
+        self.save_step_interval = save_step_interval
+        self.save_time_interval = save_time_interval
+        self.max_io_fraction = max_io_fraction
+        assert sharded_sync_interval > 0, 'sharded_sync_interval must be positive'
+        self.sharded_sync_interval = sharded_sync_interval
+        self.checksum = checksum
+        self._is_mid_epoch_save = False
+        self._last_save_start = None
+        # decided at a batch end, saved at the next batch start
+        self._pending_step_save = False
+        self._num_step_saves = 0
+        # sharded: (time triggered, within io budget) of rank 0 as of the last sync,
+        # the buffer and pending handle of the async broadcast, and the number
+        # of saves when it was started
+        self._synced_conditions = (False, True)
+        self._conditions_storage = None
+        self._pending_conditions = None
+        # blocking time of recent saves, in seconds
+        self._save_durations = collections.deque(maxlen=5)
+        # rank 0 defers sharded saves and file ops until all ranks join the save
+        self._sharded_saves = None
+        self._deferred_io = None
+        self._writer: Optional[U.AsyncCheckpointWriter] = None
+        self._trainer = None
+        self._manifest: Optional[U.CheckpointManifest] = None
+        # paths scheduled for writing but possibly not yet in the manifest (async)
+        self._scheduled = set()
+        # {metric name: 'min' or 'max'}, the first one is the primary metric
+        self.monitor_modes = _parse_monitor_modes(monitor_metric, monitor_metric_mode)
+        primary_metric = next(iter(self.monitor_modes))
 
         super().__init__(
-            filepath=self.ckpt_path, monitor=monitor_metric, verbose=False,
+            filepath=self.ckpt_path, monitor=primary_metric, verbose=False,
             save_top_k=save_top_k, save_weights_only=False,
-            mode=monitor_metric_mode, period=save_epoch_interval, prefix=''
+            mode=self.monitor_modes[primary_metric], period=save_epoch_interval, prefix=''
         )
+        # {metric name: {filepath: value}}, `best_k_models` of every metric
+        self.metric_top_k = {monitor: {} for monitor in self.monitor_modes}
+        self.best_k_models = self.metric_top_k[self.monitor]
 
-    def format_checkpoint_name(self, epoch, metrics, ver=None, ckpt_type='best'):
+    def format_checkpoint_name(self, epoch, metrics, ver=None, ckpt_type='best', monitor=None):
         """Override
 
+        With multiple monitored metrics, best checkpoints of `monitor` go to
+        a subfolder named after it, e.g. `best/val_acc1/epoch=5.ckpt`
+
         Example::
 
             >>> tmpdir = os.path.dirname(__file__)
@@ -61,10 +183,7 @@ class ExtendedCheckpoint(ModelCheckpoint):
             >>> os.path.basename(ckpt.format_checkpoint_name(0, {}))
             'missing=0.ckpt'
         """
-        if ckpt_type == 'best':
-            fpath = self.best_ckpt_path
-        else:
-            fpath = self.ckpt_path
+        fpath = self._checkpoint_template(ckpt_type, monitor)
         # check if user passed in keys to the string
         groups = re.findall(r'(\{.*?)[:\}]', fpath)
         assert len(groups) > 0, \
@@ -85,11 +204,71 @@ class ExtendedCheckpoint(ModelCheckpoint):
         str_ver = f'_v{ver}' if ver is not None else ''
         return fpath + str_ver + '.ckpt'
 
-    def check_monitor_top_k(self, current):
+    def _checkpoint_template(self, ckpt_type, monitor=None):
+        if ckpt_type == 'best':
+            fpath = self.best_ckpt_path
+            if monitor is not None and len(self.monitor_modes) > 1:
+                dirname, basename = os.path.split(fpath)
+                fpath = os.path.join(dirname, monitor.replace('/', '_'), basename)
+            return fpath
+        else:
+            return self.ckpt_path
+
+    def _checkpoint_name_regex(self, ckpt_type, monitor=None):
+        """
+        Inverse of format_checkpoint_name()
+
+        Returns:
+            (compiled regex of the full path, {regex group: template key})
+        """
+        template = self._checkpoint_template(ckpt_type, monitor)
+        if template.endswith('.ckpt'):
+            template = template[:-len('.ckpt')]
+        pattern, keys, last = '', {}, 0
+        for i, m in enumerate(re.finditer(r'\{([^:}]*)(:[^}]*)?\}', template)):
+            group = f'key{i}'
+            keys[group] = m.group(1)
+            pattern += re.escape(template[last:m.start()])
+            pattern += re.escape(m.group(1).replace('/', '_') + '=') + f'(?P<{group}>[^/]*?)'
+            last = m.end()
+        pattern += re.escape(template[last:]) + r'(_v\d+)?\.ckpt'
+        return re.compile(pattern), keys
+
+    def _parse_checkpoint_name(self, relpath):
+        """
+        Manifest fields of a checkpoint written before the manifest existed,
+        recovered from its file name. None if it matches no filename template
+        """
+        path = os.path.join(self.save_dir, relpath)
+        if relpath == 'last.ckpt':
+            return {'kind': 'last'}
+        candidates = [('best', monitor) for monitor in self.monitor_modes]
+        candidates.append(('periodic', None))
+        for ckpt_type, monitor in candidates:
+            regex, keys = self._checkpoint_name_regex(ckpt_type, monitor)
+            match = regex.fullmatch(path)
+            if match is None:
+                continue
+            values = {keys[group]: v for group, v in match.groupdict().items()}
+            fields = {'kind': ckpt_type, 'monitor': monitor}
+            try:
+                if 'epoch' in values:
+                    fields['epoch'] = int(values['epoch'])
+                if monitor in values:
+                    fields['value'] = float(values[monitor])
+            except ValueError:
+                continue
+            return fields
+        return None
+
+    def check_monitor_top_k(self, current, monitor=None):
         """
         Override warning from super class
         """
-        less_than_k_models = len(self.best_k_models) < self.save_top_k
+        if monitor is None:
+            monitor = self.monitor
+        best_k_models = self.metric_top_k[monitor]
+        less_than_k_models = len(best_k_models) < self.save_top_k
         if less_than_k_models:
             return True
 
@@ -99,27 +278,126 @@ class ExtendedCheckpoint(ModelCheckpoint):
         monitor_op = {
             "min": torch.lt,
             "max": torch.gt,
-        }[self.mode]
+        }[self.monitor_modes[monitor]]
+
+        kth_value = best_k_models[self._kth_best_model(monitor)]
+        return monitor_op(current, torch.tensor(kth_value))
 
-        return monitor_op(current, self.best_k_models[self.kth_best_model])
+    def _kth_best_model(self, monitor):
+        best_k_models = self.metric_top_k[monitor]
+        _op = max if self.monitor_modes[monitor] == 'min' else min
+        return _op(best_k_models, key=best_k_models.get)
+
+    def _best_value(self, monitor):
+        _op = min if self.monitor_modes[monitor] == 'min' else max
+        return _op(self.metric_top_k[monitor].values())
+
+    def _push_top_k(self, monitor, filepath, current):
+        """
+        Replaces `_do_check_save()` of the super class, without saving
+
+        Returns:
+            filepath evicted from the top-k of `monitor`, None if not full yet
+        """
+        best_k_models = self.metric_top_k[monitor]
+        evicted = None
+        if len(best_k_models) >= self.save_top_k:
+            evicted = self._kth_best_model(monitor)
+            best_k_models.pop(evicted)
+        best_k_models[filepath] = current
+        if monitor == self.monitor:
+            self._sync_primary_top_k()
+        return evicted
+
+    def _sync_primary_top_k(self):
+        """
+        Keep the attributes of pl ModelCheckpoint up to date for the primary metric
+        """
+        self.best_k_models = self.metric_top_k[self.monitor]
+        if self.best_k_models:
+            self.kth_best_model = self._kth_best_model(self.monitor)
+            self.kth_value = self.best_k_models[self.kth_best_model]
+            self.best = self._best_value(self.monitor)
 
-    @rank_zero_only
     def on_validation_end(self, trainer, pl_module):
         """
         Mostly copied from pytorch_lightning.callbacks.ModelCheckpoint
         """
-        # only run on main process
-        if trainer.proc_rank != 0:
-            return
+        self._trainer = trainer
+        if self.always_save_last:
+            # refreshes last.ckpt anyway
+            self._pending_step_save = False
+        start = time.time()
+        saved = False
+        if self._is_sharded_distributed():
+            saved = self._sharded_validation_end(trainer)
+        elif trainer.proc_rank == 0:
+            # only run on main process
+            saved = self._save_checkpoints(trainer)
+        if saved:
+            self._add_save_duration(start)
 
+    def _is_sharded_distributed(self):
+        return self.sharded and dist.is_initialized() and dist.get_world_size() > 1
+
+    def _sharded_validation_end(self, trainer):
+        """
+        Rank 0 decides what to save, then all ranks write their shards together
+
+        Returns:
+            True if shards were written
+        """
+        self._sharded_saves, self._deferred_io = [], []
+        error = None
+        try:
+            if trainer.proc_rank == 0:
+                try:
+                    self._save_checkpoints(trainer)
+                except Exception as e:
+                    # the other ranks are waiting in the broadcast, tell them
+                    error = e
+            # None signals that rank 0 failed
+            save_paths = dist.broadcast_object(
+                None if error is not None else self._sharded_saves, src=0
+            )
+            deferred_io = self._deferred_io
+        finally:
+            self._sharded_saves = self._deferred_io = None
+        if error is not None:
+            raise error
+        if save_paths is None:
+            raise RuntimeError('rank 0 failed to prepare the sharded checkpoint save')
+        if save_paths:
+            checkpoint = trainer.dump_checkpoint()
+            for filepath in save_paths:
+                U.save_sharded_checkpoint(checkpoint, filepath)
+        # copies, deletes and manifest updates after the shards are complete
+        for fn, args, kwargs in deferred_io:
+            fn(*args, **kwargs)
+        return bool(save_paths)
+
+    def _save_checkpoints(self, trainer):
+        """
+        Returns:
+            True if any checkpoint is saved
+        """
+        if not any(self.metric_top_k.values()):
+            self._restore_top_k()
         metrics = trainer.callback_metrics
         epoch = trainer.current_epoch
         _best_path = self._save_best(metrics, epoch)
         _periodic_path = self._save_periodic(metrics, epoch, _best_path)
-        self._save_last(_periodic_path, _best_path)
+        _last_path = self._save_last(_periodic_path, _best_path)
+        return bool(_best_path or _periodic_path or _last_path)
 
     def _save_best(self, metrics, epoch):
         """
+        Every monitored metric keeps its own top-k. The checkpoint is written
+        for the first metric it wins, then linked for the other ones.
+        Evicting a metric only deletes its own link, the data is freed once
+        no metric links it anymore (file system link count, or blob
+        references with save_format='dedup')
+
         Returns:
             filepath if the best is saved, None if nothing saved
         """
@@ -127,31 +405,39 @@ class ExtendedCheckpoint(ModelCheckpoint):
             # no best saved
             return None
 
-        filepath = self.format_checkpoint_name(epoch, metrics, ckpt_type='best')
-        version_cnt = 1
-        while os.path.isfile(filepath):
-            filepath = self.format_checkpoint_name(epoch, metrics, ver=version_cnt, ckpt_type='best')
-            # this epoch called before
-            version_cnt += 1
-
-        current = metrics.get(self.monitor)
+        saved_path = None
+        for monitor in self.monitor_modes:
+            current = metrics.get(monitor)
+            if current is None:
+                rank_zero_warn(
+                    f'Can save best model only with {monitor} available, skipping.', RuntimeWarning
+                )
+                continue
+            if isinstance(current, torch.Tensor):
+                current = current.item()
+            if not self.check_monitor_top_k(current, monitor):
+                _log.infov(f'\nEpoch {epoch:03d}: {monitor} was not in top {self.save_top_k}')
+                continue
 
-        if current is None:
-            rank_zero_warn(
-                f'Can save best model only with {self.monitor} available, skipping.', RuntimeWarning
+            filepath, version_cnt = self._versioned_checkpoint_name(
+                epoch, metrics, 'best', monitor=monitor
             )
-        elif self.check_monitor_top_k(current):
-            self._do_check_save(filepath, current, epoch)
             if version_cnt > 1:
                 _log.warn(f'best ckpt filepath exists, saving to a different version: {filepath}')
+            evicted = self._push_top_k(monitor, filepath, current)
+            if saved_path is None:
+                self._save_model(filepath)
+                self._record(filepath, 'best', epoch, value=current, monitor=monitor)
+                saved_path = filepath
+            else:
+                self._copy_model(saved_path, filepath, kind='best', monitor=monitor, value=current)
+            if evicted is not None and evicted != filepath:
+                self._del_model(evicted)
             _log.infov(
-                f'\nEpoch {epoch:05d}: {self.monitor} reached'
-                f' {current:0.5f} (best {self.best:0.5f}), saving model to'
+                f'\nEpoch {epoch:05d}: {monitor} reached'
+                f' {current:0.5f} (best {self._best_value(monitor):0.5f}), saving model to'
                 f' {filepath} as top {self.save_top_k}')
-            return filepath
-
-        _log.infov(f'\nEpoch {epoch:03d}: {self.monitor} was not in top {self.save_top_k}')
-        return None
+        return saved_path
 
     def _save_periodic(self, metrics, epoch, _best_save_path):
         """
@@ -161,12 +447,7 @@ class ExtendedCheckpoint(ModelCheckpoint):
             # skip if not this period
             return None
 
-        filepath = self.format_checkpoint_name(epoch, metrics, ckpt_type='periodic')
-        version_cnt = 1
-        while os.path.isfile(filepath):
-            filepath = self.format_checkpoint_name(epoch, metrics, ver=version_cnt, ckpt_type='periodic')
-            # this epoch called before
-            version_cnt += 1
+        filepath, version_cnt = self._versioned_checkpoint_name(epoch, metrics, 'periodic')
         if version_cnt > 1:
             _log.warn(f'ckpt filepath exists, saving to a different version: {filepath}')
 
@@ -175,21 +456,502 @@ class ExtendedCheckpoint(ModelCheckpoint):
         if _best_save_path:
             # the destination shouldn't exist tho
             _log.debug2(f'\nEpoch {epoch:03d}: periodic saving copies from the best ckpt {_best_save_path}')
-            U.f_copy(_best_save_path, filepath, exists_ok=True)
+            self._copy_model(_best_save_path, filepath, kind='periodic')
         else:
             self._save_model(filepath)
+            self._record(filepath, 'periodic', epoch)
         return filepath
 
     def _save_last(self, _periodic_save_path, _best_save_path):
         if not self.always_save_last:
-            return
+            return None
 
         # always save a copy to the special `last.ckpt`
         last_path = os.path.join(self.save_dir, 'last.ckpt')
         if _periodic_save_path:
-            U.f_copy(_periodic_save_path, last_path, exists_ok=True)
+            self._copy_model(_periodic_save_path, last_path, kind='last')
         elif _best_save_path:
-            U.f_copy(_best_save_path, last_path, exists_ok=True)
+            self._copy_model(_best_save_path, last_path, kind='last')
         else:
             # neither best or periodic saved
             self._save_model(last_path)
+            self._record(last_path, 'last', self._trainer.current_epoch)
+        return last_path
+
+    # ==================== mid-epoch saves ====================
+    def training_hooks(self) -> Callback:
+        """
+        pl.Trainer only calls `on_validation_end` of the checkpoint callback,
+        add this to the trainer callbacks for mid-epoch saves and for
+        flushing async saves at the end of training
+        """
+        return _CheckpointTrainingHooks(self)
+
+    def _add_save_duration(self, start):
+        self._last_save_start = start
+        self._save_durations.append(time.time() - start)
+
+    def _is_step_save_enabled(self):
+        return bool(self.save_step_interval or self.save_time_interval or self.max_io_fraction)
+
+    def _is_time_based(self):
+        return bool(self.save_time_interval or self.max_io_fraction)
+
+    def _local_save_conditions(self):
+        """
+        Returns:
+            (time triggered, within io budget) from the clock of this process
+        """
+        now = time.time()
+        if self._last_save_start is None:
+            # start the clock
+            self._last_save_start = now
+        elapsed = now - self._last_save_start
+        time_triggered = bool(self.save_time_interval and elapsed >= self.save_time_interval)
+        if self.max_io_fraction and self._save_durations:
+            within_budget = elapsed >= self.mean_save_duration / self.max_io_fraction
+        else:
+            # the first save measures the cost
+            within_budget = True
+        return time_triggered, within_budget
+
+    def _synced_save_conditions(self, step):
+        """
+        Same as `_local_save_conditions()` on every rank, from rank 0 as of
+        the last sync. The broadcast started at a sync is read at the next one
+        and dropped if a save happened in between, it predates that save
+        """
+        if step % self.sharded_sync_interval == 0:
+            if self._pending_conditions is not None:
+                handle, num_saves = self._pending_conditions
+                conditions = handle.wait().tolist()
+                self._pending_conditions = None
+                if num_saves == self._num_step_saves:
+                    self._synced_conditions = (conditions[0] > 0, conditions[1] > 0)
+            if self._conditions_storage is None:
+                self._conditions_storage = torch.zeros(2, device=dist.comm_device())
+            if dist.get_rank() == 0:
+                self._conditions_storage.copy_(torch.tensor(
+                    [float(c) for c in self._local_save_conditions()]
+                ))
+            self._pending_conditions = (
+                dist.broadcast_(self._conditions_storage, src=0, async_op=True),
+                self._num_step_saves
+            )
+        return self._synced_conditions
+
+    def _should_save_step(self, trainer):
+        """
+        Called at the end of the last batch of an optimizer step, before
+        pl increments global_step
+        """
+        step = trainer.global_step + 1
+        # deterministic, every rank agrees without communication
+        step_triggered = bool(self.save_step_interval and step % self.save_step_interval == 0)
+        if not self._is_time_based():
+            return step_triggered
+        if self._is_sharded_distributed():
+            time_triggered, within_budget = self._synced_save_conditions(step)
+        else:
+            time_triggered, within_budget = self._local_save_conditions()
+        triggered = step_triggered or time_triggered
+        if self.max_io_fraction:
+            if self.save_step_interval or self.save_time_interval:
+                triggered = triggered and within_budget
+            else:
+                triggered = within_budget
+        return triggered
+
+    def on_batch_end(self, trainer, pl_module):
+        if not self._is_step_save_enabled():
+            return
+        if (trainer.batch_idx + 1) % trainer.accumulate_grad_batches != 0:
+            # in the middle of a gradient accumulation window, no optimizer step yet
+            return
+        self._trainer = trainer
+        if self._should_save_step(trainer):
+            # pl still has to step the lr schedulers and global_step
+            self._pending_step_save = True
+
+    def on_batch_start(self, trainer, pl_module):
+        if not self._pending_step_save:
+            return
+        self._pending_step_save = False
+        self._trainer = trainer
+        start = time.time()
+        self._num_step_saves += 1
+        if self._is_sharded_distributed():
+            # rank 0's clock is reported again after the save
+            self._synced_conditions = (False, False)
+        if self._is_sharded_distributed() or not self._is_time_based():
+            # every rank saves at this step
+            self._sync_train_progress(pl_module)
+        last_path = os.path.join(self.save_dir, 'last.ckpt')
+        self._is_mid_epoch_save = True
+        saved = False
+        try:
+            if self._is_sharded_distributed():
+                U.save_sharded_checkpoint(self._dump_checkpoint(), last_path)
+                if trainer.proc_rank == 0:
+                    self._record(last_path, 'last', trainer.current_epoch)
+                saved = True
+            elif trainer.proc_rank == 0:
+                self._save_model(last_path)
+                self._record(last_path, 'last', trainer.current_epoch)
+                saved = True
+        finally:
+            self._is_mid_epoch_save = False
+        if saved:
+            # only the ranks that wrote measure the cost of a save
+            self._add_save_duration(start)
+            _log.debug2(f'Step {trainer.global_step}: saved {last_path} '
+                        f'in {self._save_durations[-1]:.2f}s')
+
+    def save_emergency(self, trainer, pl_module=None):
+        """
+        Fast synchronous save of `last.ckpt`, e.g. before preemption:
+        plain torch format (or shards), no best/periodic copies, no checksum.
+        Must be called by all ranks at the same step with DDP.
+
+        Returns:
+            path of the saved checkpoint
+        """
+        self._trainer = trainer
+        # saves the same state
+        self._pending_step_save = False
+        # a pending async write must not overwrite it afterwards
+        self.flush()
+        self._sync_train_progress(pl_module)
+        last_path = os.path.join(self.save_dir, 'last.ckpt')
+        self._is_mid_epoch_save = True
+        try:
+            if self._is_sharded_distributed():
+                U.save_sharded_checkpoint(self._dump_checkpoint(), last_path)
+            elif trainer.proc_rank == 0:
+                U.atomic_torch_save(self._dump_checkpoint(), last_path)
+        finally:
+            self._is_mid_epoch_save = False
+        if trainer.proc_rank == 0:
+            if self.save_format == 'dedup':
+                # replaced by a plain file
+                self.store.release(last_path)
+            self._scheduled.add(last_path)
+            self.manifest.add(
+                last_path, 'last', epoch=trainer.current_epoch + 1,
+                step=trainer.global_step, checksum=False
+            )
+        return last_path
+
+    @property
+    def mean_save_duration(self) -> Optional[float]:
+        """
+        Mean blocking time of recent saves in seconds, None if nothing saved yet
+        """
+        if not self._save_durations:
+            return None
+        return sum(self._save_durations) / len(self._save_durations)
+
+    @staticmethod
+    def _sync_train_progress(pl_module):
+        """
+        Collective: partial-epoch train meters summed over all ranks for
+        the next mid-epoch save
+        """
+        if isinstance(pl_module, ExtendedModule):
+            pl_module._sync_train_progress()
+
+    def _dump_checkpoint(self):
+        checkpoint = self._trainer.dump_checkpoint()
+        if self._is_mid_epoch_save:
+            # pl assumes the epoch is complete, resume should restart the current epoch
+            checkpoint['epoch'] = self._trainer.current_epoch
+            # pl assumes a save before the global_step increment, these run
+            # at the start of a batch, after it
+            checkpoint['global_step'] = self._trainer.global_step
+        return checkpoint
+
+    # ==================== manifest ====================
+    @property
+    def manifest(self) -> U.CheckpointManifest:
+        if self._manifest is None:
+            self._manifest = U.CheckpointManifest(
+                self.save_dir, checksum=self.checksum,
+                parse_filename=self._parse_checkpoint_name
+            )
+        return self._manifest
+
+    def _is_taken(self, filepath):
+        return filepath in self._scheduled or filepath in self.manifest
+
+    def _versioned_checkpoint_name(self, epoch, metrics, ckpt_type, monitor=None):
+        """
+        Returns:
+            (filepath, version_cnt), appends a version suffix if the file exists
+        """
+        filepath = self.format_checkpoint_name(
+            epoch, metrics, ckpt_type=ckpt_type, monitor=monitor
+        )
+        version_cnt = 1
+        while self._is_taken(filepath):
+            filepath = self.format_checkpoint_name(
+                epoch, metrics, ver=version_cnt, ckpt_type=ckpt_type, monitor=monitor
+            )
+            # this epoch called before
+            version_cnt += 1
+        return filepath, version_cnt
+
+    def _record(self, filepath, kind, epoch, value=None, monitor=None):
+        """
+        Add the checkpoint to the manifest once it is written
+        """
+        if isinstance(value, torch.Tensor):
+            value = value.item()
+        self._scheduled.add(filepath)
+        self._run_io(
+            self.manifest.add, filepath, kind,
+            epoch=epoch + 1,  # consistent with the `epoch` in file names
+            step=self._trainer.global_step,
+            monitor=monitor,
+            value=value
+        )
+
+    def _restore_top_k(self):
+        """
+        Rebuild the top-k state from the manifest when resuming, so that
+        old best checkpoints keep being evicted properly
+        """
+        if self.save_top_k <= 0:
+            return
+        for monitor, mode in self.monitor_modes.items():
+            best = self.manifest.find('best', monitor)
+            best = {path: e['value'] for path, e in best.items() if e.get('value') is not None}
+            ranked = sorted(best, key=best.get, reverse=(mode == 'max'))
+            best_k_models = self.metric_top_k[monitor]
+            best_k_models.clear()
+            best_k_models.update((path, best[path]) for path in ranked[:self.save_top_k])
+            if best_k_models:
+                _log.debug2(f'Restored top {len(best_k_models)} checkpoints of {monitor} from manifest')
+        self._sync_primary_top_k()
+
+    def average_top_k(self, output_path=None, monitor=None) -> str:
+        """
+        Averages the weights of the current top-k best checkpoints of `monitor`
+        (defaults to the primary metric) into a weights-only checkpoint,
+        streamed one file at a time, see `U.average_checkpoints`.
+        Call on rank 0 after training.
+
+        Args:
+            output_path: defaults to `average.ckpt` in `save_dir`,
+                or `average-val_acc1.ckpt` for a metric other than the primary one
+        Returns:
+            output_path
+        """
+        if monitor is None:
+            monitor = self.monitor
+        assert monitor in self.monitor_modes, f'{monitor} is not a monitored metric'
+        self.flush()
+        # re-read the manifest: with ddp spawn, training ran in child processes
+        self._manifest = None
+        self._restore_top_k()
+        best_k_models = self.metric_top_k[monitor]
+        if not best_k_models:
+            raise FileNotFoundError(f'No best checkpoint of {monitor} to average in {self.save_dir}')
+        if output_path is None:
+            if monitor == self.monitor:
+                output_path = os.path.join(self.save_dir, 'average.ckpt')
+            else:
+                output_path = os.path.join(self.save_dir, f'average-{monitor.replace("/", "_")}.ckpt')
+        output_path = os.path.expanduser(output_path)
+        start = time.time()
+        paths = sorted(best_k_models, key=best_k_models.get)
+        U.average_checkpoints(paths, output_path)
+        _log.info(f'Averaged top {len(paths)} checkpoints of {monitor} into '
+                  f'{output_path} in {time.time() - start:.1f}s')
+        return output_path
+
+    def export_best(self, output_path=None, dtype='fp16', monitor=None) -> str:
+        """
+        Exports the weights of the best checkpoint of `monitor` (defaults to
+        the primary metric) for inference, see `U.export_weights`.
+        Call on rank 0 after training.
+
+        Args:
+            output_path: defaults to `best.weights` in `save_dir`
+            dtype: 'fp16', 'bf16', 'fp32' or None to keep the saved dtype
+        Returns:
+            output_path
+        """
+        if monitor is None:
+            monitor = self.monitor
+        assert monitor in self.monitor_modes, f'{monitor} is not a monitored metric'
+        self.flush()
+        # re-read the manifest: with ddp spawn, training ran in child processes
+        self._manifest = None
+        best_path = self.manifest.best(monitor, self.monitor_modes[monitor])
+        if best_path is None:
+            raise FileNotFoundError(f'No best checkpoint of {monitor} to export in {self.save_dir}')
+        if output_path is None:
+            output_path = os.path.join(self.save_dir, 'best.weights')
+        output_path = os.path.expanduser(output_path)
+        nbytes = U.export_weights(best_path, output_path, dtype=dtype)
+        _log.info(f'Exported weights of {best_path} to {output_path} '
+                  f'({nbytes / 2 ** 20:.1f} MB)')
+        return output_path
+
+    # ==================== file operations ====================
+    def __getstate__(self):
+        # the trainer pickles callbacks to spawn DDP processes
+        state = self.__dict__.copy()
+        state['_writer'] = None
+        state['_trainer'] = None
+        state['_manifest'] = None
+        state['_store'] = None
+        state['_conditions_storage'] = state['_pending_conditions'] = None
+        return state
+
+    @property
+    def store(self) -> U.DedupCheckpointStore:
+        if self._store is None:
+            self._store = U.DedupCheckpointStore(self.save_dir)
+        return self._store
+
+    def _get_save_function(self):
+        if self.save_format == 'dedup':
+            return self.store.save
+        elif self.save_format == 'compressed':
+            return functools.partial(
+                U.save_compressed_checkpoint, codec=self.compression_codec
+            )
+        else:
+            return U.atomic_torch_save
+
+    def _get_writer(self) -> Optional[U.AsyncCheckpointWriter]:
+        if self.async_save and self._writer is None:
+            self._writer = U.AsyncCheckpointWriter(
+                max_pending=self.max_pending_saves, pin_memory=self.pin_memory,
+                save_function=self._get_save_function()
+            )
+        return self._writer
+
+    def _save_model(self, filepath):
+        """
+        Every write is atomic (temp file + fsync + rename), a preempted job
+        never leaves a truncated checkpoint. Renaming also replaces the inode,
+        so other checkpoints hardlinked to `filepath` are left untouched.
+        """
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        if self.sharded:
+            if self._sharded_saves is not None:
+                self._sharded_saves.append(filepath)
+            else:
+                U.save_sharded_checkpoint(self._dump_checkpoint(), filepath)
+            return
+        checkpoint = self._dump_checkpoint()
+        writer = self._get_writer()
+        if writer is None:
+            self._get_save_function()(checkpoint, filepath)
+        else:
+            writer.save(checkpoint, filepath)
+
+    def _run_io(self, fn, *args, **kwargs):
+        """
+        Runs in the writer thread after all pending writes if async_save,
+        or after the collective save if sharded
+        """
+        if self._deferred_io is not None:
+            self._deferred_io.append((fn, args, kwargs))
+            return
+        writer = self._get_writer()
+        if writer is None:
+            return fn(*args, **kwargs)
+        else:
+            writer.submit(fn, *args, **kwargs)
+
+    def _copy_model(self, src, dst, kind, **manifest_fields):
+        """
+        Aliases with hardlink or reflink when the filesystem supports it,
+        to avoid writing the same checkpoint multiple times
+        """
+        def _copy():
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            method = U.f_link_or_copy(src, dst)
+            _log.debug2(f'{method} {src} -> {dst}')
+            if self.save_format == 'dedup':
+                self.store.alias(src, dst)
+            self.manifest.add_alias(src, dst, kind, **manifest_fields)
+
+        self._scheduled.add(dst)
+        # runs after the pending write of `src` if async
+        self._run_io(_copy)
+
+    def _del_model(self, filepath):
+        def _delete():
+            if os.path.isdir(filepath):
+                # sharded checkpoint
+                U.f_remove(filepath)
+            else:
+                super(ExtendedCheckpoint, self)._del_model(filepath)
+            if self.save_format == 'dedup':
+                # deletes the blobs no other checkpoint references
+                self.store.release(filepath)
+            self.manifest.remove(filepath)
+
+        self._scheduled.discard(filepath)
+        self._run_io(_delete)
+
+    def flush(self):
+        """
+        Block until all async checkpoint writes are finished
+        """
+        if self._writer is not None:
+            self._writer.flush()
+
+    def on_train_end(self, trainer, pl_module):
+        """
+        pl only calls `on_validation_end` of the `checkpoint_callback`, this
+        runs through the `training_hooks()` callback (added by `configure_trainer()`).
+        Pending writes are also flushed at interpreter exit
+        """
+        self.flush()
+        if self._pending_conditions is not None:
+            self._pending_conditions[0].wait()
+            self._pending_conditions = None
+
+
+def _parse_monitor_modes(monitor_metric, default_mode) -> Dict[str, str]:
+    """
+    Returns:
+        {metric name: 'min' or 'max'}, 'auto' resolved like pl ModelCheckpoint
+    """
+    if isinstance(monitor_metric, str):
+        monitor_metric = [monitor_metric]
+    if hasattr(monitor_metric, 'items'):  # dict or DictConfig
+        modes = dict(monitor_metric.items())
+    else:
+        modes = {name: default_mode for name in monitor_metric}
+    assert modes, 'at least one monitor_metric is required'
+    resolved = {}
+    for name, mode in modes.items():
+        if not mode or mode == 'auto':
+            mode = 'max' if 'acc' in name or name.startswith('fmeasure') else 'min'
+        assert mode in ['min', 'max'], f'invalid mode {mode} for monitor metric {name}'
+        resolved[name] = mode
+    return resolved
+
+
+class _CheckpointTrainingHooks(Callback):
+    """
+    See ExtendedCheckpoint.training_hooks()
+    """
+    def __init__(self, checkpoint_callback: ExtendedCheckpoint):
+        self.checkpoint_callback = checkpoint_callback
+
+    def on_batch_start(self, trainer, pl_module):
+        self.checkpoint_callback.on_batch_start(trainer, pl_module)
+
+    def on_batch_end(self, trainer, pl_module):
+        self.checkpoint_callback.on_batch_end(trainer, pl_module)
+
+    def on_train_end(self, trainer, pl_module):
+        self.checkpoint_callback.on_train_end(trainer, pl_module)
+
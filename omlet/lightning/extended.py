@@ -4,6 +4,7 @@ Quick hack: enhanced pytorch-lightning mixin
 
 import argparse
 import functools
+import random
 from typing import Union, Dict, List, Optional, Any
 from pprint import pprint
 import omlet.utils as U
@@ -31,6 +32,10 @@ class ExtendedModule(LightningModule):
         - batch_size or global_batch_size
         - eval_batch_size or global_eval_batch_size (defaults to `batch_size` if unspecified)
         - num_workers or global_num_workers
+        - stepwise_window (defaults to trainer.row_log_interval): number of
+            recent steps averaged for `train/stepwise_*` logs
+        - stepwise_window_seconds (optional): also limit the stepwise moving
+            average to the last N seconds
 
     Useful attributes:
         - hparams
@@ -53,20 +58,24 @@ class ExtendedModule(LightningModule):
     best_metrics:
         {'val/acc1': 'max', 'test/acc5': 'max', 'val/loss': 'min'}
     """
-    def __new__(cls, *args, **kwargs):
+    # guards against nested patched calls, e.g. test_step() -> validation_step()
+    # or super().training_step() when both parent and child are patched
+    _in_patched_call = False
+
+    def __init_subclass__(cls, **kwargs):
         """
-        Class-level patch to avoid multiprocessing pickle error:
+        Class-level patch, done exactly once per subclass at class creation.
+        Patching the class instead of the instance avoids multiprocessing pickle error:
             _pickle.PicklingError: Can't pickle <function .. at ..>: it's not
             the same object as __main__.<obj>
         """
-        obj = super().__new__(cls)
+        super().__init_subclass__(**kwargs)
         # patch up subclass methods:
         #   - [train|validation|test]_step
         #   - [train|validation|test]_epoch_end
         for stage in STAGES:
             cls._patch_pl_step(stage)
             cls._patch_pl_epoch_end(stage)
-        return obj
 
     def __init__(self, hparams: Union[dict, argparse.Namespace, DictConfig]):
         super().__init__()
@@ -85,22 +94,43 @@ class ExtendedModule(LightningModule):
         test_metrics: List[str] = self._check_hparams('test_metrics', default=val_metrics)
         best_metrics: Dict[str, str] = self._check_hparams('best_metrics', default={})
         self.debug = self._check_hparams('debug', default=False)
+        self._stepwise_window = self._check_hparams('stepwise_window', default=None)
+        self._stepwise_window_seconds = self._check_hparams('stepwise_window_seconds', default=None)
 
         self._metrics_meter = {}
-        self._train_step_meter = {}  # show fine-grained step logs for training
+        # moving average for fine-grained step logs in training, see _get_train_step_meter()
+        self._train_step_meter = None
+        self._train_metric_names = train_metrics
         self._metrics_history = []  # list of {'train/loss': .., 'val/acc1': ...}
         self._best_metrics_values = {}  # {'val/acc1': {'value': 76.1, 'epoch': 87, 'step': 900}}
         self._best_metrics_spec = best_metrics
 
         for stage, names in zip(STAGES, (train_metrics, val_metrics, test_metrics)):
-            self._metrics_meter[stage] = {m: U.AverageMeter() for m in names}
-            if stage == 'train':
-                self._train_step_meter = {m: U.AverageMeter() for m in names}
+            # TensorMeter accumulates on device, avoids host sync at every step
+            self._metrics_meter[stage] = {m: U.TensorMeter() for m in names}
+        # precomputed (key, meter) tables and reused dicts for the per-step path
+        self._epoch_meter_table = {
+            stage: tuple(meters.items()) for stage, meters in self._metrics_meter.items()
+        }
+        self._pbar_values = {stage: {} for stage in STAGES}
+        self._stepwise_meter_table = None  # see _get_train_step_meter()
+        self._stepwise_log_values = {}
 
         for name, value in best_metrics.items():
             assert '/' in name
             assert value in ['min', 'max']
 
+        # persistent buffer for epoch-end DDP reduction, allocated on first use
+        self._reduce_buffer: Optional[dist.ReduceBuffer] = None
+        # mid-epoch resume, see get_dataloader()
+        self._train_sampler: Optional[dist.ResumableSampler] = None
+        self._sampler_seed = self._get_sampler_seed()
+        self._resume_progress = None
+        self._resumed_epoch = None
+        # train meter states summed over all ranks for the next save
+        self._synced_train_meters = None
+        # batches of the current epoch that completed their training step
+        self._train_batches_done = 0
         self._is_training_started = False
         # to be propagated to children processes
         self._global_logging_level = U.get_logging_level()
@@ -174,14 +204,44 @@ class ExtendedModule(LightningModule):
                 local_value = default
         return local_value
 
+    def _get_sampler_seed(self):
+        """
+        `seed` from hparams, otherwise drawn from the RNG seeded by
+        set_seed_everywhere(). Drawn here so that DDP processes share it,
+        and saved in checkpoints so that resume replays the same order
+        """
+        seed = self._check_hparams('seed', default=None)
+        if isinstance(seed, int) and seed >= 0:
+            return seed
+        return random.randrange(2 ** 31)
+
     def get_dataloader(self, dataset, stage):
+        """
+        The shuffled train loader uses a ResumableSampler, its position is saved
+        in checkpoints. With DDP, pl adds a DistributedSampler instead unless
+        `configure_trainer(mid_epoch_resume=True)`, in which case the
+        samplers are created here.
+        """
         assert stage in STAGES
         num_workers = self._divide_by_gpu('num_workers', default=8)
         if stage == 'train':
+            batch_size = self._divide_by_gpu('batch_size')
+            if self.use_ddp and self.trainer.replace_sampler_ddp:
+                self._train_sampler = None
+                return torch.utils.data.DataLoader(
+                    dataset=dataset,
+                    batch_size=batch_size,
+                    shuffle=False,
+                    num_workers=num_workers
+                )
+            self._train_sampler = dist.ResumableSampler(
+                dataset, shuffle=True, seed=self._sampler_seed
+            )
+            self._restore_sampler_progress()
             return torch.utils.data.DataLoader(
                 dataset=dataset,
-                batch_size=self._divide_by_gpu('batch_size'),
-                shuffle=not self.use_ddp,
+                batch_size=batch_size,
+                sampler=self._train_sampler,
                 num_workers=num_workers
             )
         else:
@@ -189,13 +249,85 @@ class ExtendedModule(LightningModule):
             if eval_batch_size == -1:
                 # defaults to training batch_size
                 eval_batch_size = self._divide_by_gpu('batch_size')
+            sampler = None
+            if self.use_ddp and not self.trainer.replace_sampler_ddp:
+                sampler = torch.utils.data.DistributedSampler(dataset, shuffle=False)
             return torch.utils.data.DataLoader(
                 dataset=dataset,
                 batch_size=eval_batch_size,
                 shuffle=False,
+                sampler=sampler,
                 num_workers=num_workers
             )
 
+    def _is_train_sampler_in_use(self):
+        loader = getattr(self.trainer, 'train_dataloader', None)
+        return (self._train_sampler is not None
+                and getattr(loader, 'sampler', None) is self._train_sampler)
+
+    def _sync_train_progress(self):
+        """
+        Collective, called by ExtendedCheckpoint on every rank before a
+        mid-epoch save that all ranks reach at the same step. The next saved
+        train meters are summed over all ranks, restored by rank 0 alone.
+        """
+        meters = {}
+        for name, meter in self._metrics_meter['train'].items():
+            # the live meters keep accumulating local values
+            meters[name] = U.AverageMeter()
+            meters[name].load_state_dict(meter.state_dict())
+        self._synced_train_meters = {
+            name: meter.state_dict() for name, meter in U.reduce_meters_(meters).items()
+        }
+
+    def _get_train_progress(self):
+        """
+        Position in the current epoch, saved in checkpoints for mid-epoch resume.
+
+        The partial train meters are exact over all ranks if the save was
+        prepared with _sync_train_progress(). Otherwise (DDP saves decided by
+        the clock of rank 0 alone) they are rank 0's, and every rank restores
+        them: rank 0's batches before the save stand in for the other ranks'
+        in the average of the resumed epoch.
+        """
+        synced, self._synced_train_meters = self._synced_train_meters, None
+        progress = {
+            'epoch': self.current_epoch,
+            'train_meters': synced if synced is not None else {
+                name: meter.state_dict() for name, meter in self._metrics_meter['train'].items()
+            },
+            # summed over all ranks, restored by rank 0 only
+            'train_meters_reduced': synced is not None,
+            'sampler': None,
+        }
+        if self._is_train_sampler_in_use():
+            sampler = self._train_sampler
+            state = sampler.state_dict()
+            # mid-epoch saves are written at the start of the next batch
+            consumed = self._train_batches_done * self.trainer.train_dataloader.batch_size
+            state['start_index'] = min(sampler.start_index + consumed, sampler.num_samples)
+            progress['sampler'] = state
+        return progress
+
+    def _restore_sampler_progress(self):
+        """
+        Fast-forwards the train sampler if resuming in the middle of this epoch
+        """
+        progress = self._resume_progress
+        # the loader is created before pl sets self.current_epoch
+        epoch = self.trainer.current_epoch
+        if progress is None or progress['epoch'] != epoch \
+                or progress['sampler'] is None:
+            return
+        if self._train_sampler.load_state_dict(progress['sampler']):
+            self._resumed_epoch = epoch
+            self.log_info(
+                f'Resuming epoch {epoch} from sample '
+                f'{self._train_sampler.start_index} of {self._train_sampler.num_samples} per GPU'
+            )
+        else:
+            self.log_warn('Number of GPUs changed, cannot resume mid-epoch, restarting the epoch')
+
     # ================ Patch [train|validation|test]_step() ===================
     @classmethod
     def _patch_pl_step(cls, stage):
@@ -205,11 +337,21 @@ class ExtendedModule(LightningModule):
             'test': 'test_step'
         }[stage]
         pl_step_method = getattr(cls, pl_method_name)
+        if getattr(pl_step_method, '_omlet_patched', False):
+            # inherited from an already patched parent class
+            return
 
         @functools.wraps(pl_step_method)
         def _wrapped(self, batch, batch_idx, *args, **kwargs):
-            output = pl_step_method(self, batch, batch_idx, *args, **kwargs)
+            if self._in_patched_call:
+                return pl_step_method(self, batch, batch_idx, *args, **kwargs)
+            self._in_patched_call = True
+            try:
+                output = pl_step_method(self, batch, batch_idx, *args, **kwargs)
+            finally:
+                self._in_patched_call = False
             return self._after_step(stage, batch, output)
+        _wrapped._omlet_patched = True
         # monkey patch
         setattr(cls, pl_method_name, _wrapped)
 
@@ -218,29 +360,59 @@ class ExtendedModule(LightningModule):
             'self does not yet support DP or DDP2, only single GPU or DDP'
         batch_size = self.get_batch_size(batch)
         self._update_epoch_metrics(stage, output, batch_size)
-        if 'progress_bar' not in output:
-            output['progress_bar'] = {}
-        output['progress_bar'].update(self._get_avg_epoch_metrics(stage))
-        output['progress_bar'].pop('loss', None)  # hack: PTL already adds loss to progress bar
+        # reading meter values syncs with the device, only do it when needed
+        if self._is_progress_bar_refresh_step(stage):
+            pbar = output.get('progress_bar')
+            if pbar is None:
+                pbar = output['progress_bar'] = {}
+            pbar.update(self._fill_meter_values(
+                self._pbar_values[stage], self._epoch_meter_table[stage]
+            ))
+        if 'progress_bar' in output:
+            output['progress_bar'].pop('loss', None)  # hack: PTL already adds loss to progress bar
         if stage == 'train':
+            # set, not incremented: several optimizers or tbptt splits call it per batch
+            self._train_batches_done = self.trainer.batch_idx + 1
             # record log at every training batch step
             # for test and val, we don't record log at every batch step
             # only one summary statistic at step end
-            # training stats are averaged over trainer.row_log_interval
-            # (how often we write to TB logs)
-            if 'log' not in output:
-                output['log'] = {}
-
+            # training stats are moving averages over the last
+            # `stepwise_window` steps (defaults to trainer.row_log_interval,
+            # i.e. how often we write to TB logs)
             self._update_train_step_metrics(output, batch_size)
-            output['log'].update(self._get_avg_train_step_metrics(
-                name_template='train/stepwise_{name}'
-            ))
-            self._add_extended_log(output['log'])
             # we don't do (self.batch_idx+1) because we need to sync with PL
             if self.batch_idx % self.trainer.row_log_interval == 0:
-                self._reset_train_step_metrics()
+                # PL only writes to loggers on these steps
+                log = output.get('log')
+                if log is None:
+                    log = output['log'] = {}
+                log.update(self._fill_meter_values(
+                    self._stepwise_log_values, self._stepwise_meter_table
+                ))
+                self._add_extended_log(log)
         return output
 
+    @staticmethod
+    def _fill_meter_values(values: Dict[str, float], table):
+        """
+        Refresh a persistent dict in place from a precomputed (key, meter) table
+        """
+        for key, meter in table:
+            values[key] = meter.value
+        return values
+
+    def _is_progress_bar_refresh_step(self, stage):
+        """
+        PL only shows step-level progress bar metrics for training,
+        and only refreshes every `refresh_rate` batches
+        """
+        if stage != 'train':
+            return False
+        pbar = getattr(self.trainer, 'progress_bar_callback', None)
+        if pbar is None or not pbar.is_enabled:
+            return False
+        return (self.batch_idx + 1) % pbar.refresh_rate == 0
+
     # ============ Patch [train|validation|test]_epoch_end() ==================
     @classmethod
     def _patch_pl_epoch_end(cls, stage):
@@ -251,11 +423,21 @@ class ExtendedModule(LightningModule):
             'test': 'test_epoch_end'
         }[stage]
         pl_method = getattr(cls, pl_method_name)
+        if getattr(pl_method, '_omlet_patched', False):
+            # inherited from an already patched parent class
+            return
 
         @functools.wraps(pl_method)
         def _wrapped(self, outputs):
-            pl_method(self, outputs)
+            if self._in_patched_call:
+                return pl_method(self, outputs)
+            self._in_patched_call = True
+            try:
+                pl_method(self, outputs)
+            finally:
+                self._in_patched_call = False
             return self._epoch_end(stage)
+        _wrapped._omlet_patched = True
 
         setattr(cls, pl_method_name, _wrapped)
 
@@ -263,10 +445,7 @@ class ExtendedModule(LightningModule):
         """
         Collect stats from all processes at the end of an epoch
         """
-        _info = self._get_avg_epoch_metrics(stage, name_template='{name}')
-        # cumulative batch size on all GPUs should be exactly the same
-        # so we can do a simple mean
-        info_short_name = self.reduce(_info, op='mean')
+        info_short_name = self._reduce_epoch_metrics(stage)
         # add long name (train/acc1)
         info_long_name = {f'{stage}/{name}': v for name, v in info_short_name.items()}
         pbar = info_long_name.copy()
@@ -315,46 +494,85 @@ class ExtendedModule(LightningModule):
             assert dist.get_rank() == self.rank
         return self.rank != 0
 
-    def reduce(self, values: Union[float, Dict[str, float]], op: str) \
-            -> Union[float, Dict[str, float]]:
+    def reduce(self, values: Union[float, Dict[str, float]], op: str,
+               async_op=False) -> Union[float, Dict[str, float], dist.AsyncReduce]:
+        """
+        async_op: True to return a dist.AsyncReduce handle, call `.wait()`
+            lazily to get the reduced values (also works without DDP)
+        """
         if self.use_ddp:
             return dist.reduce_scalars(
-                values, broadcast=True, device=self.device, op=op
+                values, broadcast=True, device=self.device, op=op,
+                async_op=async_op
             )
+        elif async_op:
+            return dist.AsyncReduce(dist.CompletedWork(), lambda: values)
         else:
             return values
 
+    def _get_reduce_buffer(self) -> dist.ReduceBuffer:
+        """
+        One segment per stage, each metric has a `sum` and a `count` slot
+        """
+        if self._reduce_buffer is None:
+            segments = {}
+            for stage in STAGES:
+                segments[stage] = [
+                    k for name in self._metrics_meter[stage]
+                    for k in dist.sum_count_keys(name)
+                ]
+            self._reduce_buffer = dist.ReduceBuffer(segments, device=self.device)
+        return self._reduce_buffer
+
+    def _reduce_epoch_metrics(self, stage):
+        """
+        Exact global averages weighted by the number of samples each process
+        has seen, reduced with a single collective through the persistent buffer
+        """
+        meters = self._metrics_meter[stage]
+        if not self.use_ddp:
+            return {name: meter.value for name, meter in meters.items()}
+        return dist.reduce_meters(
+            meters, broadcast=True,
+            storage=self._get_reduce_buffer(), segment=stage
+        )
+
     # ==================== Metrics book-keeping ====================
     def _reset_epoch_metrics(self, stages='all'):
         for stage in STAGES if stages == 'all' else [stages]:
             for meter in self._metrics_meter[stage].values():
                 meter.reset()
 
-    def _reset_train_step_metrics(self, stages='all'):
-        for meter in self._train_step_meter.values():
-            meter.reset()
-
-    def _get_avg_epoch_metrics(self, stage, name_template='{name}'):
-        return {
-            name_template.format(stage=stage, name=name): meter.value
-            for name, meter in self._metrics_meter[stage].items()
-        }
+    def _get_train_step_meter(self) -> Dict[str, U.WindowedMeter]:
+        """
+        Moving averages for the `train/stepwise_*` logs, apart from the epoch
+        meters: they carry over epochs, and the epoch meters do not keep a
+        history (averaging one would copy it to host at every log step).
+        Lazily created because the default window needs the trainer
+        """
+        if self._train_step_meter is None:
+            window = self._stepwise_window or self.trainer.row_log_interval
+            self._train_step_meter = {
+                m: U.WindowedMeter(window, window_seconds=self._stepwise_window_seconds)
+                for m in self._train_metric_names
+            }
+            self._stepwise_meter_table = tuple(
+                (f'train/stepwise_{name}', meter)
+                for name, meter in self._train_step_meter.items()
+            )
+        return self._train_step_meter
 
-    def _get_avg_train_step_metrics(self, name_template='{name}'):
-        return {
-            name_template.format(name=name): meter.value
-            for name, meter in self._train_step_meter.items()
-        }
-    
     def _update_epoch_metrics(self, stage, output, batch_size):
-        for key, value in output.items():
-            if key in self._metrics_meter[stage]:
-                self._metrics_meter[stage][key].update(value, batch_size)
+        for key, meter in self._epoch_meter_table[stage]:
+            value = output.get(key)
+            if value is not None:
+                meter.update(value, batch_size)
 
     def _update_train_step_metrics(self, output, batch_size):
-        for key, value in output.items():
-            if key in self._train_step_meter:
-                self._train_step_meter[key].update(value, batch_size)
+        for key, meter in self._get_train_step_meter().items():
+            value = output.get(key)
+            if value is not None:
+                meter.update(value, batch_size)
 
     def _update_best_metrics(self, metric_name, new_value):
         assert metric_name in self._best_metrics_spec
@@ -386,15 +604,39 @@ class ExtendedModule(LightningModule):
 
     # ==================== Override hooks ====================
     def on_epoch_start(self):
+        # stepwise train meters are moving averages and carry over epochs
         self._reset_epoch_metrics()
-        self._reset_train_step_metrics()
+        self._train_batches_done = 0
+        self._synced_train_meters = None
         self._is_training_started = True  # avoid sanity check
+        if self._resumed_epoch is not None and self._resumed_epoch != self.current_epoch:
+            # back to full epochs after the resumed one
+            self._resumed_epoch = None
+            self.trainer.reset_train_dataloader(self)
+        if self._resume_progress is not None:
+            # partial metrics only if the sampler skips the samples they count,
+            # an epoch that restarts from the beginning would count them twice.
+            # A global sum is restored once so that the epoch-end reduction
+            # does not count it per rank
+            if self._resumed_epoch == self.current_epoch and (
+                    not self._resume_progress.get('train_meters_reduced', False)
+                    or self.rank == 0):
+                for name, state in self._resume_progress['train_meters'].items():
+                    if name in self._metrics_meter['train']:
+                        self._metrics_meter['train'][name].load_state_dict(state)
+            # used or skipped, the train loader has been created
+            self._resume_progress = None
+        if self._is_train_sampler_in_use():
+            # pl only calls set_epoch() with DDP
+            self._train_sampler.set_epoch(self.current_epoch)
 
     def on_save_checkpoint(self, checkpoint):
         # patch pl
         extended = {
             'metrics_history': self._metrics_history,
-            'best_metrics': self._best_metrics_values
+            'best_metrics': self._best_metrics_values,
+            'train_progress': self._get_train_progress(),
+            'sampler_seed': self._sampler_seed,
         }
         checkpoint['extended'] = extended
         return checkpoint
@@ -404,6 +646,9 @@ class ExtendedModule(LightningModule):
         extended = checkpoint['extended']
         self._metrics_history = extended['metrics_history']
         self._best_metrics_values = extended['best_metrics']
+        # applied when the train loader is created, see get_dataloader()
+        self._resume_progress = extended.get('train_progress')
+        self._sampler_seed = extended.get('sampler_seed', self._sampler_seed)
 
     def init_ddp_connection(
             self,
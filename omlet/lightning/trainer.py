@@ -13,7 +13,7 @@ from omegaconf import DictConfig
 import omlet.utils as U
 from typing import Optional, Union, Dict, Any, List, Callable
 from . import omlet_logger as _log, override_loggers
-from .callbacks import FileLogger
+from .callbacks import FileLogger, PreemptionHandler
 from .checkpoint import ExtendedCheckpoint
 
 
@@ -36,6 +36,44 @@ def _check_run_name(run_name):
             f'Run name "{run_name}" cannot have special character {special_char}'
 
 
+class ExtendedTrainer(pl.Trainer):
+    """
+    pl.Trainer that restores `resume_from_checkpoint` in every format written
+    by ExtendedCheckpoint. The checkpoint is read once by `U.load_checkpoint()`,
+    memory-mapped when supported (pl would `torch.load()` all of it into memory),
+    and restored like pl.Trainer.restore().
+    `trainer.test()` only loads the model weights.
+
+    Returned by `configure_trainer()`.
+    """
+    def restore(self, checkpoint_path: str, on_gpu: bool):
+        if self.testing:
+            checkpoint = U.load_checkpoint(checkpoint_path, state_dict_only=True)
+            model = self.get_model()
+            model.load_state_dict(checkpoint['state_dict'])
+            if on_gpu:
+                model.cuda(self.root_gpu)
+            _log.info(f'Loaded weights for evaluation: {checkpoint_path}')
+            return
+        # memory-mapped when supported, tensors are only read when used
+        checkpoint = U.load_checkpoint(checkpoint_path)
+        if 'optimizer_states' not in checkpoint:
+            raise ValueError(
+                f'Cannot resume training from {checkpoint_path}: weights-only checkpoint, '
+                f'e.g. written by average_top_k() or export_weights(). Evaluate it with '
+                f'trainer.test() (`eval=true` in hydra_trainer) instead'
+            )
+        # mirrors pl.Trainer.restore()
+        model = self.get_model()
+        model.load_state_dict(checkpoint['state_dict'])
+        model.on_load_checkpoint(checkpoint)
+        if on_gpu:
+            model.cuda(self.root_gpu)
+        if self.use_amp and self.use_native_amp and 'native_amp_scaling_state' in checkpoint:
+            self.scaler.load_state_dict(checkpoint['native_amp_scaling_state'])
+        self.restore_training_state(checkpoint)
+
+
 def configure_trainer(
         *,
         root_dir,  # experiment root folder
@@ -45,12 +83,22 @@ def configure_trainer(
         fp16: bool = False,
         # checkpointing
         resume: Union[str, int, bool] = False,
-        monitor_metric: str,
+        monitor_metric: Union[str, List[str], Dict[str, str]],
         monitor_metric_mode: str,  # min or max
         save_top_k: int = 3,
         save_epoch_interval: int = 5,
         always_save_last: bool = True,
         best_filename_template: Optional[str] = None,
+        sharded_checkpoint: bool = False,
+        checkpoint_format: str = 'torch',
+        checkpoint_compression: str = 'zlib',
+        save_step_interval: int = 0,
+        save_time_interval: float = 0,
+        max_checkpoint_io_fraction: float = 0,
+        checkpoint_checksum: bool = False,
+        mid_epoch_resume: bool = False,
+        handle_preemption: bool = False,
+        preemption_grace_period: float = 120.,
         # distributed environment variables
         master_addr='localhost',
         master_port='auto',
@@ -64,12 +112,43 @@ def configure_trainer(
         **extra_trainer_kwargs
 ):
     """
+    monitor_metric:
+        a metric name like 'val/acc1', a list of names, or a dict {name: mode}
+        to keep the top-k checkpoints of several metrics in one run,
+        see ExtendedCheckpoint. `monitor_metric_mode` applies to all names in a list
     always_save_last:
         True to always save `last.ckpt` regardless of regular epoch intervals
         `last.ckpt` is for resuming and will be replaced every epoch
+    sharded_checkpoint:
+        True for each DDP rank to save its own slice of every checkpoint in parallel
+    checkpoint_format:
+        'torch', 'dedup' or 'compressed', see ExtendedCheckpoint `save_format`
+    checkpoint_compression:
+        codec for checkpoint_format='compressed': 'zlib', 'bz2' or 'lzma'
+    save_step_interval, save_time_interval (seconds):
+        also refresh `last.ckpt` every N steps or seconds, 0 to disable
+    max_checkpoint_io_fraction:
+        cap the fraction of training time spent blocked on checkpoint saves,
+        e.g. 0.03. See ExtendedCheckpoint `max_io_fraction`
+    checkpoint_checksum:
+        record a CRC32 of every checkpoint and check it on resume,
+        costs a full extra read of every checkpoint. File sizes are always checked
+    mid_epoch_resume:
+        with DDP, keep the ExtendedModule train sampler instead of pl's
+        DistributedSampler, so that resuming from a mid-epoch checkpoint
+        (see `save_step_interval`) skips the samples already trained on.
+        Without DDP, mid-epoch resume always works
+    handle_preemption:
+        on SIGTERM / SIGUSR1, save `last.ckpt` at the next step and stop training
+        cleanly, see PreemptionHandler. Relaunch with resume='auto'
+    preemption_grace_period:
+        seconds between the signal and the forced kill by the scheduler
     resume:
-        - 'last': resume from last.ckpt checkpoint in the folder
-        - 'best/epoch=1': any relative path within the run folder
+        - 'last' or True: resume from last.ckpt checkpoint in the folder
+        - 'auto': 'last' if the run has any checkpoint, otherwise start from scratch
+        - 'best': resume from the best checkpoint of `monitor_metric` (the first one)
+        - 'best/epoch=1': any relative path within the run folder,
+            '.ckpt' is appended unless the path exists as given, e.g. 'best.weights'
         - 4 (int): defaults to 'epoch={N}.ckpt'
         - '~/my/checkpoint/file.ckpt': full path
     wandb:
@@ -98,14 +177,20 @@ def configure_trainer(
     assert os.path.isdir(root_dir)
     exp_dir = U.f_join(root_dir, run_name)
     is_exp_dir_exists = os.path.exists(exp_dir)
-    assert '/' in monitor_metric
+    monitor_names = [monitor_metric] if isinstance(monitor_metric, str) else list(monitor_metric)
+    for name in monitor_names:
+        assert '/' in name, f'monitor_metric {name} should look like "val/acc1"'
 
     if not monitor_metric_mode:
         monitor_metric_mode = 'auto'
     assert monitor_metric_mode in ['min', 'max', 'auto']
 
     if not best_filename_template:
-        best_filename_template = 'best/{epoch}-{' + monitor_metric + ':.2f}'
+        if len(monitor_names) == 1:
+            best_filename_template = 'best/{epoch}-{' + monitor_names[0] + ':.2f}'
+        else:
+            # each metric has its own subfolder, e.g. best/val_acc1/epoch=5.ckpt
+            best_filename_template = 'best/{epoch}'
 
     ckpt_dir = U.f_join(exp_dir, 'ckpt')
     checkpoint_callback = ExtendedCheckpoint(
@@ -116,7 +201,14 @@ def configure_trainer(
         monitor_metric_mode=monitor_metric_mode,
         save_top_k=save_top_k,
         save_epoch_interval=save_epoch_interval,
-        always_save_last=always_save_last
+        always_save_last=always_save_last,
+        sharded=sharded_checkpoint,
+        save_format=checkpoint_format,
+        compression_codec=checkpoint_compression,
+        save_step_interval=save_step_interval,
+        save_time_interval=save_time_interval,
+        max_io_fraction=max_checkpoint_io_fraction,
+        checksum=checkpoint_checksum,
     )
     _log.info(f'checkpoint dir: {ckpt_dir}')
 
@@ -142,13 +234,25 @@ def configure_trainer(
 
     if callbacks is None:
         callbacks = []
+    callbacks.append(checkpoint_callback.training_hooks())
+    if handle_preemption:
+        callbacks.append(PreemptionHandler(grace_period=preemption_grace_period))
     if log_file:
         callbacks.append(FileLogger(U.f_join(exp_dir, log_file)))
 
+    if resume == 'auto':
+        resume = 'last' if checkpoint_callback.manifest.last() is not None else False
     if resume:
         assert isinstance(resume, (int, str, bool))
-        if resume is True:
-            resume = U.f_join(ckpt_dir, 'last.ckpt')
+        manifest = checkpoint_callback.manifest
+        if resume is True or resume == 'last':
+            resume = manifest.last()
+            if resume is None:
+                raise FileNotFoundError(f'No checkpoint to resume in {ckpt_dir}')
+        elif resume == 'best':
+            resume = manifest.best(checkpoint_callback.monitor, checkpoint_callback.mode)
+            if resume is None:
+                raise FileNotFoundError(f'No best checkpoint of {checkpoint_callback.monitor} to resume in {ckpt_dir}')
         elif isinstance(resume, int):
             resume = U.f_join(ckpt_dir, f'epoch={resume}.ckpt')
         elif os.path.isabs(resume):
@@ -159,11 +263,17 @@ def configure_trainer(
                 time.sleep(2)
         else:
             resume = U.f_join(ckpt_dir, resume)
-        if not resume.endswith('.ckpt'):
+        if not os.path.exists(resume) and not resume.endswith('.ckpt'):
             resume += '.ckpt'
+        # a sharded checkpoint whose save crashed between the two renames
+        if U.f_recover_swap(resume):
+            _log.warn(f'Recovered {resume} from the previous version left by an interrupted save')
         # check resume ckpt path must exist
         if not os.path.exists(resume):
             raise FileNotFoundError(f'Resume file {resume} does not exist')
+        if not manifest.verify(resume):
+            raise RuntimeError(f'Resume file {resume} is corrupted, '
+                               f'size or checksum does not match {manifest.path}')
         _log.info(f'Resuming run from checkpoint: {resume}')
     else:
         if is_exp_dir_exists:
@@ -171,9 +281,11 @@ def configure_trainer(
             # give the user a bit time to terminate
             time.sleep(2)
         _log.info(f'Starting a new run from scratch: {run_name}')
-        resume = None
 
-    return pl.Trainer(
+    if mid_epoch_resume:
+        extra_trainer_kwargs.setdefault('replace_sampler_ddp', False)
+
+    return ExtendedTrainer(
         gpus=gpus,
         max_epochs=epochs,
         distributed_backend=distributed_backend,
@@ -181,7 +293,7 @@ def configure_trainer(
         checkpoint_callback=checkpoint_callback,
         callbacks=callbacks,
         logger=loggers,
-        resume_from_checkpoint=resume,
+        resume_from_checkpoint=resume or None,
         **extra_trainer_kwargs
     )
 
@@ -199,6 +311,11 @@ def hydra_trainer(pl_module_cls,
         - log_level ("info"): sets global logging level
         - seed (None): None to use system time
         - eval (False): True for trainer.fit(); False for trainer.test()
+            with `resume`, trainer.test() only loads the model weights, memory-mapped
+        - average_top_k (False): after trainer.fit(), average the weights of the
+            top-k best checkpoints into `ckpt/average.ckpt`, streamed one file at
+            a time. It has no training state, evaluate it with `eval=true resume=average`
+            Skipped if training was interrupted, e.g. by preemption
         - os_envs (dict): sets extra os environment variables
         - callbacks (dict): instantiable callback configs
         - trainer (dict): extra pl.Trainer() kwargs
@@ -252,5 +369,11 @@ def hydra_trainer(pl_module_cls,
         trainer.test(model)
     else:
         trainer.fit(model)
+        if trainer.interrupted:
+            # preempted or stopped by the user, leave the grace period to the exit
+            _log.info('Training was interrupted, skipping post-training steps')
+            return
+        if cfg.get('average_top_k', False) and trainer.proc_rank == 0:
+            trainer.checkpoint_callback.average_top_k()
 
 
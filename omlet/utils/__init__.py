@@ -5,5 +5,6 @@ from .torch_utils import *
 from .distributed import *
 from .timer import Timer
 from .file_utils import *
+from .checkpoint_utils import *
 from .metrics import *
 from .misc_utils import *
@@ -0,0 +1,1363 @@
+"""
+Checkpoint I/O utils.
+"""
+import os
+import io
+import copy
+import json
+import time
+import heapq
+import pickle
+import queue
+import hashlib
+import zipfile
+import struct
+import zlib
+import bz2
+import lzma
+import collections
+import concurrent.futures
+import atexit
+import inspect
+import threading
+import numpy as np
+import torch
+from typing import Optional, Dict, Any, Callable, List
+from .file_utils import (
+    f_atomic_open, f_expand, f_remove, f_fsync_dir, f_swap_dir, f_recover_swap,
+    crc32_checksum
+)
+from . import distributed as dist
+
+
+def atomic_torch_save(obj, filepath, fsync=True):
+    """
+    torch.save() through a temp file + fsync + rename, see f_atomic_open()
+    A crash mid-write never leaves a truncated checkpoint behind.
+    """
+    with f_atomic_open(filepath, 'wb', fsync=fsync) as f:
+        torch.save(obj, f)
+
+
+def torch_load(f, map_location='cpu', **kwargs):
+    """
+    torch.load() that unpickles arbitrary checkpoint objects on all torch
+    versions (newer versions default to `weights_only=True`)
+    """
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        kwargs.setdefault('weights_only', False)
+    return torch.load(f, map_location=map_location, **kwargs)
+
+
+def torch_load_mmap(path, map_location='cpu'):
+    """
+    Memory-maps the file instead of reading it (zip format of torch >= 1.6),
+    so tensors are only paged in from disk when accessed, e.g. optimizer state
+    is never read if only the `state_dict` is used.
+    Uses `torch.load(mmap=True)` on torch >= 2.1, `_torch_zip_load_mmap()`
+    on older versions. Falls back to a regular load otherwise.
+    """
+    path = f_expand(path)
+    if zipfile.is_zipfile(path):
+        if 'mmap' in inspect.signature(torch.load).parameters:
+            return torch_load(path, map_location=map_location, mmap=True)
+        try:
+            checkpoint = _torch_zip_load_mmap(path)
+        except _UnsupportedZipCheckpoint:
+            pass
+        else:
+            if map_location not in [None, 'cpu']:
+                checkpoint = _map_leaves(
+                    checkpoint,
+                    lambda _, x: x.to(map_location) if torch.is_tensor(x) else x
+                )
+            return checkpoint
+    return torch_load(path, map_location=map_location)
+
+
+class _UnsupportedZipCheckpoint(Exception):
+    pass
+
+
+_STORAGE_DTYPES = {
+    'FloatStorage': torch.float32,
+    'DoubleStorage': torch.float64,
+    'HalfStorage': torch.float16,
+    'BFloat16Storage': torch.bfloat16,
+    'LongStorage': torch.int64,
+    'IntStorage': torch.int32,
+    'ShortStorage': torch.int16,
+    'CharStorage': torch.int8,
+    'ByteStorage': torch.uint8,
+    'BoolStorage': torch.bool,
+}
+_ZIP_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+
+
+def _rebuild_tensor_mmap(storage, storage_offset, size, stride, requires_grad=False, *args):
+    t = storage.as_strided(size, stride, storage_offset)
+    if requires_grad:
+        t.requires_grad_(True)
+    return t
+
+
+def _torch_zip_load_mmap(path):
+    """
+    Reads a torch.save() zip file without torch.load(): only the pickled
+    structure is read, every tensor is a view of a copy-on-write memory map of
+    its record in the file. Records are stored uncompressed by torch.
+    Raises _UnsupportedZipCheckpoint for anything unusual (e.g. quantized or
+    sparse tensors, compressed records), the caller falls back to torch.load()
+    """
+    buffer = None
+    with zipfile.ZipFile(path) as zf:
+        pkl_names = [n for n in zf.namelist() if n.endswith('/data.pkl')]
+        if len(pkl_names) != 1:
+            raise _UnsupportedZipCheckpoint(path)
+        prefix = pkl_names[0][:-len('data.pkl')]
+        infos = {info.filename: info for info in zf.infolist()}
+        storages = {}
+
+        def _storage(key, dtype, numel):
+            info = infos.get(f'{prefix}data/{key}')
+            if info is None or info.compress_type != zipfile.ZIP_STORED:
+                raise _UnsupportedZipCheckpoint(path)
+            header = _ZIP_LOCAL_HEADER.unpack(
+                buffer[info.header_offset:info.header_offset + _ZIP_LOCAL_HEADER.size].tobytes()
+            )
+            start = info.header_offset + _ZIP_LOCAL_HEADER.size + header[9] + header[10]
+            np_dtype = _numpy_dtype(dtype)
+            array = buffer[start:start + numel * np_dtype.itemsize]
+            if start % np_dtype.itemsize:
+                array = array.copy()  # misaligned, never happens with torch >= 1.6
+            t = torch.from_numpy(array.view(np_dtype))
+            if dtype == torch.bfloat16:
+                t = t.view(torch.bfloat16)
+            return t
+
+        class _Unpickler(pickle.Unpickler):
+            def find_class(self, module, name):
+                if module == 'torch._utils' and name == '_rebuild_tensor_v2':
+                    return _rebuild_tensor_mmap
+                if module == 'torch' and name.endswith('Storage'):
+                    if name not in _STORAGE_DTYPES:
+                        raise _UnsupportedZipCheckpoint(path)
+                    return name
+                if module == 'torch._utils' and name.startswith('_rebuild') \
+                        and name != '_rebuild_parameter':
+                    raise _UnsupportedZipCheckpoint(path)
+                return super().find_class(module, name)
+
+            def persistent_load(self, pid):
+                if pid[0] != 'storage' or not isinstance(pid[1], str):
+                    raise _UnsupportedZipCheckpoint(path)
+                storage_type, key, _, numel = pid[1:5]
+                if key not in storages:
+                    storages[key] = _storage(key, _STORAGE_DTYPES[storage_type], numel)
+                return storages[key]
+
+        if os.path.getsize(path) > 0:
+            buffer = np.memmap(path, dtype=np.uint8, mode='c')
+        with zf.open(pkl_names[0]) as f:
+            return _Unpickler(f).load()
+
+
+# keys needed to run a model, see `load_checkpoint(state_dict_only=True)`
+STATE_DICT_KEYS = ['state_dict', 'epoch', 'global_step', 'hparams', 'hparams_type']
+
+
+def _select_state_dict(checkpoint):
+    return {k: checkpoint[k] for k in STATE_DICT_KEYS if k in checkpoint}
+
+
+def snapshot_to_host(obj, buffers: Optional[Dict] = None, pin_memory=False):
+    """
+    Recursively copies a (nested) checkpoint to host memory, so that training
+    can keep mutating the original tensors while the snapshot is serialized.
+
+    Args:
+        obj: nested dict/list/tuple of tensors and python objects
+        buffers: host buffers returned by a previous call, reused in place
+            when a tensor at the same position has the same shape and dtype
+        pin_memory: allocate new host buffers for CUDA tensors in pinned
+            memory, device-to-host copies are then non-blocking
+    Returns:
+        (snapshot, buffers)
+    """
+    if buffers is None:
+        buffers = {}
+    has_cuda = [False]
+
+    def _copy_tensor(path, t):
+        t = t.detach()
+        buf = buffers.get(path)
+        if buf is None or buf.shape != t.shape or buf.dtype != t.dtype:
+            buf = torch.empty(t.shape, dtype=t.dtype, device='cpu')
+            if pin_memory and t.is_cuda:
+                buf = buf.pin_memory()
+            buffers[path] = buf
+        if t.is_cuda:
+            has_cuda[0] = True
+            buf.copy_(t, non_blocking=buf.is_pinned())
+        else:
+            buf.copy_(t)
+        return buf
+
+    def _snapshot(path, x):
+        if torch.is_tensor(x):
+            return _copy_tensor(path, x)
+        elif isinstance(x, dict):
+            return type(x)((k, _snapshot(path + (k,), v)) for k, v in x.items())
+        elif isinstance(x, (list, tuple)) and not hasattr(x, '_fields'):
+            return type(x)(_snapshot(path + (i,), v) for i, v in enumerate(x))
+        else:
+            # python objects may be mutated later by the training loop
+            return copy.deepcopy(x)
+
+    snapshot = _snapshot((), obj)
+    if has_cuda[0]:
+        torch.cuda.synchronize()
+    return snapshot, buffers
+
+
+class AsyncCheckpointWriter:
+    """
+    Serializes and writes checkpoints in a background thread.
+
+    - `save()` snapshots the checkpoint to host memory (optionally into reused
+      pinned buffers) and returns, training continues while the file is written
+    - all jobs run in FIFO order in a single thread, so a copy or delete
+      submitted after a save sees the finished file
+    - at most `max_pending` saves are in flight, `save()` blocks otherwise
+    - `flush()` waits for all jobs and re-raises the first error.
+      It is also registered to run at interpreter exit
+
+    Not picklable, create it lazily in the process that uses it.
+    """
+    def __init__(self,
+                 max_pending: int = 1,
+                 pin_memory: bool = True,
+                 save_function: Callable[[Any, str], None] = atomic_torch_save):
+        assert max_pending >= 1
+        self.max_pending = max_pending
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._save_function = save_function
+        self._slots = threading.Semaphore(max_pending)
+        # one set of host buffers per in-flight save
+        self._free_buffers = [None] * max_pending
+        self._buffers_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._worker, name='AsyncCheckpointWriter', daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args, kwargs = job
+                fn(*args, **kwargs)
+            except BaseException as e:
+                if self._error is None:
+                    self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('async checkpoint write failed') from error
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Run any function (e.g. a file copy) in the writer thread, after all
+        previously submitted jobs
+        """
+        self._check_error()
+        self._queue.put((fn, args, kwargs))
+
+    def save(self, checkpoint, filepath):
+        # raise a previous error before taking a slot
+        self._check_error()
+        self._slots.acquire()
+        with self._buffers_lock:
+            buffers = self._free_buffers.pop()
+        try:
+            snapshot, buffers = snapshot_to_host(
+                checkpoint, buffers=buffers, pin_memory=self.pin_memory
+            )
+
+            def _write():
+                try:
+                    self._save_function(snapshot, filepath)
+                finally:
+                    self._release(buffers)
+
+            self.submit(_write)
+        except BaseException:
+            # the job never runs, give back the slot and the buffers
+            self._release(buffers)
+            raise
+
+    def _release(self, buffers):
+        with self._buffers_lock:
+            self._free_buffers.append(buffers)
+        self._slots.release()
+
+    @property
+    def num_pending(self):
+        return self._queue.unfinished_tasks
+
+    def flush(self):
+        if self._thread.is_alive():
+            self._queue.join()
+        self._check_error()
+
+    def close(self):
+        self.flush()
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        atexit.unregister(self.flush)
+
+
+def _path_size(path):
+    if os.path.isdir(path):
+        return sum(
+            os.path.getsize(os.path.join(root, f))
+            for root, _, files in os.walk(path) for f in files
+        )
+    return os.path.getsize(path)
+
+
+class CheckpointManifest:
+    """
+    JSON index of all checkpoints in a directory (`manifest.json`), so that
+    versioning, top-k eviction, resume lookup and integrity checks do not need
+    to probe or scan the filesystem (slow on network filesystems).
+
+    Entries are keyed by path relative to the directory:
+        {'kind': 'best' | 'periodic' | 'last' | ..., 'epoch': 5, 'step': 1200,
+         'monitor': 'val/loss', 'value': 0.31, 'size': 1234, 'checksum': '89abcdef',
+         'time': 1590000000.0}
+
+    The manifest is rewritten atomically on every change. If it does not exist
+    yet, existing *.ckpt files are imported once with a directory scan.
+    Thread-safe, so it can be updated from the async writer thread.
+    """
+    FILENAME = 'manifest.json'
+
+    def __init__(self, ckpt_dir, checksum=False,
+                 parse_filename: Optional[Callable[[str], Optional[Dict[str, Any]]]] = None):
+        """
+        Args:
+            checksum: opt-in, compute CRC32 of every new file for integrity
+                checks. Costs a full extra read of the file when it is added
+                and again by verify(). Sizes are always checked
+            parse_filename: recovers entry fields (kind, epoch, monitor, value)
+                from the path relative to `ckpt_dir` when importing checkpoints
+                written before the manifest existed, None if it does not match
+        """
+        self.ckpt_dir = f_expand(ckpt_dir)
+        self.path = os.path.join(self.ckpt_dir, self.FILENAME)
+        self.checksum = checksum
+        self.parse_filename = parse_filename
+        self._lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)['checkpoints']
+        elif os.path.isdir(self.ckpt_dir):
+            self._import_existing()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _import_existing(self):
+        for root, dirs, files in os.walk(self.ckpt_dir):
+            for name in dirs + files:
+                if name.endswith('.ckpt'):
+                    path = os.path.join(root, name)
+                    relpath = self.relpath(path)
+                    entry = {
+                        'kind': 'unknown', 'epoch': None, 'step': None,
+                        'monitor': None, 'value': None,
+                        'size': _path_size(path), 'checksum': None,
+                        'time': os.path.getmtime(path)
+                    }
+                    if self.parse_filename is not None:
+                        entry.update(self.parse_filename(relpath) or {})
+                    self.entries[relpath] = entry
+            # sharded checkpoints are directories, don't descend
+            # skip hidden dirs like the dedup blob store
+            dirs[:] = [d for d in dirs if not d.endswith('.ckpt') and not d.startswith('.')]
+        if self.entries:
+            self._save()
+
+    def _save(self):
+        os.makedirs(self.ckpt_dir, exist_ok=True)
+        with f_atomic_open(self.path, 'w') as f:
+            json.dump({'version': 1, 'checkpoints': self.entries}, f, indent=2, sort_keys=True)
+
+    def relpath(self, path):
+        return os.path.relpath(f_expand(path), self.ckpt_dir)
+
+    def abspath(self, relpath):
+        return os.path.join(self.ckpt_dir, relpath)
+
+    def __contains__(self, path):
+        return self.relpath(path) in self.entries
+
+    def get(self, path) -> Optional[Dict[str, Any]]:
+        return self.entries.get(self.relpath(path))
+
+    def add(self, path, kind, *, epoch=None, step=None, monitor=None, value=None,
+            checksum: Optional[bool] = None, **extra):
+        """
+        Record a newly written checkpoint. Call after the file is complete
+
+        Args:
+            checksum: override the `checksum` setting of the manifest,
+                e.g. False to save time before preemption
+        """
+        if checksum is None:
+            checksum = self.checksum
+        entry = {
+            'kind': kind, 'epoch': epoch, 'step': step,
+            'monitor': monitor, 'value': None if value is None else float(value),
+            'size': _path_size(path),
+            'checksum': crc32_checksum(path) if checksum and os.path.isfile(path) else None,
+            'time': time.time(),
+        }
+        entry.update(extra)
+        with self._lock:
+            self.entries[self.relpath(path)] = entry
+            self._save()
+        return entry
+
+    def add_alias(self, src, dst, kind, **fields):
+        """
+        Record `dst` as a copy or link of `src`, without re-reading the file
+
+        Args:
+            fields: override entry fields of `dst`, e.g. `monitor` and `value`
+                of a best checkpoint linked by several monitored metrics
+        """
+        with self._lock:
+            entry = dict(self.entries.get(self.relpath(src), {}))
+            if not entry:
+                entry = {'size': _path_size(dst), 'checksum': None}
+            entry['kind'] = kind
+            entry['time'] = time.time()
+            entry.update(fields)
+            self.entries[self.relpath(dst)] = entry
+            self._save()
+        return entry
+
+    def remove(self, path):
+        with self._lock:
+            if self.entries.pop(self.relpath(path), None) is not None:
+                self._save()
+
+    def find(self, kind=None, monitor=None) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns:
+            {abspath: entry} matching `kind` and `monitor`
+        """
+        return {
+            self.abspath(rel): entry for rel, entry in self.entries.items()
+            if (kind is None or entry.get('kind') == kind)
+            and (monitor is None or entry.get('monitor') == monitor)
+        }
+
+    def last(self) -> Optional[str]:
+        """
+        Returns:
+            abspath of `last.ckpt`, or of the most recently written checkpoint
+        """
+        if 'last.ckpt' in self.entries:
+            return self.abspath('last.ckpt')
+        if not self.entries:
+            return None
+        rel = max(self.entries, key=lambda k: self.entries[k].get('time') or 0)
+        return self.abspath(rel)
+
+    def best(self, monitor, mode) -> Optional[str]:
+        """
+        Returns:
+            abspath of the best checkpoint for `monitor`, mode is 'min' or 'max'
+        """
+        assert mode in ['min', 'max']
+        candidates = {
+            path: entry['value'] for path, entry in self.find('best', monitor).items()
+            if entry.get('value') is not None
+        }
+        if not candidates:
+            return None
+        _op = min if mode == 'min' else max
+        return _op(candidates, key=candidates.get)
+
+    def verify(self, path) -> bool:
+        """
+        Integrity check against the recorded size and checksum.
+        Files not in the manifest are only checked for existence.
+        """
+        path = f_expand(path)
+        if not os.path.exists(path):
+            return False
+        entry = self.get(path)
+        if entry is None:
+            return True
+        if entry.get('size') is not None and _path_size(path) != entry['size']:
+            return False
+        if entry.get('checksum') and os.path.isfile(path):
+            return crc32_checksum(path) == entry['checksum']
+        return True
+
+
+# ==================== sharded checkpoints ====================
+SHARD_META_FILE = 'meta.pt'
+
+
+def _shard_file(rank, world_size):
+    return f'shard-{rank:05d}-of-{world_size:05d}.pt'
+
+
+def _iter_tensors(obj, path=()):
+    """
+    Yields (path, tensor) for all tensors in a nested dict/list/tuple
+    """
+    if torch.is_tensor(obj):
+        yield path, obj
+    elif isinstance(obj, dict):
+        for k, v in obj.items():
+            yield from _iter_tensors(v, path + (k,))
+    elif isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        for i, v in enumerate(obj):
+            yield from _iter_tensors(v, path + (i,))
+
+
+def _map_leaves(obj, fn, path=()):
+    """
+    Rebuilds a nested dict/list/tuple with every leaf replaced by fn(path, leaf)
+    """
+    if isinstance(obj, dict):
+        return type(obj)((k, _map_leaves(v, fn, path + (k,))) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return type(obj)(_map_leaves(v, fn, path + (i,)) for i, v in enumerate(obj))
+    return fn(path, obj)
+
+
+class TensorRef:
+    """
+    Placeholder of a tensor stored in a shard, see save_sharded_checkpoint()
+    """
+    def __init__(self, path, shape, dtype, owner):
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+        self.owner = owner
+
+    def __repr__(self):
+        return f'TensorRef({self.path}, shape={self.shape}, dtype={self.dtype}, owner={self.owner})'
+
+
+def _nbytes(t):
+    return t.numel() * t.element_size()
+
+
+def plan_shards(checkpoint, world_size) -> Dict[tuple, int]:
+    """
+    Greedy balanced partition: the largest tensors first, each to the rank
+    with the fewest bytes so far.
+
+    Returns:
+        {tensor path: owner rank}
+    """
+    tensors = sorted(
+        _iter_tensors(checkpoint), key=lambda pt: (-_nbytes(pt[1]), repr(pt[0]))
+    )
+    loads = [(0, rank) for rank in range(world_size)]
+    plan = {}
+    for path, t in tensors:
+        load, rank = heapq.heappop(loads)
+        plan[path] = rank
+        heapq.heappush(loads, (load + _nbytes(t), rank))
+    return plan
+
+
+def _get_rank_world_size(group=None):
+    if dist.is_initialized():
+        return dist.get_rank(group), dist.get_world_size(group)
+    return 0, 1
+
+
+def is_sharded_checkpoint(path):
+    return os.path.isfile(os.path.join(f_expand(path), SHARD_META_FILE))
+
+
+def save_sharded_checkpoint(checkpoint, dirpath, group=None):
+    """
+    Collective: every rank of `group` must call it with its own copy of the
+    (replicated) checkpoint. Tensors are partitioned across ranks by size and
+    each rank writes only its shard in parallel, rank 0 also writes
+    `meta.pt` with the non-tensor state and the shard layout.
+
+    Shards are written to `{dirpath}.partial` and the directory is swapped in
+    with f_swap_dir() once all ranks are done, an interrupted save never
+    replaces `dirpath` with partial shards. A crash during the swap itself
+    leaves the previous version in `{dirpath}.old`, load_checkpoint() and
+    resume move it back.
+
+    Layout:
+        dirpath/meta.pt
+        dirpath/shard-00000-of-00004.pt
+        ...
+    """
+    dirpath = f_expand(dirpath)
+    rank, world_size = _get_rank_world_size(group)
+    is_distributed = world_size > 1
+    partial_dir = dirpath + '.partial'
+
+    plan = None
+    if rank == 0:
+        plan = plan_shards(checkpoint, world_size)
+        f_remove(partial_dir)
+        os.makedirs(partial_dir)
+    if is_distributed:
+        plan = dist.broadcast_object(plan, src=0, group=group)
+
+    shard = {
+        path: t.detach().cpu() for path, t in _iter_tensors(checkpoint)
+        if plan.get(path) == rank
+    }
+    atomic_torch_save(shard, os.path.join(partial_dir, _shard_file(rank, world_size)))
+    del shard
+    if is_distributed:
+        dist.barrier(group)
+
+    if rank == 0:
+        def _to_ref(path, x):
+            if torch.is_tensor(x):
+                return TensorRef(path, tuple(x.shape), x.dtype, plan[path])
+            return x
+
+        meta = {
+            'version': 1,
+            'world_size': world_size,
+            'checkpoint': _map_leaves(checkpoint, _to_ref),
+        }
+        atomic_torch_save(meta, os.path.join(partial_dir, SHARD_META_FILE))
+        f_swap_dir(partial_dir, dirpath)
+    if is_distributed:
+        dist.barrier(group)
+
+
+def load_sharded_checkpoint(dirpath, map_location=None, state_dict_only=False,
+                            group=None, collective=True):
+    """
+    If the current world size matches the one at save time, every rank reads
+    only its own shard and the remaining tensors are broadcast from their
+    owners. Otherwise (e.g. a single process), all shards are read locally.
+    Shards are memory-mapped when supported.
+
+    Args:
+        map_location: device to move the tensors to, None to keep them on CPU
+        state_dict_only: skip optimizer and other training state
+        collective: False to read every shard in this process even if the
+            process group is initialized, e.g. when called on rank 0 only
+    Returns:
+        the full checkpoint dict on every rank
+    """
+    dirpath = f_expand(dirpath)
+    meta = torch_load(os.path.join(dirpath, SHARD_META_FILE))
+    if state_dict_only:
+        meta['checkpoint'] = _select_state_dict(meta['checkpoint'])
+    saved_world_size = meta['world_size']
+    rank, world_size = _get_rank_world_size(group)
+    refs = []
+
+    def _collect(path, x):
+        if isinstance(x, TensorRef):
+            refs.append(x)
+        return x
+
+    _map_leaves(meta['checkpoint'], _collect)
+
+    tensors = {}
+    if collective and world_size > 1 and world_size == saved_world_size:
+        tensors.update(torch_load_mmap(os.path.join(dirpath, _shard_file(rank, world_size))))
+        works = []
+        for ref in refs:
+            if ref.owner != rank:
+                tensors[ref.path] = torch.empty(ref.shape, dtype=ref.dtype)
+            else:
+                # the collective sends the raw memory, receivers are contiguous
+                tensors[ref.path] = tensors[ref.path].contiguous()
+            works.append(dist.broadcast_(
+                tensors[ref.path], src=ref.owner, group=group, async_op=True
+            ))
+        for work in works:
+            work.wait()
+    else:
+        for r in range(saved_world_size):
+            tensors.update(torch_load_mmap(os.path.join(dirpath, _shard_file(r, saved_world_size))))
+
+    def _fill(path, x):
+        if isinstance(x, TensorRef):
+            t = tensors.pop(x.path)
+            return t if map_location is None else t.to(map_location)
+        return x
+
+    return _map_leaves(meta['checkpoint'], _fill)
+
+
+# ==================== deduplicated checkpoints ====================
+DEDUP_MAGIC = b'OMLTDDP1'
+BLOB_DIR = '.blobs'
+
+
+def checkpoint_format(path) -> str:
+    """
+    Returns:
+        'sharded', 'dedup', 'compressed', 'weights' or 'torch',
+        without reading the whole file
+    """
+    path = f_expand(path)
+    if os.path.isdir(path):
+        assert is_sharded_checkpoint(path), f'{path} is not a checkpoint'
+        return 'sharded'
+    with open(path, 'rb') as f:
+        magic = f.read(len(DEDUP_MAGIC))
+    if magic == DEDUP_MAGIC:
+        return 'dedup'
+    elif magic == COMPRESSED_MAGIC:
+        return 'compressed'
+    elif magic == WEIGHTS_MAGIC:
+        return 'weights'
+    return 'torch'
+
+
+def _tensor_to_numpy(t):
+    t = t.detach().cpu().contiguous()
+    if t.dtype == torch.bfloat16:
+        # numpy has no bfloat16, same bits as int16
+        t = t.view(torch.int16)
+    return t.numpy()
+
+
+def _numpy_dtype(dtype):
+    if dtype == torch.bfloat16:
+        dtype = torch.int16
+    return torch.empty(0, dtype=dtype).numpy().dtype
+
+
+class BlobRef:
+    """
+    Placeholder of a tensor stored as a content-addressed blob, see DedupCheckpointStore
+    """
+    def __init__(self, key, shape, dtype):
+        self.key = key
+        self.shape = shape
+        self.dtype = dtype
+
+    def __repr__(self):
+        return f'BlobRef({self.key}, shape={self.shape}, dtype={self.dtype})'
+
+
+class DedupCheckpointStore:
+    """
+    Content-addressed checkpoint storage. Every tensor is hashed and stored once
+    as a raw blob under `{root}/.blobs/`, a checkpoint file only holds the
+    non-tensor state and references to the blobs. Identical tensors (e.g. a
+    frozen backbone, see `freeze_params`) are written once across checkpoints.
+
+    Blobs are reference counted per checkpoint path in `.blobs/refs.json` and
+    deleted when the last checkpoint referencing them is released.
+    New blobs are fsynced in one batch before the checkpoint file referencing
+    them is committed, so a complete checkpoint never points to a truncated blob.
+
+    Thread-safe, can run in the async writer thread.
+    """
+    def __init__(self, root):
+        self.root = f_expand(root)
+        self.blob_dir = os.path.join(self.root, BLOB_DIR)
+        self.refs_path = os.path.join(self.blob_dir, 'refs.json')
+        self._lock = threading.Lock()
+        self.refs: Dict[str, List[str]] = {}
+        if os.path.exists(self.refs_path):
+            with open(self.refs_path, 'r') as f:
+                self.refs = json.load(f)
+        self._counts = collections.Counter(
+            key for keys in self.refs.values() for key in keys
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _relpath(self, path):
+        return os.path.relpath(f_expand(path), self.root)
+
+    def blob_path(self, key):
+        return os.path.join(self.blob_dir, key[:2], key)
+
+    def _save_refs(self):
+        os.makedirs(self.blob_dir, exist_ok=True)
+        with f_atomic_open(self.refs_path, 'w') as f:
+            json.dump(self.refs, f)
+
+    def _put_blob(self, array, new_blobs) -> str:
+        data = memoryview(array.reshape(-1)).cast('B')
+        key = hashlib.blake2b(data, digest_size=20).hexdigest()
+        blob_path = self.blob_path(key)
+        with self._lock:
+            # an unreferenced blob may be left by a crash before its fsync
+            is_committed = self._counts[key] > 0 and os.path.exists(blob_path)
+        if not is_committed and blob_path not in new_blobs:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # fsync later in one batch, see _fsync_blobs()
+            with f_atomic_open(blob_path, 'wb', fsync=False) as f:
+                f.write(data)
+            new_blobs.add(blob_path)
+        return key
+
+    def _fsync_blobs(self, blob_paths):
+        for blob_path in blob_paths:
+            with open(blob_path, 'rb') as f:
+                os.fsync(f.fileno())
+        for dirpath in set(os.path.dirname(p) for p in blob_paths):
+            f_fsync_dir(dirpath)
+        if blob_paths:
+            f_fsync_dir(self.blob_dir)
+
+    def save(self, checkpoint, filepath):
+        """
+        Writes the new blobs of `checkpoint`, then the small checkpoint file.
+        Blobs only referenced by a previous checkpoint at `filepath` are released.
+        """
+        keys = []
+        new_blobs = set()
+
+        def _to_ref(path, x):
+            if torch.is_tensor(x):
+                key = self._put_blob(_tensor_to_numpy(x), new_blobs)
+                keys.append(key)
+                return BlobRef(key, tuple(x.shape), x.dtype)
+            return x
+
+        skeleton = _map_leaves(checkpoint, _to_ref)
+        # blobs must be durable before the checkpoint that references them
+        self._fsync_blobs(new_blobs)
+        filepath = f_expand(filepath)
+        with f_atomic_open(filepath, 'wb') as f:
+            f.write(DEDUP_MAGIC)
+            torch.save({'version': 1, 'checkpoint': skeleton}, f)
+        self._set_refs(filepath, keys)
+
+    def alias(self, src, dst):
+        """
+        `dst` is a copy or link of the checkpoint file `src`
+        """
+        with self._lock:
+            keys = list(self.refs.get(self._relpath(src), []))
+        self._set_refs(dst, keys)
+
+    def release(self, filepath):
+        """
+        Call after the checkpoint file is deleted
+        """
+        self._set_refs(filepath, [])
+
+    def _set_refs(self, filepath, keys):
+        rel = self._relpath(filepath)
+        with self._lock:
+            old_keys = self.refs.pop(rel, [])
+            if keys:
+                self.refs[rel] = keys
+            self._counts.update(keys)
+            self._counts.subtract(old_keys)
+            dead = [k for k in set(old_keys) if self._counts[k] <= 0]
+            for key in dead:
+                del self._counts[key]
+            self._save_refs()
+            for key in dead:
+                f_remove(self.blob_path(key))
+
+    def gc(self):
+        """
+        Deletes blobs not referenced by any checkpoint, e.g. left by a crash
+        between writing the blobs and the checkpoint file
+
+        Returns:
+            number of blobs deleted
+        """
+        cnt = 0
+        with self._lock:
+            for root, _, files in os.walk(self.blob_dir):
+                for name in files:
+                    if root != self.blob_dir and self._counts[name] <= 0:
+                        os.remove(os.path.join(root, name))
+                        cnt += 1
+        return cnt
+
+
+def load_dedup_checkpoint(filepath, map_location=None, state_dict_only=False, mmap=True):
+    """
+    Args:
+        map_location: device to move the tensors to, None to keep them on CPU
+        state_dict_only: skip optimizer and other training state
+        mmap: memory-map the blobs (copy-on-write), pages are read lazily
+    """
+    filepath = f_expand(filepath)
+    with open(filepath, 'rb') as f:
+        assert f.read(len(DEDUP_MAGIC)) == DEDUP_MAGIC, f'{filepath} is not a dedup checkpoint'
+        meta = torch_load(io.BytesIO(f.read()))
+    if state_dict_only:
+        meta['checkpoint'] = _select_state_dict(meta['checkpoint'])
+    # nearest `.blobs` in the parent dirs, the checkpoint dir can be moved
+    # and the file can be linked to a different sub-folder
+    blob_dir = os.path.dirname(filepath)
+    while not os.path.isdir(os.path.join(blob_dir, BLOB_DIR)):
+        parent = os.path.dirname(blob_dir)
+        assert parent != blob_dir, f'{BLOB_DIR} dir not found for {filepath}'
+        blob_dir = parent
+    blob_dir = os.path.join(blob_dir, BLOB_DIR)
+
+    def _load_blob(path, x):
+        if isinstance(x, BlobRef):
+            blob_path = os.path.join(blob_dir, x.key[:2], x.key)
+            np_dtype = _numpy_dtype(x.dtype)
+            if mmap and os.path.getsize(blob_path) > 0:
+                array = np.memmap(blob_path, dtype=np_dtype, mode='c')
+            else:
+                array = np.fromfile(blob_path, dtype=np_dtype)
+            t = torch.from_numpy(array)
+            if x.dtype == torch.bfloat16:
+                t = t.view(torch.bfloat16)
+            t = t.reshape(x.shape)
+            return t if map_location is None else t.to(map_location)
+        return x
+
+    return _map_leaves(meta['checkpoint'], _load_blob)
+
+
+# ==================== compressed checkpoints ====================
+COMPRESSED_MAGIC = b'OMLTZIP1'
+_COMPRESSED_FOOTER = struct.Struct('<Q8s')  # header length, magic
+
+COMPRESSION_CODECS = {
+    # name: (compress(data, level), decompress(data), default level)
+    'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress, 1),
+    'bz2': (lambda data, level: bz2.compress(data, level), bz2.decompress, 1),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 0),
+}
+
+
+class ChunkedTensorRef:
+    """
+    Placeholder of a tensor stored as compressed chunks, see save_compressed_checkpoint()
+
+    chunks: list of (file offset, stored length, raw length, is_compressed)
+    """
+    def __init__(self, shape, dtype, shuffled, chunks):
+        self.shape = shape
+        self.dtype = dtype
+        self.shuffled = shuffled
+        self.chunks = chunks
+
+    def __repr__(self):
+        return f'ChunkedTensorRef(shape={self.shape}, dtype={self.dtype}, chunks={len(self.chunks)})'
+
+
+def _shuffle_bytes(data, itemsize):
+    """
+    Groups the i-th byte of all elements together (like blosc shuffle),
+    exponents and high mantissa bits of floats then compress much better
+    """
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, itemsize).T.tobytes()
+
+
+def _unshuffle_bytes(data, itemsize):
+    return np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1).T.tobytes()
+
+
+def save_compressed_checkpoint(checkpoint, filepath, codec='zlib', level=None,
+                               chunk_size=4 * 2 ** 20, shuffle=True,
+                               num_threads=None, fsync=True):
+    """
+    Compresses every tensor in chunks of `chunk_size` bytes on a thread pool
+    (the standard library codecs release the GIL), chunks are written in
+    order as soon as they are ready. Chunks that do not shrink are stored raw.
+
+    Layout: magic | chunks ... | header (torch.save of the non-tensor state
+        and chunk offsets) | header length | magic
+
+    Args:
+        codec: 'zlib', 'bz2' or 'lzma', see COMPRESSION_CODECS. Run
+            examples/benchmark_checkpoint_codecs.py for the speed/size trade-off
+        level: codec compression level, None for the fast default
+        shuffle: byte shuffle the elements before compression, 10-20% smaller
+            for float32 optimizer state
+        num_threads: None for os.cpu_count()
+    """
+    assert codec in COMPRESSION_CODECS, f'invalid codec: {codec}'
+    compress, _, default_level = COMPRESSION_CODECS[codec]
+    level = default_level if level is None else level
+
+    def _compress_chunk(data, itemsize):
+        if shuffle and itemsize > 1:
+            data = _shuffle_bytes(data, itemsize)
+        compressed = compress(data, level)
+        if len(compressed) < len(data):
+            return compressed, len(data), True
+        return data, len(data), False
+
+    def _iter_chunks():
+        for path, t in _iter_tensors(checkpoint):
+            array = _tensor_to_numpy(t)
+            itemsize = array.itemsize
+            refs[path] = ChunkedTensorRef(tuple(t.shape), t.dtype, shuffle and itemsize > 1, [])
+            data = memoryview(array.reshape(-1)).cast('B')
+            # whole elements per chunk so that they can be shuffled
+            step = max(chunk_size // itemsize, 1) * itemsize
+            for i in range(0, len(data), step):
+                yield path, data[i:i + step], itemsize
+
+    refs = {}
+    num_threads = num_threads or os.cpu_count()
+    with f_atomic_open(filepath, 'wb', fsync=fsync) as f, \
+            concurrent.futures.ThreadPoolExecutor(num_threads) as pool:
+        f.write(COMPRESSED_MAGIC)
+        offset = len(COMPRESSED_MAGIC)
+        # bounded window of chunks in flight, written in order
+        pending = collections.deque()
+
+        def _write_next():
+            nonlocal offset
+            path, future = pending.popleft()
+            stored, raw_len, is_compressed = future.result()
+            f.write(stored)
+            refs[path].chunks.append((offset, len(stored), raw_len, is_compressed))
+            offset += len(stored)
+
+        for path, data, itemsize in _iter_chunks():
+            pending.append((path, pool.submit(_compress_chunk, data, itemsize)))
+            if len(pending) >= 2 * num_threads:
+                _write_next()
+        while pending:
+            _write_next()
+
+        header = io.BytesIO()
+        torch.save({
+            'version': 1,
+            'codec': codec,
+            'checkpoint': _map_leaves(
+                checkpoint, lambda path, x: refs[path] if torch.is_tensor(x) else x
+            ),
+        }, header)
+        header = header.getvalue()
+        f.write(header)
+        f.write(_COMPRESSED_FOOTER.pack(len(header), COMPRESSED_MAGIC))
+
+
+def load_compressed_checkpoint(filepath, map_location=None, state_dict_only=False,
+                               num_threads=None):
+    """
+    Decompresses all chunks in parallel on a thread pool
+
+    Args:
+        map_location: device to move the tensors to, None to keep them on CPU
+        state_dict_only: skip optimizer and other training state, their
+            chunks are not read
+    """
+    filepath = f_expand(filepath)
+    with open(filepath, 'rb') as f:
+        assert f.read(len(COMPRESSED_MAGIC)) == COMPRESSED_MAGIC, \
+            f'{filepath} is not a compressed checkpoint'
+        f.seek(-_COMPRESSED_FOOTER.size, os.SEEK_END)
+        header_len, magic = _COMPRESSED_FOOTER.unpack(f.read(_COMPRESSED_FOOTER.size))
+        assert magic == COMPRESSED_MAGIC, f'{filepath} is truncated'
+        f.seek(-_COMPRESSED_FOOTER.size - header_len, os.SEEK_END)
+        meta = torch_load(io.BytesIO(f.read(header_len)))
+        if state_dict_only:
+            meta['checkpoint'] = _select_state_dict(meta['checkpoint'])
+        _, decompress, _ = COMPRESSION_CODECS[meta['codec']]
+        fd = f.fileno()
+
+        def _load_chunk(ref, out, out_offset, chunk):
+            offset, stored_len, raw_len, is_compressed = chunk
+            data = os.pread(fd, stored_len, offset)
+            if is_compressed:
+                data = decompress(data)
+            if ref.shuffled:
+                data = _unshuffle_bytes(data, out.itemsize)
+            out.reshape(-1).view(np.uint8)[out_offset:out_offset + raw_len] = \
+                np.frombuffer(data, dtype=np.uint8)
+
+        refs = []
+        _map_leaves(
+            meta['checkpoint'],
+            lambda path, x: refs.append(x) if isinstance(x, ChunkedTensorRef) else None
+        )
+        arrays = {}
+        with concurrent.futures.ThreadPoolExecutor(num_threads) as pool:
+            futures = []
+            for ref in refs:
+                out = np.empty(ref.shape, dtype=_numpy_dtype(ref.dtype))
+                arrays[id(ref)] = out
+                out_offset = 0
+                for chunk in ref.chunks:
+                    futures.append(pool.submit(_load_chunk, ref, out, out_offset, chunk))
+                    out_offset += chunk[2]
+            for future in futures:
+                future.result()
+
+    def _to_tensor(path, x):
+        if isinstance(x, ChunkedTensorRef):
+            t = torch.from_numpy(arrays.pop(id(x)))
+            if x.dtype == torch.bfloat16:
+                t = t.view(torch.bfloat16)
+            return t if map_location is None else t.to(map_location)
+        return x
+
+    return _map_leaves(meta['checkpoint'], _to_tensor)
+
+
+# ==================== inference weights ====================
+WEIGHTS_MAGIC = b'OMLTWTS1'
+_WEIGHTS_HEADER_LEN = struct.Struct('<Q')
+WEIGHTS_ALIGNMENT = 64
+
+WEIGHTS_DTYPES = {
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+    'fp32': torch.float32,
+}
+
+
+def _align(offset, alignment=WEIGHTS_ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def export_weights(checkpoint, output_path, dtype=None, fsync=True) -> int:
+    """
+    Writes only the model weights in a flat layout that load_weights() maps
+    into memory without copying. Optimizer, scheduler and metrics history are
+    dropped, and with `dtype` the floating point weights are cast on the fly,
+    one tensor at a time.
+
+    Layout: magic | header length | JSON header {name: dtype, shape, offset} |
+        padding | raw tensor bytes, each aligned to WEIGHTS_ALIGNMENT bytes
+
+    Args:
+        checkpoint: checkpoint path of any format read by load_checkpoint(),
+            a checkpoint dict, a state_dict or an nn.Module
+        dtype: 'fp16', 'bf16', 'fp32' or a torch dtype to cast floating point
+            weights to, None to keep them as is
+    Returns:
+        number of bytes written
+    """
+    if isinstance(checkpoint, (str, os.PathLike)):
+        # called on one rank, not a collective load of sharded checkpoints
+        checkpoint = load_checkpoint(
+            os.fspath(checkpoint), state_dict_only=True, collective=False
+        )
+    if isinstance(checkpoint, torch.nn.Module):
+        state_dict = checkpoint.state_dict()
+    elif 'state_dict' in checkpoint:
+        state_dict = checkpoint['state_dict']
+    else:
+        state_dict = checkpoint
+    if isinstance(dtype, str):
+        assert dtype in WEIGHTS_DTYPES, f'invalid dtype: {dtype}'
+        dtype = WEIGHTS_DTYPES[dtype]
+
+    def _cast(t):
+        if dtype is not None and t.is_floating_point():
+            return t.to(dtype)
+        return t
+
+    header = {}
+    offset = 0
+    for name, t in state_dict.items():
+        assert torch.is_tensor(t), f'{name} is not a tensor'
+        t_dtype = dtype if dtype is not None and t.is_floating_point() else t.dtype
+        nbytes = t.numel() * torch.empty(0, dtype=t_dtype).element_size()
+        header[name] = {
+            'dtype': str(t_dtype).replace('torch.', ''),
+            'shape': list(t.shape),
+            'offset': offset,
+        }
+        offset = _align(offset + nbytes)
+    header = json.dumps(header).encode('utf-8')
+
+    with f_atomic_open(output_path, 'wb', fsync=fsync) as f:
+        f.write(WEIGHTS_MAGIC)
+        f.write(_WEIGHTS_HEADER_LEN.pack(len(header)))
+        f.write(header)
+        pos = f.tell()
+        for t in state_dict.values():
+            f.write(b'\0' * (_align(pos) - pos))
+            array = _tensor_to_numpy(_cast(t))
+            f.write(memoryview(array.reshape(-1)).cast('B'))
+            pos = _align(pos) + array.nbytes
+    return pos
+
+
+def load_weights(path, map_location=None, mmap=True) -> Dict[str, torch.Tensor]:
+    """
+    Loads weights written by export_weights(). With mmap, the tensors are
+    views of one copy-on-write memory map of the file: nothing is read until
+    a tensor is accessed and nothing is copied on CPU.
+
+    Args:
+        map_location: device to move the tensors to, None to keep them on CPU
+    Returns:
+        state_dict
+    """
+    path = f_expand(path)
+    with open(path, 'rb') as f:
+        assert f.read(len(WEIGHTS_MAGIC)) == WEIGHTS_MAGIC, f'{path} is not a weights file'
+        header_len, = _WEIGHTS_HEADER_LEN.unpack(f.read(_WEIGHTS_HEADER_LEN.size))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    data_start = _align(len(WEIGHTS_MAGIC) + _WEIGHTS_HEADER_LEN.size + header_len)
+    if mmap and os.path.getsize(path) > data_start:
+        buffer = np.memmap(path, dtype=np.uint8, mode='c')
+    else:
+        buffer = np.fromfile(path, dtype=np.uint8)
+
+    state_dict = collections.OrderedDict()
+    for name, info in header.items():
+        t_dtype = getattr(torch, info['dtype'])
+        np_dtype = _numpy_dtype(t_dtype)
+        start = data_start + info['offset']
+        numel = int(np.prod(info['shape']))
+        array = buffer[start:start + numel * np_dtype.itemsize].view(np_dtype)
+        t = torch.from_numpy(array)
+        if t_dtype == torch.bfloat16:
+            t = t.view(torch.bfloat16)
+        t = t.reshape(info['shape'])
+        state_dict[name] = t if map_location is None else t.to(map_location)
+    return state_dict
+
+
+def load_checkpoint(path, map_location=None, state_dict_only=False, mmap=True,
+                    collective=True):
+    """
+    Loads any checkpoint format written by ExtendedCheckpoint
+
+    Args:
+        map_location: device for the tensors, None to keep them on CPU
+        state_dict_only: return only the model weights (and hparams),
+            optimizer state is never read from disk if the file is memory-mapped
+        mmap: memory-map the file when supported, tensors are paged in lazily
+            when accessed (e.g. copied into the model), host memory is not
+            doubled. Not the same as `torch.load(weights_only=...)`
+        collective: sharded checkpoints are loaded collectively by all ranks
+            when the process group is initialized, False to read every shard
+            in this process, see load_sharded_checkpoint()
+    """
+    # sharded dir left as `{path}.old` by a crash during save
+    f_recover_swap(path)
+    fmt = checkpoint_format(path)
+    if fmt == 'sharded':
+        return load_sharded_checkpoint(
+            path, map_location=map_location, state_dict_only=state_dict_only,
+            collective=collective
+        )
+    elif fmt == 'dedup':
+        return load_dedup_checkpoint(
+            path, map_location=map_location, state_dict_only=state_dict_only, mmap=mmap
+        )
+    elif fmt == 'compressed':
+        return load_compressed_checkpoint(
+            path, map_location=map_location, state_dict_only=state_dict_only
+        )
+    elif fmt == 'weights':
+        return {'state_dict': load_weights(path, map_location=map_location, mmap=mmap)}
+    if mmap:
+        checkpoint = torch_load_mmap(path, map_location=map_location or 'cpu')
+    else:
+        checkpoint = torch_load(f_expand(path), map_location=map_location or 'cpu')
+    if state_dict_only:
+        checkpoint = _select_state_dict(checkpoint)
+    return checkpoint
+
+
+# ==================== checkpoint averaging ====================
+def average_checkpoints(paths, output_path=None, mmap=True) -> Dict[str, Any]:
+    """
+    Averages the model weights of several checkpoints, e.g. the top-k best
+    checkpoints of a run (SWA-style). Checkpoints are streamed one at a time:
+    only the running sum and the current checkpoint are in memory. Memory-mapped
+    formats ('torch' zip files with any torch version, see torch_load_mmap(),
+    'dedup' and 'sharded') are paged in tensor by tensor and optimizer state is
+    never read, so peak memory is about one copy of the weights (the running
+    sum) plus reclaimable page cache.
+    Not a collective: every shard is read in this process, call it on one rank.
+    'compressed' and legacy (non-zip) torch files are read fully, one at a time.
+
+    Floating point tensors are summed in float32 (float64 stays float64) and
+    cast back to their dtype. Other tensors, e.g. BatchNorm `num_batches_tracked`,
+    are taken from the last checkpoint.
+
+    Args:
+        paths: checkpoints in any format read by load_checkpoint()
+        output_path: if not None, atomically saves a weights-only checkpoint
+            {'state_dict': averaged weights, 'averaged_checkpoints': paths}
+    Returns:
+        averaged state_dict
+    """
+    assert len(paths) > 0, 'no checkpoint to average'
+    total = None
+    dtypes = {}
+    for path in paths:
+        state_dict = load_checkpoint(
+            path, map_location='cpu', state_dict_only=True, mmap=mmap,
+            collective=False
+        )['state_dict']
+        if total is None:
+            total = collections.OrderedDict()
+            for name, value in state_dict.items():
+                if torch.is_tensor(value) and value.is_floating_point():
+                    dtypes[name] = value.dtype
+                    sum_dtype = torch.float64 if value.dtype == torch.float64 else torch.float32
+                    # copy, never accumulate into the memory-mapped file
+                    total[name] = value.to(sum_dtype, copy=True)
+                else:
+                    total[name] = value
+        else:
+            assert state_dict.keys() == total.keys(), \
+                f'{path} does not have the same parameters as {paths[0]}'
+            for name, value in state_dict.items():
+                if name in dtypes:
+                    total[name].add_(value)
+                else:
+                    total[name] = value
+        del state_dict
+    for name, dtype in dtypes.items():
+        total[name] = total[name].div_(len(paths)).to(dtype)
+
+    if output_path is not None:
+        atomic_torch_save({
+            'state_dict': total,
+            'averaged_checkpoints': [f_expand(path) for path in paths],
+        }, output_path)
+    return total
@@ -1,10 +1,12 @@
 import os
+import math
+import pickle
 import socket
 import torch
 import torch.distributed as _dist
 import torch.utils.data
 import torch.backends.cudnn as cudnn
-from typing import Union, Optional
+from typing import Union, Optional, Dict, List
 
 
 def optimize_cudnn():
@@ -20,6 +22,7 @@ def _get_group(group):
 
 get_rank = _dist.get_rank
 get_world_size = _dist.get_world_size
+is_initialized = _dist.is_initialized
 
 
 def is_master(group=None):
@@ -34,6 +37,27 @@ def current_device():
     return torch.cuda.current_device()
 
 
+def _get_comm_device(group=None, device=None):
+    """
+    NCCL only reduces CUDA tensors, other backends (gloo) work on CPU
+    """
+    if get_backend(group) == 'nccl':
+        if device is None:
+            device = torch.cuda.current_device()
+        return torch.device('cuda', device) if isinstance(device, int) else torch.device(device)
+    return torch.device('cpu')
+
+
+def comm_device(group=None, device=None) -> torch.device:
+    """
+    Device of the tensors that the backend of `group` can reduce
+
+    Args:
+        device: CUDA device for NCCL, defaults to torch.cuda.current_device()
+    """
+    return _get_comm_device(_get_group(group), device)
+
+
 def _get_reduce_op(op):
     OPS = {
         'sum': _dist.ReduceOp.SUM,
@@ -47,8 +71,67 @@ def _get_reduce_op(op):
     return OPS[op]
 
 
+class AsyncReduce:
+    """
+    Handle of a pending non-blocking reduction, returned by the reduce
+    functions in this module when `async_op=True`.
+
+    The collective runs in the background, `wait()` blocks until it finishes
+    and returns the same result as the blocking call would have. The result is
+    computed once and cached, so `wait()` can be called lazily and repeatedly,
+    e.g. every time the progress bar renders.
+
+    WARNING: the output tensor (or persistent storage) must not be reused by
+        another reduction before `wait()` returns.
+    """
+    def __init__(self, work, finalize):
+        """
+        Args:
+            work: torch.distributed Work or another AsyncReduce
+            finalize: no-arg function called after `work` completes,
+                its return value is the result of `wait()`
+        """
+        self._work = work
+        self._finalize = finalize
+        self._done = False
+        self._result = None
+
+    def is_completed(self) -> bool:
+        """
+        Non-blocking completion check
+        """
+        return self._done or self._work.is_completed()
+
+    def wait(self):
+        if not self._done:
+            self._work.wait()
+            self._result = self._finalize()
+            self._done = True
+            # release references to buffers
+            self._work = self._finalize = None
+        return self._result
+
+    def then(self, fn) -> 'AsyncReduce':
+        """
+        Returns a new handle whose result is `fn(self.wait())`
+        """
+        return AsyncReduce(self, lambda: fn(self.wait()))
+
+
+class CompletedWork:
+    """
+    Stand-in for an already finished collective, e.g. in single process mode
+    """
+    def is_completed(self):
+        return True
+
+    def wait(self):
+        return True
+
+
 def reduce(tensor, op='sum', group=None,
-           broadcast=True, out: Optional[torch.Tensor] = None) -> torch.Tensor:
+           broadcast=True, out: Optional[torch.Tensor] = None,
+           async_op=False) -> Union[torch.Tensor, AsyncReduce]:
     """
     Args:
         tensor
@@ -56,6 +139,8 @@ def reduce(tensor, op='sum', group=None,
         out:
             - if the same tensor as input, will mutate input
             - None: create a new tensor and leave the input unchanged
+        async_op: True to return an AsyncReduce handle immediately,
+            `handle.wait()` returns the output tensor
     """
     assert torch.is_tensor(tensor)
     if out is None:
@@ -65,12 +150,18 @@ def reduce(tensor, op='sum', group=None,
     group = _get_group(group)
     opcode = _get_reduce_op(op)
     if broadcast:
-        _dist.all_reduce(out, op=opcode, group=group)
+        work = _dist.all_reduce(out, op=opcode, group=group, async_op=async_op)
     else:
-        _dist.reduce(out, dst=0, op=opcode, group=group)
-    if op.lower() == 'mean' and (broadcast or is_master(group)):
-        out.div_(1. * _dist.get_world_size(group))
-    return out
+        work = _dist.reduce(out, dst=0, op=opcode, group=group, async_op=async_op)
+
+    def _finalize():
+        if op.lower() == 'mean' and (broadcast or is_master(group)):
+            out.div_(1. * _dist.get_world_size(group))
+        return out
+
+    if async_op:
+        return AsyncReduce(work, _finalize)
+    return _finalize()
 
 
 def all_reduce_(tensor, op='sum', group=None):
@@ -97,8 +188,55 @@ def master_reduce(tensor, op='sum', group=None):
     )
 
 
+def barrier(group=None):
+    _dist.barrier(group=_get_group(group))
+
+
+def broadcast_(tensor, src=0, group=None, async_op=False):
+    """
+    In-place broadcast from `src`. The tensor is moved to the communication
+    device of the backend (CUDA for NCCL) and back if needed.
+    """
+    group = _get_group(group)
+    comm_device = _get_comm_device(group)
+    buf = tensor if tensor.device == comm_device else tensor.to(comm_device)
+    work = _dist.broadcast(buf, src=src, group=group, async_op=async_op)
+
+    def _finalize():
+        if buf is not tensor:
+            tensor.copy_(buf)
+        return tensor
+
+    if async_op:
+        return AsyncReduce(work, _finalize)
+    return _finalize()
+
+
+def broadcast_object(obj=None, src=0, group=None):
+    """
+    Broadcast any picklable object from `src`, `obj` is ignored on other ranks
+    """
+    group = _get_group(group)
+    comm_device = _get_comm_device(group)
+    if get_rank(group) == src:
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        size = torch.tensor([len(data)], dtype=torch.long, device=comm_device)
+    else:
+        size = torch.zeros(1, dtype=torch.long, device=comm_device)
+    _dist.broadcast(size, src=src, group=group)
+    if get_rank(group) == src:
+        buf = torch.tensor(bytearray(data), dtype=torch.uint8, device=comm_device)
+    else:
+        buf = torch.empty(int(size.item()), dtype=torch.uint8, device=comm_device)
+    _dist.broadcast(buf, src=src, group=group)
+    if get_rank(group) == src:
+        return obj
+    return pickle.loads(buf.cpu().numpy().tobytes())
+
+
 def reduce_scalar(scalar, op='sum', *,
-                  broadcast=True, storage=None, group=None, device=None):
+                  broadcast=True, storage=None, group=None, device=None,
+                  async_op=False):
     """
     Args:
         scalar: single python float
@@ -107,8 +245,9 @@ def reduce_scalar(scalar, op='sum', *,
             a persistent CUDA tensor in advance to provide temporary storage
             if None, allocates new CUDA memory every time
         device: if None, defaults to torch.cuda.current_device()
+        async_op: True to return an AsyncReduce handle, see reduce()
     Returns:
-        python float
+        python float, or AsyncReduce whose `wait()` returns the float
     """
     scalar = float(scalar)
     group = _get_group(group)
@@ -126,12 +265,17 @@ def reduce_scalar(scalar, op='sum', *,
             assert storage.is_cuda
         storage[0] = scalar
         s = storage
+    if async_op:
+        return reduce(
+            s, op=op, group=group, broadcast=broadcast, out=s, async_op=True
+        ).then(lambda out: float(out[0]))
     reduce(s, op=op, group=group, broadcast=broadcast, out=s)
     return float(s[0])
 
 
 def reduce_scalars(scalars, op='sum', *,
-                   broadcast=True, storage=None, group=None, device=None):
+                   broadcast=True, storage=None, group=None, device=None,
+                   async_op=False):
     """
     Args:
         scalars: list, tuple or dict of python floats
@@ -140,14 +284,16 @@ def reduce_scalars(scalars, op='sum', *,
             a persistent CUDA tensor in advance to provide temporary storage
             if None, allocates new CUDA memory every time
         device: if None, defaults to torch.cuda.current_device()
+        async_op: True to return an AsyncReduce handle, see reduce()
     Returns:
-        list, tuple or dict of reduced floats
+        list, tuple or dict of reduced floats,
+        or AsyncReduce whose `wait()` returns them
     """
     if not isinstance(scalars, (tuple, list, dict)):
         # singleton falls back to reduce_scalar()
         return reduce_scalar(
             scalars, op=op, broadcast=broadcast, storage=storage,
-            group=group, device=device
+            group=group, device=device, async_op=async_op
         )
 
     group = _get_group(group)
@@ -176,12 +322,297 @@ def reduce_scalars(scalars, op='sum', *,
             assert storage.is_cuda
         storage[:numel] = values
         values = storage
+
+    def _unpack(values):
+        values = values[:numel].tolist()
+        if isinstance(scalars, dict):
+            return {k: values[idx_map[k]] for k in idx_map}
+        else:
+            return type(scalars)(values)
+
+    if async_op:
+        return reduce(
+            values, op=op, group=group, broadcast=broadcast, out=values,
+            async_op=True
+        ).then(_unpack)
     reduce(values, op=op, group=group, broadcast=broadcast, out=values)
+    return _unpack(values)
 
-    if isinstance(scalars, dict):
-        return {k: float(values[idx_map[k]]) for k in idx_map}
+
+class ReduceBuffer:
+    """
+    Persistent communication buffer for repeated scalar reductions.
+
+    Named scalars are packed into one preallocated tensor and reduced with a
+    single collective. Slots are grouped into named segments, each segment is
+    a contiguous view of the buffer that can be packed and reduced on its own.
+    The buffer is allocated once on first use and reused afterwards.
+
+    Example:
+        buf = ReduceBuffer({'train': ['loss', 'acc1'], 'val': ['loss']})
+        buf.pack('val', {'loss': 0.3})
+        buf.reduce('val', op='sum')
+        buf.unpack('val')  # {'loss': 1.2}
+    """
+    def __init__(self,
+                 segments: Dict[str, List[str]],
+                 dtype=torch.float64,
+                 group=None,
+                 device=None):
+        """
+        Args:
+            segments: segment name -> list of slot keys
+            dtype: float64 by default so that large sums stay exact
+            device: if None, defaults to torch.cuda.current_device() for NCCL
+                and CPU for other backends
+        """
+        self._layout = {}
+        offset = 0
+        for seg_name, keys in segments.items():
+            keys = list(keys)
+            assert len(set(keys)) == len(keys), f'duplicate keys in segment {seg_name}'
+            index = {k: i for i, k in enumerate(keys)}
+            self._layout[seg_name] = (offset, offset + len(keys), index)
+            offset += len(keys)
+        self.numel = offset
+        self.dtype = dtype
+        self.group = group
+        self.device = device
+        self._buffer = None
+
+    @property
+    def buffer(self) -> torch.Tensor:
+        if self._buffer is None:
+            self._buffer = torch.zeros(
+                self.numel, dtype=self.dtype,
+                device=_get_comm_device(_get_group(self.group), self.device)
+            )
+        return self._buffer
+
+    def keys(self, segment):
+        return list(self._layout[segment][2].keys())
+
+    def segment(self, segment) -> torch.Tensor:
+        start, end, _ = self._layout[segment]
+        return self.buffer[start:end]
+
+    def pack(self, segment, values: Dict[str, Union[float, torch.Tensor]]):
+        """
+        Write values into the segment slots. Tensor values are copied on
+        device, so packing CUDA tensors into a CUDA buffer does not sync.
+        Slots not present in `values` are set to zero.
+        """
+        view = self.segment(segment)
+        index = self._layout[segment][2]
+        if len(values) < len(index):
+            view.zero_()
+        for key, value in values.items():
+            if torch.is_tensor(value):
+                view[index[key]].copy_(value.detach().reshape(()))
+            else:
+                view[index[key]] = float(value)
+        return view
+
+    def reduce(self, segment, op='sum', broadcast=True, async_op=False) \
+            -> Union[torch.Tensor, AsyncReduce]:
+        """
+        In-place reduce of a single segment with one collective
+        """
+        view = self.segment(segment)
+        return reduce(
+            view, op=op, group=self.group, broadcast=broadcast, out=view,
+            async_op=async_op
+        )
+
+    def unpack(self, segment) -> Dict[str, float]:
+        """
+        Single device-to-host copy of the segment
+        """
+        values = self.segment(segment).tolist()
+        index = self._layout[segment][2]
+        return {k: values[i] for k, i in index.items()}
+
+
+def sum_count_keys(key):
+    """
+    ReduceBuffer slot keys used by reduce_sum_count() for a single pair
+    """
+    return f'{key}/sum', f'{key}/count'
+
+
+def reduce_sum_count(pairs, *,
+                     broadcast=True, storage: Optional[ReduceBuffer] = None,
+                     segment=None, group=None, device=None, async_op=False):
+    """
+    Reduces (sum, count) pairs across processes with a single packed collective.
+
+    Args:
+        pairs: list, tuple or dict of (sum, count), where sum can be a python
+            float or a scalar tensor (packed on device without host sync)
+        broadcast: True to use all_reduce, else master_reduce
+            (only master gets valid results)
+        storage: persistent ReduceBuffer whose `segment` contains the slots
+            `sum_count_keys(key)` for every key (index for list/tuple).
+            If None, allocates a temporary buffer
+        async_op: True to return an AsyncReduce handle, see reduce()
+    Returns:
+        list, tuple or dict of global (sum, count),
+        or AsyncReduce whose `wait()` returns them
+    """
+    is_dict = isinstance(pairs, dict)
+    items = list(pairs.items()) if is_dict else list(enumerate(pairs))
+    if storage is None:
+        segment = '_'
+        storage = ReduceBuffer(
+            {segment: [k for key, _ in items for k in sum_count_keys(key)]},
+            group=group, device=device
+        )
+    else:
+        assert segment is not None, 'must specify the storage segment'
+    packed = {}
+    for key, (_sum, count) in items:
+        sum_key, count_key = sum_count_keys(key)
+        packed[sum_key] = _sum
+        packed[count_key] = count
+    storage.pack(segment, packed)
+
+    def _unpack(_out):
+        reduced = storage.unpack(segment)
+        results = []
+        for key, _ in items:
+            sum_key, count_key = sum_count_keys(key)
+            results.append((key, (reduced[sum_key], reduced[count_key])))
+        if is_dict:
+            return dict(results)
+        else:
+            return type(pairs)(r for _, r in results)
+
+    if async_op:
+        return storage.reduce(
+            segment, op='sum', broadcast=broadcast, async_op=True
+        ).then(_unpack)
+    storage.reduce(segment, op='sum', broadcast=broadcast)
+    return _unpack(None)
+
+
+def reduce_meters(meters, *,
+                  broadcast=True, storage: Optional[ReduceBuffer] = None,
+                  segment=None, group=None, device=None, async_op=False):
+    """
+    Exact sample-weighted global averages of AverageMeters.
+    Each rank contributes its own (sum, size), so uneven batches or different
+    number of samples per rank are weighted correctly, unlike mean-of-means.
+
+    Args:
+        meters: list, tuple or dict of AverageMeter (TensorMeter sums are
+            packed on device without host sync)
+        see reduce_sum_count() for the other args
+    Returns:
+        list, tuple or dict of global averages (0. for empty meters),
+        or AsyncReduce whose `wait()` returns them
+    """
+    def _sum_count(meter):
+        _sum = meter.sum_tensor if hasattr(meter, 'sum_tensor') else meter.sum
+        return _sum, meter.size
+
+    if isinstance(meters, dict):
+        pairs = {k: _sum_count(m) for k, m in meters.items()}
     else:
-        return type(scalars)(float(v) for v in values[:numel])
+        pairs = [_sum_count(m) for m in meters]
+
+    def _avg(sum_count):
+        _sum, count = sum_count
+        return _sum / count if count > 0 else 0.
+
+    def _averages(reduced):
+        if isinstance(meters, dict):
+            return {k: _avg(v) for k, v in reduced.items()}
+        else:
+            return type(meters)(_avg(v) for v in reduced)
+
+    reduced = reduce_sum_count(
+        pairs, broadcast=broadcast, storage=storage, segment=segment,
+        group=group, device=device, async_op=async_op
+    )
+    if async_op:
+        return reduced.then(_averages)
+    return _averages(reduced)
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    Drop-in for RandomSampler / DistributedSampler whose position within an
+    epoch can be saved and restored, to resume a long epoch mid-way.
+
+    The permutation only depends on (seed, epoch). `set_start_index(n)` skips
+    the first n samples of this replica for the current epoch: the skipped
+    indices are never yielded, so the DataLoader never loads them.
+    Changing the epoch resets the start index.
+    """
+    def __init__(self, dataset, shuffle=True, seed=0,
+                 num_replicas=None, rank=None):
+        if num_replicas is None:
+            num_replicas = get_world_size() if is_initialized() else 1
+        if rank is None:
+            rank = get_rank() if is_initialized() else 0
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        # same padding as DistributedSampler, every replica gets num_samples
+        self.num_samples = int(math.ceil(len(dataset) / num_replicas))
+        self.total_size = self.num_samples * num_replicas
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.start_index = 0
+        self.epoch = epoch
+
+    def set_start_index(self, start_index):
+        assert 0 <= start_index <= self.num_samples
+        self.start_index = start_index
+
+    def _indices(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        while len(indices) < self.total_size:
+            indices += indices[:self.total_size - len(indices)]
+        return indices[self.rank:self.total_size:self.num_replicas]
+
+    def __iter__(self):
+        return iter(self._indices()[self.start_index:])
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+    def state_dict(self):
+        return {
+            'seed': self.seed,
+            'epoch': self.epoch,
+            'start_index': self.start_index,
+            'num_replicas': self.num_replicas,
+        }
+
+    def load_state_dict(self, state):
+        """
+        Returns:
+            False if the position cannot be restored (different number of
+            replicas), the epoch then starts from the beginning
+        """
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        if state['num_replicas'] != self.num_replicas:
+            self.start_index = 0
+            return False
+        self.set_start_index(min(state['start_index'], self.num_samples))
+        return True
 
 
 def random_free_tcp_port():
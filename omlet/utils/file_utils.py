@@ -8,9 +8,12 @@ import shutil
 import glob
 import pwd
 import codecs
+import zlib
 import hashlib
 import tarfile
 import fnmatch
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 from socket import gethostname
 
@@ -152,6 +155,180 @@ def f_copy(fsrc, fdst, exists_ok=False):
                 raise
 
 
+def f_fsync_dir(dirpath):
+    """
+    Persist a directory entry change (e.g. a rename) to disk. No-op on
+    platforms that cannot open directories (Windows)
+    """
+    try:
+        fd = os.open(f_expand(dirpath) or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _f_temp_path(fpath):
+    "temp file in the same dir as `fpath`, so that rename is atomic"
+    dirname, basename = os.path.split(fpath)
+    return os.path.join(
+        dirname, f'.{basename}.tmp{os.getpid()}-{threading.get_ident()}'
+    )
+
+
+@contextmanager
+def f_atomic_open(fpath, mode='wb', fsync=True):
+    """
+    Crash-safe write: yields a temp file in the same dir, which is flushed,
+    fsynced and renamed to `fpath` on success, then the dir is fsynced.
+    Readers never see a partially written file and a crash mid-write leaves
+    the previous `fpath` intact. The temp file is removed on error.
+
+    Example:
+        with f_atomic_open('last.ckpt') as f:
+            torch.save(obj, f)
+    """
+    assert 'w' in mode, 'f_atomic_open is for writing only'
+    fpath = f_expand(fpath)
+    tmp_path = _f_temp_path(fpath)
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, fpath)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    if fsync:
+        f_fsync_dir(os.path.dirname(fpath))
+
+
+def f_swap_dir(fsrc, fdst, fsync=True):
+    """
+    Replaces the directory `fdst` with `fsrc`: the existing `fdst` is first
+    renamed to `{fdst}.old`, then `fsrc` to `fdst`, then `{fdst}.old` is removed.
+    NOT atomic: if the process dies between the two renames, `fdst` is missing
+    and `{fdst}.old` holds the previous version, see f_recover_swap()
+    """
+    fsrc, fdst = f_expand(fsrc), f_expand(fdst)
+    old_dir = fdst + '.old'
+    if os.path.exists(fdst):
+        f_remove(old_dir)
+        os.replace(fdst, old_dir)
+    os.replace(fsrc, fdst)
+    if fsync:
+        f_fsync_dir(os.path.dirname(fdst))
+    f_remove(old_dir)
+
+
+def f_recover_swap(fpath):
+    """
+    Undoes an f_swap_dir() interrupted between its two renames: if `fpath` is
+    missing but `{fpath}.old` exists, moves the previous version back.
+    Safe to call from several processes at once.
+
+    Returns:
+        True if `fpath` was recovered
+    """
+    fpath = f_expand(fpath)
+    old_path = fpath + '.old'
+    if os.path.exists(fpath) or not os.path.isdir(old_path):
+        return False
+    try:
+        os.replace(old_path, fpath)
+    except FileNotFoundError:
+        # recovered by another process
+        return False
+    f_fsync_dir(os.path.dirname(fpath))
+    return True
+
+
+# Linux ioctl to clone a file with copy-on-write (btrfs, XFS, ...)
+_FICLONE = 0x40049409
+
+
+def _f_reflink(fsrc, fdst):
+    """
+    Returns: True if `fdst` is created as a copy-on-write clone of `fsrc`
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(fsrc, 'rb') as src, open(fdst, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        return True
+    except OSError:
+        if os.path.exists(fdst):
+            os.remove(fdst)
+        return False
+
+
+def f_link_or_copy(fsrc, fdst, fsync=True):
+    """
+    Makes `fdst` an alias of `fsrc` without duplicating data when possible:
+    hardlink, then reflink (copy-on-write clone), then full copy as fallback.
+    Existing `fdst` file is replaced atomically. Directories are aliased file
+    by file into a temp dir that is then swapped in with f_swap_dir(), so
+    `fdst` never mixes old and new files. Files of an existing `fdst` dir that
+    are not in `fsrc` are removed.
+
+    WARNING: hardlinked files share the same data, never modify either of them
+        in place. Replace instead, e.g. with f_atomic_open()
+
+    Args:
+        fsync: persist the copied data and the directory entry to disk
+    Returns:
+        'hardlink', 'reflink' or 'copy' (the last method used for a directory)
+    """
+    fsrc, fdst = f_expand(fsrc), f_expand(fdst)
+    if os.path.isdir(fsrc):
+        tmp_dir = _f_temp_path(fdst)
+        f_remove(tmp_dir)
+        os.makedirs(tmp_dir)
+        try:
+            method = 'hardlink'
+            for name in os.listdir(fsrc):
+                method = f_link_or_copy(
+                    os.path.join(fsrc, name), os.path.join(tmp_dir, name), fsync=fsync
+                )
+            f_swap_dir(tmp_dir, fdst, fsync=fsync)
+        finally:
+            f_remove(tmp_dir)
+        return method
+
+    if os.path.exists(fdst) and os.path.samefile(fsrc, fdst):
+        return 'hardlink'
+    tmp_path = _f_temp_path(fdst)
+    try:
+        try:
+            os.link(fsrc, tmp_path)
+            method = 'hardlink'
+        except OSError:
+            if _f_reflink(fsrc, tmp_path):
+                method = 'reflink'
+            else:
+                shutil.copyfile(fsrc, tmp_path)
+                method = 'copy'
+            if fsync:
+                with open(tmp_path, 'rb') as f:
+                    os.fsync(f.fileno())
+        os.replace(tmp_path, fdst)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    if fsync:
+        f_fsync_dir(os.path.dirname(fdst))
+    return method
+
+
 def _f_copytree(src, dst, symlinks=False,
                ignore=None, exist_ok=True, copy_function=shutil.copy2,
                ignore_dangling_symlinks=False):
@@ -305,6 +482,17 @@ def md5_checksum(fpath):
     return hash_md5.hexdigest()
 
 
+def crc32_checksum(fpath):
+    """
+    File CRC32 as 8 hex digits, much faster than md5 for large files
+    """
+    crc = 0
+    with open(f_expand(fpath), 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 22), b''):
+            crc = zlib.crc32(chunk, crc)
+    return f'{crc & 0xffffffff:08x}'
+
+
 def make_tar(source_file, output_tarball, compress_mode='gz'):
     """
     Args:
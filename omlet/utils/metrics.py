@@ -1,25 +1,175 @@
+import math
+import time
+import numpy as np
 import torch
+from typing import Union, Sequence, Optional
+from . import distributed as dist
 
 
 def accuracy(output, target, topk=(1,), scale_100=False):
     """
     Computes the accuracy over the k top predictions for the specified values of k.
     Accuracy is a float between 0.0 and 1.0
+
+    Single host sync for all k, see `accuracy_tensor` for the sync-free version
+    """
+    return accuracy_tensor(output, target, topk=topk, scale_100=scale_100).tolist()
+
+
+def accuracy_tensor(output: Union[torch.Tensor, Sequence[torch.Tensor]],
+                    target: torch.Tensor,
+                    topk=(1,),
+                    scale_100=False) -> torch.Tensor:
+    """
+    Vectorized top-k accuracy for all k and optionally multiple classifier heads
+    in one pass. Stays on device, the results can be fed directly to TensorMeter.
+
+    Args:
+        output: [B, C] logits, or multiple heads as [H, B, C] tensor
+            or a list of [B, C] tensors (heads may have different C)
+        target: [B] labels shared by all heads, or [H, B] labels per head
+    Returns:
+        float tensor of shape [len(topk)] for a single [B, C] output,
+        [H, len(topk)] for multiple heads
     """
     with torch.no_grad():
+        if isinstance(output, (list, tuple)):
+            if len(set(o.size(-1) for o in output)) > 1:
+                # heads with different number of classes cannot be stacked
+                if target.dim() == 1:
+                    target = target.unsqueeze(0).expand(len(output), -1)
+                return torch.stack([
+                    accuracy_tensor(o, t, topk=topk, scale_100=scale_100)
+                    for o, t in zip(output, target)
+                ])
+            output = torch.stack(output)
+        is_multi_head = output.dim() == 3
+        if not is_multi_head:
+            output = output.unsqueeze(0)
+        if target.dim() == 1:
+            target = target.unsqueeze(0)  # broadcast to all heads
         maxk = max(topk)
-        batch_size = target.size(0)
+        batch_size = target.size(-1)
 
-        _, pred = output.topk(maxk, 1, True, True)
-        pred = pred.t()
-        correct = pred.eq(target.view(1, -1).expand_as(pred))
+        _, pred = output.topk(maxk, dim=-1, largest=True, sorted=True)  # [H, B, maxk]
+        correct = pred.eq(target.unsqueeze(-1))
+        # each sample has at most one hit, so the cumsum along the sorted
+        # predictions indicates whether the target is within top-k
+        hits = correct.to(torch.int32).cumsum(dim=-1)
+        k_index = torch.as_tensor(topk, dtype=torch.long, device=hits.device) - 1
+        correct_k = hits.index_select(-1, k_index).sum(dim=1).float()  # [H, len(topk)]
 
         mult = 100. if scale_100 else 1.
-        res = []
-        for k in topk:
-            correct_k = correct[:k].view(-1).float().sum(0, keepdim=True)
-            res.append(float(correct_k.mul_(mult / batch_size).item()))
-        return res
+        correct_k.mul_(mult / batch_size)
+        if not is_multi_head:
+            correct_k = correct_k.squeeze(0)
+        return correct_k
+
+
+class MeterHistory:
+    """
+    Compact (value, size) history in growable preallocated NumPy buffers.
+    16 bytes per entry and amortized O(1) append, instead of a python tuple each.
+
+    Behaves like the old list of (value, size) tuples for len(), iteration and
+    indexing, and adds vectorized accessors.
+    """
+    def __init__(self, capacity: int = 1024):
+        self._values = np.empty(capacity, dtype=np.float64)
+        self._sizes = np.empty(capacity, dtype=np.int64)
+        self._len = 0
+
+    def _reserve(self, n):
+        capacity = len(self._values)
+        if self._len + n <= capacity:
+            return
+        new_capacity = max(2 * capacity, self._len + n, 16)
+        for attr in ('_values', '_sizes'):
+            old = getattr(self, attr)
+            new = np.empty(new_capacity, dtype=old.dtype)
+            new[:self._len] = old[:self._len]
+            setattr(self, attr, new)
+
+    def append(self, value, size=None):
+        """
+        Args:
+            value: float, or a (value, size) tuple like the old list entries
+            size: defaults to 1
+        """
+        if size is None:
+            if isinstance(value, (tuple, list)):
+                value, size = value
+            else:
+                size = 1
+        self._reserve(1)
+        self._values[self._len] = value
+        self._sizes[self._len] = size
+        self._len += 1
+
+    def extend(self, values, sizes):
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        sizes = np.broadcast_to(np.asarray(sizes, dtype=np.int64), values.shape)
+        n = len(values)
+        self._reserve(n)
+        self._values[self._len:self._len + n] = values
+        self._sizes[self._len:self._len + n] = sizes
+        self._len += n
+
+    def clear(self):
+        "keeps the allocated buffers"
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return zip(self.values.tolist(), self.sizes.tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(zip(self.values[index].tolist(), self.sizes[index].tolist()))
+        return float(self.values[index]), int(self.sizes[index])
+
+    @staticmethod
+    def _read_only(view: np.ndarray) -> np.ndarray:
+        view.flags.writeable = False
+        return view
+
+    @property
+    def values(self) -> np.ndarray:
+        "read-only view, no copy"
+        return self._read_only(self._values[:self._len])
+
+    @property
+    def sizes(self) -> np.ndarray:
+        "read-only view, no copy"
+        return self._read_only(self._sizes[:self._len])
+
+    def to_numpy(self):
+        """
+        Returns:
+            (values, sizes) copies
+        """
+        return self.values.copy(), self.sizes.copy()
+
+    def cumulative_mean(self) -> np.ndarray:
+        """
+        Running size-weighted mean after each entry, i.e. the meter value curve
+        """
+        weighted = np.cumsum(self.values * self.sizes)
+        return weighted / np.maximum(np.cumsum(self.sizes), 1)
+
+    def windowed_mean(self, window: int) -> np.ndarray:
+        """
+        Size-weighted moving average over the last `window` entries
+        (fewer for the first window-1 entries)
+        """
+        assert window > 0
+        weighted = np.concatenate([[0.], np.cumsum(self.values * self.sizes)])
+        sizes = np.concatenate([[0], np.cumsum(self.sizes)])
+        end = np.arange(1, self._len + 1)
+        start = np.maximum(end - window, 0)
+        return (weighted[end] - weighted[start]) / np.maximum(sizes[end] - sizes[start], 1)
 
 
 class AverageMeter:
@@ -28,15 +178,21 @@ class AverageMeter:
                  keep_history=False):
         """
         Args:
-            keep_history: if True, keeps a list of [(value, n)]
+            keep_history: if True, keeps a MeterHistory of [(value, n)]
         """
         self.name = name
         self.fmt = formatter.lstrip(':')
         self.keep_history = keep_history
         self.reset()
 
+    def _reset_history(self):
+        if getattr(self, 'history', None) is None:
+            self.history = MeterHistory(capacity=1024 if self.keep_history else 0)
+        else:
+            self.history.clear()
+
     def reset(self):
-        self.history = []
+        self._reset_history()
         self.sum = 0
         self.size = 0
         self.n = 0
@@ -48,7 +204,7 @@ class AverageMeter:
         self.size += size
         self.n += 1
         if self.keep_history:
-            self.history.append((value, size))
+            self.history.append(value, size)
 
     @property
     def value(self):
@@ -56,6 +212,31 @@ class AverageMeter:
             return 0.
         return self.sum / self.size
 
+    def state_dict(self):
+        """
+        Running average state, e.g. for resuming a partial epoch.
+        History is not included.
+        """
+        return {'sum': float(self.sum), 'size': self.size, 'n': self.n}
+
+    def load_state_dict(self, state):
+        self.reset()
+        self.sum = state['sum']
+        self.size = state['size']
+        self.n = state['n']
+
+    def _set_sum_size(self, _sum, size):
+        self.sum = _sum
+        self.size = int(size)
+
+    def reduce_(self, group=None):
+        """
+        In-place sum of (sum, size) over all processes, `value` becomes the
+        exact sample-weighted global average.
+        See reduce_meters_() to reduce several meters with one collective
+        """
+        reduce_meters_([self], group=group)
+
     def __float__(self):
         return float(self.value)
 
@@ -68,3 +249,640 @@ class AverageMeter:
         return fmtstr.format(name=self.name, avg=self.value)
 
 
+class TensorMeter(AverageMeter):
+    """
+    AverageMeter that accumulates tensor values on their own device.
+
+    `update()` never forces a host/device sync: weighted sums stay on the
+    device of the incoming tensor and the sample count is kept as a python int
+    (batch sizes are already known on the host).
+    Values are only copied to host when `value` or `sum` is read.
+    The device sum is float32 with Kahan compensation: close to float64
+    accuracy over long epochs, and float64 is slow on consumer GPUs and
+    not supported on MPS.
+    Plain python numbers are still accepted and accumulated on the host.
+
+    With keep_history, values are staged in a device buffer and copied to
+    the host MeterHistory once every `history_chunk` updates (or when read).
+    """
+    def __init__(self, name=None, formatter='.2f',
+                 keep_history=False, history_chunk: int = 256):
+        self._history = None
+        self._history_chunk = history_chunk
+        self._pending = None
+        self._pending_sizes = []
+        super().__init__(name=name, formatter=formatter, keep_history=keep_history)
+
+    def _reset_history(self):
+        if self._history is None:
+            self._history = MeterHistory(capacity=1024 if self.keep_history else 0)
+        else:
+            self._history.clear()
+        self._pending_sizes = []
+
+    @property
+    def history(self) -> MeterHistory:
+        self._flush_history()
+        return self._history
+
+    def _flush_history(self):
+        n = len(self._pending_sizes)
+        if n > 0:
+            self._history.extend(self._pending[:n].cpu().numpy(), self._pending_sizes)
+            self._pending_sizes = []
+
+    def _append_history(self, value, size):
+        n = len(self._pending_sizes)
+        if self._pending is None or n == 0 and torch.is_tensor(value) \
+                and value.device != self._pending.device:
+            device = value.device if torch.is_tensor(value) else 'cpu'
+            self._pending = torch.empty(
+                self._history_chunk, dtype=torch.float32, device=device
+            )
+        if torch.is_tensor(value):
+            self._pending[n].copy_(value.reshape(()))
+        else:
+            self._pending[n] = value
+        self._pending_sizes.append(size)
+        if n + 1 == self._history_chunk:
+            self._flush_history()
+
+    def reset(self):
+        self._reset_history()
+        self._host_sum = 0.
+        self._device_sum = None
+        self._device_compensation = None
+        self.size = 0
+        self.n = 0
+
+    def update(self, value, size=1):
+        if not torch.is_tensor(value):
+            value = float(value)
+            size = int(size)
+            self._host_sum += value * size
+        else:
+            value = value.detach()
+            size = int(size)
+            weighted = value.to(torch.float32) * size
+            if self._device_sum is None:
+                self._device_sum = weighted
+                self._device_compensation = torch.zeros_like(weighted)
+            else:
+                # Kahan summation, all in place on device
+                weighted -= self._device_compensation
+                total = self._device_sum + weighted
+                self._device_compensation.copy_(total).sub_(self._device_sum).sub_(weighted)
+                self._device_sum = total
+        self.size += size
+        self.n += 1
+        if self.keep_history:
+            self._append_history(value, size)
+
+    @property
+    def sum_tensor(self) -> torch.Tensor:
+        """
+        Weighted sum as a float32 tensor on the accumulation device, no sync.
+        """
+        if self._device_sum is None:
+            return torch.tensor(self._host_sum, dtype=torch.float32)
+        return self._device_sum - self._device_compensation + self._host_sum
+
+    @property
+    def value_tensor(self) -> torch.Tensor:
+        """
+        Average as a float32 tensor on the accumulation device, no sync.
+        """
+        return self.sum_tensor / max(self.size, 1)
+
+    @property
+    def sum(self):
+        if self._device_sum is None:
+            return self._host_sum
+        return self._host_sum + float(self._device_sum) - float(self._device_compensation)
+
+    def load_state_dict(self, state):
+        self.reset()
+        self._host_sum = state['sum']
+        self.size = state['size']
+        self.n = state['n']
+
+    def _set_sum_size(self, _sum, size):
+        self._host_sum = float(_sum)
+        self._device_sum = None
+        self._device_compensation = None
+        self.size = int(size)
+
+    @property
+    def value(self):
+        if self.size == 0:
+            return 0.
+        return self.sum / self.size
+
+
+def reduce_meters_(meters, group=None):
+    """
+    In-place exact reduction of AverageMeters across processes, with a single
+    collective for all of them. Each meter then holds the global (sum, size),
+    so unlike the averages returned by dist.reduce_meters(), it can still be
+    updated or saved with state_dict(). `n` and the history stay local.
+    No-op without DDP.
+
+    Args:
+        meters: list, tuple or dict of AverageMeter (TensorMeter sums are
+            packed on device without host sync)
+    Returns:
+        `meters`
+    """
+    if not dist.is_initialized() or dist.get_world_size(group) == 1:
+        return meters
+    items = list(meters.values()) if isinstance(meters, dict) else list(meters)
+    pairs = [
+        (m.sum_tensor if hasattr(m, 'sum_tensor') else m.sum, m.size) for m in items
+    ]
+    for meter, (_sum, size) in zip(items, dist.reduce_sum_count(pairs, group=group)):
+        meter._set_sum_size(_sum, size)
+    return meters
+
+
+class WindowedMeter:
+    """
+    Moving size-weighted average over the last `window` updates, and
+    optionally only those within the last `window_seconds`.
+
+    O(1) per update: a ring buffer of weighted values and a running sum.
+    Like TensorMeter, tensor values stay on their device and `update()` never
+    syncs, the value is only copied to host when `value` is read.
+    The running sum is recomputed from the buffer once per wrap-around
+    (amortized O(1)) so floating point error does not accumulate.
+    """
+    def __init__(self, window: int, window_seconds: Optional[float] = None,
+                 name=None, formatter='.2f'):
+        assert window > 0
+        self.window = window
+        self.window_seconds = window_seconds
+        self.name = name
+        self.fmt = formatter.lstrip(':')
+        self.reset()
+
+    def reset(self):
+        self._values = None  # float32 tensor [window] of value * size
+        self._sizes = [0] * self.window
+        self._times = [0.] * self.window
+        self._head = 0  # next slot to write
+        self._count = 0  # number of valid entries, ending right before head
+        self._sum = 0.
+        self.size = 0
+
+    def _get_buffer(self, value):
+        device = value.device if torch.is_tensor(value) else torch.device('cpu')
+        if self._values is None:
+            self._values = torch.zeros(self.window, dtype=torch.float32, device=device)
+            self._sum = self._values.new_zeros(())
+        elif torch.is_tensor(value) and self._values.device != device:
+            # e.g. python floats first, then CUDA tensors. Happens at most once
+            self._values = self._values.to(device)
+            self._sum = self._sum.to(device)
+        return self._values
+
+    def _evict_oldest(self, zero_slot):
+        idx = (self._head - self._count) % self.window
+        self._sum -= self._values[idx]
+        self.size -= self._sizes[idx]
+        if zero_slot:
+            self._values[idx] = 0.
+        self._count -= 1
+
+    def _evict_expired(self, now):
+        if self.window_seconds is None:
+            return
+        while self._count > 0:
+            idx = (self._head - self._count) % self.window
+            if now - self._times[idx] <= self.window_seconds:
+                break
+            self._evict_oldest(zero_slot=True)
+
+    def update(self, value, size=1):
+        size = int(size)
+        buffer = self._get_buffer(value)
+        now = time.monotonic()
+        self._evict_expired(now)
+        if self._count == self.window:
+            self._evict_oldest(zero_slot=False)  # slot is overwritten below
+        head = self._head
+        if torch.is_tensor(value):
+            buffer[head].copy_(value.detach().reshape(()).to(torch.float32) * size)
+        else:
+            buffer[head] = float(value) * size
+        self._sum += buffer[head]
+        self._sizes[head] = size
+        self._times[head] = now
+        self.size += size
+        self._count += 1
+        self._head = (head + 1) % self.window
+        if self._head == 0:
+            # all slots outside the window are zero
+            self._sum = buffer.sum()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def value(self):
+        self._evict_expired(time.monotonic())
+        if self.size == 0:
+            return 0.
+        return float(self._sum) / self.size
+
+    def __float__(self):
+        return float(self.value)
+
+    def __str__(self):
+        if self.name:
+            fmtstr = '{name} {avg:' + self.fmt + '}'
+        else:
+            fmtstr = '{avg:' + self.fmt + '}'
+        return fmtstr.format(name=self.name, avg=self.value)
+
+
+class ConfusionMatrixMeter:
+    """
+    Streaming confusion matrix with fixed [C, C] state on the device of the
+    inputs. Rows are targets, columns are predictions.
+    Memory does not grow with the number of samples, and the state can be
+    reduced across processes with a single collective.
+    """
+    def __init__(self, num_classes: int, name=None, ignore_index: Optional[int] = None):
+        self.num_classes = num_classes
+        self.name = name
+        self.ignore_index = ignore_index
+        self.reset()
+
+    def reset(self):
+        self.matrix = None
+
+    def _get_state(self, device):
+        if self.matrix is None:
+            C = self.num_classes
+            self.matrix = torch.zeros(C, C, dtype=torch.long, device=device)
+        return self.matrix
+
+    def _counts(self):
+        """
+        The matrix, zeros if never updated. The state is only allocated by
+        update() or reduce_(), on the device they get
+        """
+        if self.matrix is None:
+            C = self.num_classes
+            return torch.zeros(C, C, dtype=torch.long)
+        return self.matrix
+
+    def update(self, output: torch.Tensor, target: torch.Tensor):
+        """
+        Args:
+            output: [B, C] logits/scores, or [B] predicted labels
+            target: [B] labels
+        """
+        with torch.no_grad():
+            if output.dim() == target.dim() + 1:
+                output = output.argmax(dim=-1)
+            pred, target = output.reshape(-1).long(), target.reshape(-1).long()
+            C = self.num_classes
+            # out-of-range labels (e.g. ignore-index predictions) are skipped
+            valid = (target >= 0) & (target < C) & (pred >= 0) & (pred < C)
+            if self.ignore_index is not None:
+                valid &= target != self.ignore_index
+            index = target[valid] * C + pred[valid]
+            counts = torch.bincount(index, minlength=C * C).view(C, C)
+            self._get_state(counts.device).add_(counts)
+
+    def reduce_(self, group=None, async_op=False):
+        """
+        In-place sum over all processes with one collective.
+        A process that never called update() contributes zeros
+        """
+        if self.matrix is None:
+            self._get_state(dist.comm_device(group))
+        return dist.reduce(
+            self.matrix, op='sum', group=group, out=self.matrix, async_op=async_op
+        )
+
+    @property
+    def true_positives(self):
+        return self._counts().diag()
+
+    def accuracy(self) -> torch.Tensor:
+        """
+        0 before any update, like the per-class metrics below
+        """
+        return self.true_positives.sum().float() / self._counts().sum().clamp(min=1)
+
+    def precision(self) -> torch.Tensor:
+        """
+        Per-class precision [C], classes never predicted have 0
+        """
+        return self.true_positives.float() / self._counts().sum(dim=0).clamp(min=1)
+
+    def recall(self) -> torch.Tensor:
+        """
+        Per-class recall [C], classes never seen have 0
+        """
+        return self.true_positives.float() / self._counts().sum(dim=1).clamp(min=1)
+
+    def f1(self) -> torch.Tensor:
+        """
+        Per-class F1 [C]
+        """
+        p, r = self.precision(), self.recall()
+        return 2 * p * r / (p + r).clamp(min=1e-12)
+
+    def macro(self, metric='f1') -> torch.Tensor:
+        """
+        Average of a per-class metric over the classes present in targets,
+        0 if there is none
+        """
+        values = getattr(self, metric)()
+        present = self._counts().sum(dim=1) > 0
+        return values[present].mean() if present.any() else values.new_zeros(())
+
+
+class BinnedRankingMeter:
+    """
+    Streaming ROC-AUC and average precision (AP/mAP) with binned scores.
+
+    Scores are assumed to be in [0, 1] (e.g. softmax or sigmoid outputs) and
+    are quantized into `num_bins` bins. State is a fixed [2, C, num_bins]
+    histogram of positive and negative scores per class, so memory does not
+    grow with the dataset and can be reduced with a single collective.
+    Approximation error is bounded by the bin width.
+    """
+    def __init__(self, num_classes: int, num_bins: int = 1000, name=None):
+        self.num_classes = num_classes
+        self.num_bins = num_bins
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.histogram = None
+
+    def _get_state(self, device):
+        if self.histogram is None:
+            self.histogram = torch.zeros(
+                2, self.num_classes, self.num_bins, dtype=torch.long, device=device
+            )
+        return self.histogram
+
+    def _counts(self):
+        """
+        The histogram, zeros if never updated
+        """
+        if self.histogram is None:
+            return torch.zeros(2, self.num_classes, self.num_bins, dtype=torch.long)
+        return self.histogram
+
+    def update(self, scores: torch.Tensor, target: torch.Tensor):
+        """
+        Args:
+            scores: [B, C] scores in [0, 1]
+            target: [B] multi-class labels, or [B, C] binary multi-label targets
+        """
+        with torch.no_grad():
+            C, nbins = self.num_classes, self.num_bins
+            if target.dim() == 1:
+                target = torch.nn.functional.one_hot(target.long(), C)
+            is_pos = target.bool().reshape(-1)
+            bins = (scores.detach().float() * nbins).long().clamp_(0, nbins - 1)
+            class_offset = torch.arange(C, device=bins.device) * nbins
+            index = (bins + class_offset).reshape(-1)
+            # positives go to the first half of the flat [2, C, bins] state
+            index = index + (~is_pos).long() * (C * nbins)
+            counts = torch.bincount(index, minlength=2 * C * nbins)
+            self._get_state(counts.device).add_(counts.view(2, C, nbins))
+
+    def reduce_(self, group=None, async_op=False):
+        """
+        In-place sum over all processes with one collective.
+        A process that never called update() contributes zeros
+        """
+        if self.histogram is None:
+            self._get_state(dist.comm_device(group))
+        return dist.reduce(
+            self.histogram, op='sum', group=group, out=self.histogram,
+            async_op=async_op
+        )
+
+    def _cumulative_counts(self):
+        """
+        True and false positive counts when thresholding at each bin,
+        from the highest threshold to the lowest: [C, num_bins] each
+        """
+        hist = self._counts().double().flip(-1)
+        tp = hist[0].cumsum(dim=-1)
+        fp = hist[1].cumsum(dim=-1)
+        return tp, fp
+
+    def auc(self) -> torch.Tensor:
+        """
+        Per-class ROC-AUC [C], ties within a bin count as half
+        """
+        tp, fp = self._cumulative_counts()
+        zeros = tp.new_zeros(tp.size(0), 1)
+        tpr = torch.cat([zeros, tp], dim=-1) / tp[:, -1:].clamp(min=1)
+        fpr = torch.cat([zeros, fp], dim=-1) / fp[:, -1:].clamp(min=1)
+        return torch.trapz(tpr, fpr, dim=-1)
+
+    def average_precision(self) -> torch.Tensor:
+        """
+        Per-class average precision [C]
+        """
+        tp, fp = self._cumulative_counts()
+        precision = tp / (tp + fp).clamp(min=1)
+        recall = tp / tp[:, -1:].clamp(min=1)
+        recall_delta = torch.cat([recall[:, :1], recall[:, 1:] - recall[:, :-1]], dim=-1)
+        return (precision * recall_delta).sum(dim=-1)
+
+    @staticmethod
+    def _mean_over(values, present):
+        # the mean of no class would be NaN
+        return values[present].mean() if present.any() else values.new_zeros(())
+
+    def _present_classes(self):
+        return self._counts()[0].sum(dim=-1) > 0
+
+    def mean_auc(self) -> torch.Tensor:
+        """
+        Mean ROC-AUC over classes that have at least one positive, 0 if none has
+        """
+        return self._mean_over(self.auc(), self._present_classes())
+
+    def mean_average_precision(self) -> torch.Tensor:
+        """
+        mAP over classes that have at least one positive, 0 if none has
+        """
+        return self._mean_over(self.average_precision(), self._present_classes())
+
+
+class QuantileMeter:
+    """
+    Streaming quantile sketch (p50/p90/p99, min/max, mean) with bounded memory.
+
+    Values are counted in log-spaced bins (DDSketch): any quantile of values
+    with magnitude in [min_value, max_value] is estimated within
+    `relative_accuracy` relative error. Values with smaller magnitude go to a
+    zero bin, larger ones are clamped to the last bin. min, max and mean are exact.
+    Sketches with the same parameters can be merged and reduced across processes.
+
+    Host-side: tensor values are converted with float(), which syncs.
+    """
+    def __init__(self, name=None, formatter='.2f',
+                 relative_accuracy: float = 0.01,
+                 min_value: float = 1e-6,
+                 max_value: float = 1e6):
+        assert 0 < relative_accuracy < 1
+        assert 0 < min_value < max_value
+        self.name = name
+        self.fmt = formatter.lstrip(':')
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._offset = math.ceil(math.log(min_value) / self._log_gamma)
+        self.num_bins = math.ceil(math.log(max_value) / self._log_gamma) - self._offset + 1
+        self.reset()
+
+    def reset(self):
+        self._pos = [0.] * self.num_bins
+        self._neg = [0.] * self.num_bins
+        self._zero = 0.
+        self.size = 0.
+        self.sum = 0.
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _bin_index(self, magnitude):
+        index = math.ceil(math.log(magnitude) / self._log_gamma) - self._offset
+        return min(max(index, 0), self.num_bins - 1)
+
+    def _bin_value(self, index):
+        return 2 * self._gamma ** (index + self._offset) / (self._gamma + 1)
+
+    def update(self, value, size=1):
+        """
+        Args:
+            size: weight of the value, same convention as AverageMeter
+        """
+        value = float(value)
+        if value > self.min_value:
+            self._pos[self._bin_index(value)] += size
+        elif value < -self.min_value:
+            self._neg[self._bin_index(-value)] += size
+        else:
+            self._zero += size
+        self.size += size
+        self.sum += value * size
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        assert 0 <= q <= 1
+        if self.size == 0:
+            return 0.
+        rank = q * self.size
+        cumulative = 0.
+        # negative values from the largest magnitude to the smallest
+        for i in reversed(range(self.num_bins)):
+            cumulative += self._neg[i]
+            if cumulative > rank:
+                return self._clamp(-self._bin_value(i))
+        cumulative += self._zero
+        if cumulative > rank:
+            return self._clamp(0.)
+        for i in range(self.num_bins):
+            cumulative += self._pos[i]
+            if cumulative > rank:
+                return self._clamp(self._bin_value(i))
+        return self.max
+
+    def _clamp(self, value):
+        return min(max(value, self.min), self.max)
+
+    @property
+    def p50(self):
+        return self.quantile(0.5)
+
+    @property
+    def p90(self):
+        return self.quantile(0.9)
+
+    @property
+    def p99(self):
+        return self.quantile(0.99)
+
+    @property
+    def value(self):
+        "mean, same as AverageMeter"
+        if self.size == 0:
+            return 0.
+        return self.sum / self.size
+
+    def summary(self, quantiles=(0.5, 0.9, 0.99)):
+        """
+        Returns:
+            dict {'mean', 'min', 'max', 'p50', 'p90', 'p99'}, all 0 before any update
+        """
+        if self.size == 0:
+            # not +-inf
+            info = {'mean': 0., 'min': 0., 'max': 0.}
+        else:
+            info = {'mean': self.value, 'min': self.min, 'max': self.max}
+        for q in quantiles:
+            info[f'p{q * 100:g}'] = self.quantile(q)
+        return info
+
+    def _check_compatible(self, other):
+        assert (self.relative_accuracy, self.min_value, self.max_value) == \
+               (other.relative_accuracy, other.min_value, other.max_value), \
+            'cannot merge QuantileMeters with different parameters'
+
+    def merge(self, other: 'QuantileMeter'):
+        self._check_compatible(other)
+        self._pos = [a + b for a, b in zip(self._pos, other._pos)]
+        self._neg = [a + b for a, b in zip(self._neg, other._neg)]
+        self._zero += other._zero
+        self.size += other.size
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def reduce_(self, group=None, device=None):
+        """
+        In-place merge of the sketches on all processes.
+        One SUM collective for the bins, count and sum, one MAX for min/max.
+        """
+        n = self.num_bins
+        counts = torch.tensor(
+            self._neg + self._pos + [self._zero, self.size, self.sum],
+            dtype=torch.float64,
+            device=dist.comm_device(group, device)
+        )
+        extremes = counts.new_tensor([self.max, -self.min])
+        dist.all_reduce_(counts, op='sum', group=group)
+        dist.all_reduce_(extremes, op='max', group=group)
+        counts = counts.tolist()
+        self._neg, self._pos = counts[:n], counts[n:2 * n]
+        self._zero, self.size, self.sum = counts[2 * n:]
+        _max, _neg_min = extremes.tolist()
+        self.max, self.min = _max, -_neg_min
+        return self
+
+    def __float__(self):
+        return float(self.value)
+
+    def __str__(self):
+        fmt = '{:' + self.fmt + '}'
+        s = ' '.join(
+            f'{k} {fmt.format(v)}' for k, v in self.summary().items()
+            if k in ('p50', 'p90', 'p99')
+        )
+        return f'{self.name} {s}' if self.name else s
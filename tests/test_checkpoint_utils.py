@@ -0,0 +1,366 @@
+import os
+import sys
+import time
+import threading
+import subprocess
+import collections
+import pytest
+import torch
+import torch.multiprocessing as mp
+import omlet.utils as U
+import omlet.utils.checkpoint_utils as CU
+import omlet.utils.distributed as dist
+
+
+def _make_checkpoint(seed=0):
+    g = torch.Generator().manual_seed(seed)
+    state_dict = collections.OrderedDict([
+        ('linear.weight', torch.randn(16, 8, generator=g)),
+        ('linear.bias', torch.randn(16, generator=g)),
+        ('half', torch.randn(4, 4, generator=g).half()),
+        ('bf16', torch.randn(3, 5, generator=g).bfloat16()),
+        ('bn.num_batches_tracked', torch.tensor(7)),
+        ('mask', torch.tensor([True, False, True])),
+        ('transposed', torch.randn(6, 3, generator=g).t()),
+    ])
+    momentum = torch.randn(16, 8, generator=g)
+    return {
+        'epoch': 3,
+        'global_step': 120,
+        'state_dict': state_dict,
+        'optimizer_states': [{
+            'state': {0: {'momentum_buffer': momentum, 'step': 12}},
+            'param_groups': [{'lr': 0.1, 'params': [0]}],
+        }],
+        'extended': {'metrics_history': [{'val/acc1': 0.5}], 'best_metrics': {}},
+    }
+
+
+def _assert_same(actual, expected):
+    if torch.is_tensor(expected):
+        assert torch.is_tensor(actual)
+        assert actual.dtype == expected.dtype and actual.shape == expected.shape
+        assert torch.equal(actual, expected)
+    elif isinstance(expected, dict):
+        assert actual.keys() == expected.keys()
+        for k in expected:
+            _assert_same(actual[k], expected[k])
+    elif isinstance(expected, (list, tuple)):
+        assert len(actual) == len(expected)
+        for a, e in zip(actual, expected):
+            _assert_same(a, e)
+    else:
+        assert actual == expected
+
+
+def _save(fmt, checkpoint, path):
+    if fmt == 'torch':
+        U.atomic_torch_save(checkpoint, path)
+    elif fmt == 'dedup':
+        U.DedupCheckpointStore(os.path.dirname(path)).save(checkpoint, path)
+    elif fmt == 'compressed':
+        U.save_compressed_checkpoint(checkpoint, path, chunk_size=64)
+    elif fmt == 'sharded':
+        U.save_sharded_checkpoint(checkpoint, path)
+    else:
+        raise ValueError(fmt)
+
+
+@pytest.mark.parametrize('fmt', ['torch', 'dedup', 'compressed', 'sharded'])
+@pytest.mark.parametrize('mmap', [True, False])
+def test_round_trip(tmp_path, fmt, mmap):
+    checkpoint = _make_checkpoint()
+    path = str(tmp_path / 'epoch=3.ckpt')
+    _save(fmt, checkpoint, path)
+    assert U.checkpoint_format(path) == fmt
+    _assert_same(U.load_checkpoint(path, mmap=mmap), checkpoint)
+
+
+@pytest.mark.parametrize('fmt', ['torch', 'dedup', 'compressed', 'sharded'])
+def test_round_trip_state_dict_only(tmp_path, fmt):
+    checkpoint = _make_checkpoint()
+    path = str(tmp_path / 'last.ckpt')
+    _save(fmt, checkpoint, path)
+    loaded = U.load_checkpoint(path, state_dict_only=True)
+    assert 'optimizer_states' not in loaded
+    _assert_same(loaded['state_dict'], checkpoint['state_dict'])
+
+
+def test_torch_zip_load_mmap(tmp_path):
+    # the reader used by torch_load_mmap() when torch.load() has no mmap
+    checkpoint = _make_checkpoint()
+    checkpoint['param'] = torch.nn.Parameter(torch.ones(2))
+    path = str(tmp_path / 'a.ckpt')
+    torch.save(checkpoint, path)
+    loaded = CU._torch_zip_load_mmap(path)
+    _assert_same(loaded, checkpoint)
+    transposed = loaded['state_dict']['transposed']
+    assert transposed.stride() == checkpoint['state_dict']['transposed'].stride()
+    assert isinstance(loaded['param'], torch.nn.Parameter) and loaded['param'].requires_grad
+    # copy-on-write, the file is never modified
+    loaded['state_dict']['linear.weight'].add_(1)
+    _assert_same(U.torch_load(path), checkpoint)
+
+
+def _blocking_save(release, saved):
+    def _save(checkpoint, filepath):
+        assert release.wait(timeout=10)
+        torch.save(checkpoint, filepath)
+        saved.append(filepath)
+    return _save
+
+
+def test_async_writer_backpressure(tmp_path):
+    release, saved = threading.Event(), []
+    writer = U.AsyncCheckpointWriter(max_pending=1, save_function=_blocking_save(release, saved))
+    writer.save(_make_checkpoint(), str(tmp_path / 'a.ckpt'))
+    # the writer thread holds the only slot until the write finishes
+    second = threading.Thread(target=writer.save, args=(_make_checkpoint(), str(tmp_path / 'b.ckpt')))
+    second.start()
+    time.sleep(0.2)
+    assert second.is_alive() and saved == []
+    release.set()
+    second.join(timeout=10)
+    assert not second.is_alive()
+    writer.close()
+    assert saved == [str(tmp_path / 'a.ckpt'), str(tmp_path / 'b.ckpt')]
+
+
+def test_async_writer_snapshot_not_aliased(tmp_path):
+    release, saved = threading.Event(), []
+    writer = U.AsyncCheckpointWriter(save_function=_blocking_save(release, saved))
+    checkpoint = _make_checkpoint()
+    expected = _make_checkpoint()
+    path = str(tmp_path / 'a.ckpt')
+    writer.save(checkpoint, path)
+    # training goes on while the file is written
+    checkpoint['state_dict']['linear.weight'].add_(1)
+    checkpoint['optimizer_states'][0]['state'][0]['momentum_buffer'].zero_()
+    release.set()
+    writer.close()
+    _assert_same(torch.load(path), expected)
+
+
+def test_async_writer_error(tmp_path):
+    def _fail(checkpoint, filepath):
+        raise OSError('disk full')
+
+    writer = U.AsyncCheckpointWriter(save_function=_fail)
+    writer.save(_make_checkpoint(), str(tmp_path / 'a.ckpt'))
+    with pytest.raises(RuntimeError) as info:
+        writer.flush()
+    assert isinstance(info.value.__cause__, OSError)
+    # reported once, and the slot is free again
+    writer.flush()
+    writer.save(_make_checkpoint(), str(tmp_path / 'b.ckpt'))
+    time.sleep(0.2)
+    # a later save() reports the error of a previous one
+    with pytest.raises(RuntimeError):
+        writer.save(_make_checkpoint(), str(tmp_path / 'c.ckpt'))
+    writer.close()
+
+
+def test_async_writer_flushed_at_exit(tmp_path):
+    path = str(tmp_path / 'a.ckpt')
+    script = (
+        'import time, torch, omlet.utils as U\n'
+        'def _slow_save(checkpoint, filepath):\n'
+        '    time.sleep(0.5)\n'
+        '    torch.save(checkpoint, filepath)\n'
+        'writer = U.AsyncCheckpointWriter(save_function=_slow_save)\n'
+        f'writer.save({{"weight": torch.ones(3)}}, {path!r})\n'
+    )
+    # exits right after save(), without flush()
+    subprocess.run([sys.executable, '-c', script], check=True)
+    assert torch.equal(torch.load(path)['weight'], torch.ones(3))
+
+
+def _write_bytes(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def test_manifest_entries(tmp_path):
+    ckpt_dir = str(tmp_path)
+    manifest = U.CheckpointManifest(ckpt_dir)
+    assert manifest.last() is None and manifest.best('val/loss', 'min') is None
+    for name, value in [('a.ckpt', 0.5), ('b.ckpt', 0.3), ('c.ckpt', 0.4)]:
+        _write_bytes(str(tmp_path / name), b'x' * 10)
+        manifest.add(str(tmp_path / name), 'best', epoch=1, monitor='val/loss', value=value)
+    _write_bytes(str(tmp_path / 'epoch=1.ckpt'), b'x' * 20)
+    manifest.add(str(tmp_path / 'epoch=1.ckpt'), 'periodic', epoch=1)
+    # without last.ckpt, the most recent one
+    assert manifest.last() == str(tmp_path / 'epoch=1.ckpt')
+    assert manifest.best('val/loss', 'min') == str(tmp_path / 'b.ckpt')
+    assert manifest.best('val/loss', 'max') == str(tmp_path / 'a.ckpt')
+    assert manifest.best('val/acc1', 'max') is None
+
+    os.link(str(tmp_path / 'b.ckpt'), str(tmp_path / 'last.ckpt'))
+    entry = manifest.add_alias(str(tmp_path / 'b.ckpt'), str(tmp_path / 'last.ckpt'), 'last')
+    assert entry['kind'] == 'last' and entry['size'] == 10 and entry['value'] == 0.3
+    assert manifest.last() == str(tmp_path / 'last.ckpt')
+    assert set(manifest.find('best', 'val/loss')) == {
+        str(tmp_path / name) for name in ['a.ckpt', 'b.ckpt', 'c.ckpt']
+    }
+    manifest.remove(str(tmp_path / 'b.ckpt'))
+    assert str(tmp_path / 'b.ckpt') not in manifest
+    assert manifest.best('val/loss', 'min') == str(tmp_path / 'c.ckpt')
+
+    # persisted, the directory is not scanned again
+    os.remove(str(tmp_path / 'a.ckpt'))
+    reloaded = U.CheckpointManifest(ckpt_dir)
+    assert reloaded.entries == manifest.entries
+    assert reloaded.find(kind='periodic') == {
+        str(tmp_path / 'epoch=1.ckpt'): manifest.get(str(tmp_path / 'epoch=1.ckpt'))
+    }
+
+
+def test_manifest_verify(tmp_path):
+    manifest = U.CheckpointManifest(str(tmp_path), checksum=True)
+    path = str(tmp_path / 'last.ckpt')
+    _write_bytes(path, b'abcdef')
+    assert manifest.add(path, 'last')['checksum'] is not None
+    assert manifest.verify(path)
+    # same size, different content
+    _write_bytes(path, b'abcdeg')
+    assert not manifest.verify(path)
+    # sizes are checked without checksum
+    manifest.add(path, 'last', checksum=False)
+    assert manifest.verify(path)
+    _write_bytes(path, b'abc')
+    assert not manifest.verify(path)
+    os.remove(path)
+    assert not manifest.verify(path)
+    # not in the manifest, only checked for existence
+    _write_bytes(str(tmp_path / 'other.ckpt'), b'abc')
+    assert manifest.verify(str(tmp_path / 'other.ckpt'))
+
+
+def test_manifest_import_existing(tmp_path):
+    for name in ['last.ckpt', 'epoch=2.ckpt', 'best/epoch=1.ckpt', '.blobs/x.ckpt']:
+        os.makedirs(os.path.dirname(str(tmp_path / name)), exist_ok=True)
+        _write_bytes(str(tmp_path / name), b'x')
+    # sharded checkpoints are directories
+    U.save_sharded_checkpoint(_make_checkpoint(), str(tmp_path / 'epoch=3.ckpt'))
+
+    def _parse(relpath):
+        if relpath.startswith('epoch='):
+            return {'kind': 'periodic', 'epoch': int(relpath[len('epoch='):-len('.ckpt')])}
+        return None
+
+    manifest = U.CheckpointManifest(str(tmp_path), parse_filename=_parse)
+    assert sorted(manifest.entries) == [
+        'best/epoch=1.ckpt', 'epoch=2.ckpt', 'epoch=3.ckpt', 'last.ckpt'
+    ]
+    assert manifest.entries['epoch=2.ckpt']['kind'] == 'periodic'
+    assert manifest.entries['epoch=3.ckpt']['epoch'] == 3
+    assert manifest.entries['best/epoch=1.ckpt']['kind'] == 'unknown'
+    assert os.path.exists(manifest.path)
+    assert manifest.last() == str(tmp_path / 'last.ckpt')
+
+
+def test_dedup_shares_blobs(tmp_path):
+    store = U.DedupCheckpointStore(str(tmp_path))
+    first, second = _make_checkpoint(0), _make_checkpoint(0)
+    second['epoch'] = 4
+    store.save(first, str(tmp_path / 'epoch=3.ckpt'))
+    store.save(second, str(tmp_path / 'epoch=4.ckpt'))
+    blobs = os.listdir(store.blob_dir)
+    store.release(str(tmp_path / 'epoch=3.ckpt'))
+    os.remove(str(tmp_path / 'epoch=3.ckpt'))
+    assert os.listdir(store.blob_dir) == blobs
+    _assert_same(U.load_checkpoint(str(tmp_path / 'epoch=4.ckpt')), second)
+
+
+@pytest.mark.parametrize('dtype', [None, 'fp16', 'bf16'])
+def test_weights_round_trip(tmp_path, dtype):
+    checkpoint = _make_checkpoint()
+    path = str(tmp_path / 'best.weights')
+    U.export_weights(checkpoint, path, dtype=dtype)
+    assert U.checkpoint_format(path) == 'weights'
+    weights = U.load_weights(path)
+    expected = checkpoint['state_dict']
+    assert list(weights.keys()) == list(expected.keys())
+    for name, value in expected.items():
+        if dtype is not None and value.is_floating_point():
+            value = value.to(CU.WEIGHTS_DTYPES[dtype])
+        _assert_same(weights[name], value.contiguous())
+    loaded = U.load_checkpoint(path)
+    assert loaded.keys() == {'state_dict'}
+
+
+def test_export_weights_from_path(tmp_path):
+    checkpoint = _make_checkpoint()
+    src = tmp_path / 'last.ckpt'
+    U.save_compressed_checkpoint(checkpoint, str(src))
+    dst = str(tmp_path / 'last.weights')
+    U.export_weights(src, dst)  # os.PathLike
+    _assert_same(U.load_weights(dst, mmap=False), checkpoint['state_dict'])
+
+
+def test_average_checkpoints(tmp_path):
+    checkpoints = [_make_checkpoint(seed) for seed in range(3)]
+    paths = []
+    for i, checkpoint in enumerate(checkpoints):
+        paths.append(str(tmp_path / f'epoch={i}.ckpt'))
+        U.atomic_torch_save(checkpoint, paths[-1])
+    output_path = str(tmp_path / 'average.ckpt')
+    averaged = U.average_checkpoints(paths, output_path=output_path)
+    for name, value in checkpoints[0]['state_dict'].items():
+        if value.is_floating_point():
+            mean = sum(c['state_dict'][name].float() for c in checkpoints) / 3
+            assert averaged[name].dtype == value.dtype
+            assert torch.allclose(averaged[name].float(), mean.to(value.dtype).float())
+        else:
+            _assert_same(averaged[name], checkpoints[-1]['state_dict'][name])
+    saved = U.load_checkpoint(output_path)
+    assert 'optimizer_states' not in saved
+    _assert_same(saved['state_dict'], averaged)
+
+
+def _sharded_worker(rank, world_size, port, dirpath):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    checkpoint = _make_checkpoint()
+    U.save_sharded_checkpoint(checkpoint, dirpath)
+    dist.barrier()
+    # each rank reads its own shard and receives the others by broadcast
+    _assert_same(U.load_checkpoint(dirpath), checkpoint)
+
+
+def _sharded_single_rank_worker(rank, world_size, port, dirpath):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    checkpoint = _make_checkpoint()
+    U.save_sharded_checkpoint(checkpoint, dirpath)
+    dist.barrier()
+    if rank == 0:
+        # rank 1 is not in the load, every shard is read here
+        _assert_same(U.load_checkpoint(dirpath, collective=False), checkpoint)
+        averaged = U.average_checkpoints([dirpath])
+        _assert_same(averaged, checkpoint['state_dict'])
+        weights_path = os.path.join(os.path.dirname(dirpath), 'best.weights')
+        U.export_weights(dirpath, weights_path)
+        _assert_same(U.load_weights(weights_path), checkpoint['state_dict'])
+    dist.barrier()
+
+
+def test_sharded_load_single_rank_distributed(tmp_path):
+    mp.spawn(
+        _sharded_single_rank_worker,
+        args=(2, dist.random_free_tcp_port(), str(tmp_path / 'best.ckpt')), nprocs=2
+    )
+
+
+def test_sharded_round_trip_distributed(tmp_path):
+    dirpath = str(tmp_path / 'last.ckpt')
+    mp.spawn(
+        _sharded_worker, args=(2, dist.random_free_tcp_port(), dirpath), nprocs=2
+    )
+    assert sorted(os.listdir(dirpath)) == sorted(
+        [CU.SHARD_META_FILE, CU._shard_file(0, 2), CU._shard_file(1, 2)]
+    )
+    # fewer ranks than saved: every shard is read
+    _assert_same(U.load_checkpoint(dirpath), _make_checkpoint())
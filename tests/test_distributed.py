@@ -0,0 +1,148 @@
+import os
+import torch
+import torch.multiprocessing as mp
+import omlet.utils.distributed as dist
+
+
+def _async_reduce_worker(rank, world_size, port):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    tensor = torch.tensor([1., 2.]) * (rank + 1)
+    handle = dist.reduce(tensor, op='mean', async_op=True)
+    assert isinstance(handle, dist.AsyncReduce)
+    # out=None leaves the input unchanged
+    assert handle.wait().tolist() == [1.5, 3.]
+    assert tensor.tolist() == [rank + 1., 2. * (rank + 1)]
+    assert handle.is_completed() and handle.wait().tolist() == [1.5, 3.]
+
+    # finalizers run once, in chain order, on the first wait()
+    calls = []
+    first = dist.reduce(tensor, op='sum', out=tensor, async_op=True)
+    second = first.then(lambda out: calls.append('second') or out.sum().item())
+    third = second.then(lambda total: calls.append('third') or total * 10)
+    assert third.wait() == 90.
+    assert calls == ['second', 'third']
+    assert third.wait() == 90. and second.wait() == 9. and calls == ['second', 'third']
+    assert tensor.tolist() == [3., 6.]
+
+    storage = torch.zeros(3)
+    scalar = dist.reduce_scalar(rank, 'max', storage=storage, async_op=True)
+    scalars = dist.reduce_scalars({'a': 1., 'b': rank}, 'sum', async_op=True)
+    pair = dist.reduce_scalars((rank, 2.), 'min', async_op=True).then(list)
+    assert scalar.wait() == world_size - 1
+    assert scalars.wait() == {'a': 2., 'b': 1.}
+    assert pair.wait() == [0., 2.]
+    # same results as the blocking calls
+    assert dist.reduce_scalars({'a': 1., 'b': rank}, 'sum') == scalars.wait()
+
+
+def test_async_reduce_distributed():
+    mp.spawn(_async_reduce_worker, args=(2, dist.random_free_tcp_port()), nprocs=2)
+
+
+def test_completed_work():
+    calls = []
+    handle = dist.AsyncReduce(dist.CompletedWork(), lambda: calls.append(1) or 5)
+    assert handle.is_completed()
+    assert handle.then(lambda v: v + 1).wait() == 6
+    assert handle.wait() == 5 and calls == [1]
+
+
+def _consume(sampler, n):
+    """
+    Returns the first n indices and the sampler state after them,
+    the way ExtendedModule saves it mid-epoch
+    """
+    indices = list(sampler)[:n]
+    state = sampler.state_dict()
+    state['start_index'] = sampler.start_index + n
+    return indices, state
+
+
+def test_resumable_sampler_resumes_position():
+    dataset = list(range(50))
+    sampler = dist.ResumableSampler(dataset, shuffle=True, seed=7)
+    sampler.set_epoch(2)
+    full = list(sampler)
+    assert sorted(full) == dataset
+
+    head, state = _consume(sampler, 20)
+    resumed = dist.ResumableSampler(dataset, shuffle=True, seed=0)
+    assert resumed.load_state_dict(state)
+    assert resumed.seed == 7 and resumed.epoch == 2
+    assert len(resumed) == 30
+    assert head + list(resumed) == full
+
+
+def test_resumable_sampler_resumes_twice():
+    dataset = list(range(40))
+    sampler = dist.ResumableSampler(dataset, seed=3)
+    full = list(sampler)
+    head, state = _consume(sampler, 10)
+    second = dist.ResumableSampler(dataset, seed=3)
+    second.load_state_dict(state)
+    middle, state = _consume(second, 5)
+    third = dist.ResumableSampler(dataset, seed=3)
+    third.load_state_dict(state)
+    assert head + middle + list(third) == full
+
+
+def test_resumable_sampler_next_epoch_restarts():
+    dataset = list(range(30))
+    sampler = dist.ResumableSampler(dataset, seed=1)
+    sampler.set_start_index(12)
+    assert len(sampler) == 18
+    sampler.set_epoch(1)
+    assert len(sampler) == 30 and sampler.start_index == 0
+    # the permutation only depends on (seed, epoch)
+    other = dist.ResumableSampler(dataset, seed=1)
+    other.set_epoch(1)
+    assert list(sampler) == list(other)
+    other.set_epoch(0)
+    assert list(sampler) != list(other)
+
+
+def test_resumable_sampler_no_shuffle():
+    sampler = dist.ResumableSampler(list(range(10)), shuffle=False)
+    sampler.set_start_index(4)
+    assert list(sampler) == list(range(4, 10))
+
+
+def test_resumable_sampler_replicas():
+    dataset = list(range(21))
+    samplers = [
+        dist.ResumableSampler(dataset, seed=5, num_replicas=4, rank=rank)
+        for rank in range(4)
+    ]
+    per_rank = [list(s) for s in samplers]
+    # padded like DistributedSampler, every replica gets the same count
+    assert all(len(indices) == 6 for indices in per_rank)
+    assert set(i for indices in per_rank for i in indices) == set(dataset)
+
+    head, state = _consume(samplers[2], 4)
+    resumed = dist.ResumableSampler(dataset, seed=5, num_replicas=4, rank=2)
+    assert resumed.load_state_dict(state)
+    assert head + list(resumed) == per_rank[2]
+
+
+def test_resumable_sampler_world_size_changed():
+    dataset = list(range(20))
+    sampler = dist.ResumableSampler(dataset, seed=2, num_replicas=2, rank=0)
+    sampler.set_epoch(3)
+    _, state = _consume(sampler, 4)
+    resumed = dist.ResumableSampler(dataset, seed=0, num_replicas=4, rank=0)
+    # cannot map the position to a new sharding, restart the epoch
+    assert not resumed.load_state_dict(state)
+    assert resumed.start_index == 0 and resumed.epoch == 3 and resumed.seed == 2
+    assert len(resumed) == 5
+
+
+def test_resumable_sampler_in_dataloader():
+    dataset = torch.arange(32)
+    sampler = dist.ResumableSampler(dataset, seed=11)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=4, sampler=sampler)
+    batches = [b.tolist() for b in loader]
+    sampler.set_start_index(3 * 4)
+    assert len(loader) == 5
+    assert [b.tolist() for b in loader] == batches[3:]
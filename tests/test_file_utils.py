@@ -0,0 +1,94 @@
+import os
+import pytest
+import omlet.utils as U
+import omlet.utils.file_utils as FU
+
+
+def _write(path, data):
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_link_or_copy_hardlink(tmp_path):
+    src, dst = str(tmp_path / 'a.ckpt'), str(tmp_path / 'b.ckpt')
+    _write(src, 'new')
+    _write(dst, 'old')
+    assert U.f_link_or_copy(src, dst) == 'hardlink'
+    assert os.path.samefile(src, dst) and _read(dst) == 'new'
+    # already an alias
+    assert U.f_link_or_copy(src, dst) == 'hardlink'
+    assert sorted(os.listdir(str(tmp_path))) == ['a.ckpt', 'b.ckpt']
+
+
+def test_link_or_copy_fallback_copy(tmp_path, monkeypatch):
+    def _no_link(src, dst):
+        raise OSError('cross-device link')
+
+    monkeypatch.setattr(os, 'link', _no_link)
+    monkeypatch.setattr(FU, '_f_reflink', lambda src, dst: False)
+    src, dst = str(tmp_path / 'a.ckpt'), str(tmp_path / 'b.ckpt')
+    _write(src, 'data')
+    _write(dst, 'old')
+    assert U.f_link_or_copy(src, dst) == 'copy'
+    assert not os.path.samefile(src, dst) and _read(dst) == 'data'
+    assert sorted(os.listdir(str(tmp_path))) == ['a.ckpt', 'b.ckpt']
+
+
+def test_link_or_copy_dir_swap(tmp_path):
+    src, dst = tmp_path / 'src.ckpt', tmp_path / 'last.ckpt'
+    src.mkdir()
+    dst.mkdir()
+    _write(str(src / 'shard_0'), 'new 0')
+    _write(str(src / 'shard_1'), 'new 1')
+    _write(str(dst / 'shard_0'), 'old 0')
+    # e.g. from a run with more ranks
+    _write(str(dst / 'shard_2'), 'old 2')
+    assert U.f_link_or_copy(str(src), str(dst)) == 'hardlink'
+    assert sorted(os.listdir(str(dst))) == ['shard_0', 'shard_1']
+    assert _read(str(dst / 'shard_0')) == 'new 0'
+    # the temp and old dirs are gone
+    assert sorted(os.listdir(str(tmp_path))) == ['last.ckpt', 'src.ckpt']
+
+
+def test_link_or_copy_dir_recover(tmp_path, monkeypatch):
+    src, dst = tmp_path / 'src.ckpt', tmp_path / 'last.ckpt'
+    src.mkdir()
+    dst.mkdir()
+    _write(str(src / 'shard_0'), 'new 0')
+    _write(str(dst / 'shard_0'), 'old 0')
+    replace = os.replace
+
+    def _crash_on_second(a, b):
+        if not a.endswith('.old') and b == str(dst):
+            raise KeyboardInterrupt
+        replace(a, b)
+
+    # killed between the two renames of the swap
+    monkeypatch.setattr(os, 'replace', _crash_on_second)
+    with pytest.raises(KeyboardInterrupt):
+        U.f_link_or_copy(str(src), str(dst))
+    monkeypatch.setattr(os, 'replace', replace)
+    assert not dst.exists() and (tmp_path / 'last.ckpt.old').is_dir()
+    assert U.f_recover_swap(str(dst))
+    assert _read(str(dst / 'shard_0')) == 'old 0'
+    assert not U.f_recover_swap(str(dst))
+    assert sorted(os.listdir(str(tmp_path))) == ['last.ckpt', 'src.ckpt']
+
+
+def test_atomic_open(tmp_path):
+    path = str(tmp_path / 'last.ckpt')
+    with U.f_atomic_open(path, 'w') as f:
+        f.write('first')
+    assert _read(path) == 'first'
+    with pytest.raises(RuntimeError):
+        with U.f_atomic_open(path, 'w') as f:
+            f.write('partial')
+            raise RuntimeError('interrupted')
+    # the target is not replaced and the temp file is removed
+    assert _read(path) == 'first'
+    assert os.listdir(str(tmp_path)) == ['last.ckpt']
@@ -0,0 +1,488 @@
+import os
+import time
+import logging
+import types
+import signal
+import pytest
+import torch
+import torch.multiprocessing as mp
+import omlet.lightning as OL
+import omlet.utils as U
+import omlet.utils.distributed as dist
+from omegaconf import OmegaConf
+from torch.utils.data import TensorDataset
+
+
+class _Regression(OL.ExtendedModule):
+    """
+    8 batches of 8 samples per epoch, the inputs are the sample indices
+    """
+    def __init__(self, hparams, interrupt_at=None, interrupt=None):
+        super().__init__(hparams)
+        self.linear = torch.nn.Linear(4, 1)
+        x = torch.arange(64).float()[:, None].repeat(1, 4) / 64
+        self.dataset = TensorDataset(x, x.sum(dim=1, keepdim=True))
+        # (epoch, batch_idx) to call `interrupt` at, by default raises
+        # KeyboardInterrupt before the step, pl stops gracefully
+        self.interrupt_at = interrupt_at
+        self.interrupt = interrupt
+        self.seen = []
+
+    def forward(self, x):
+        return self.linear(x)
+
+    def training_step(self, batch, batch_idx):
+        x, y = batch
+        if (self.current_epoch, batch_idx) == self.interrupt_at:
+            if self.interrupt is None:
+                raise KeyboardInterrupt
+            self.interrupt()
+        self.seen.append((x[:, 0] * 64).round().long().tolist())
+        return {'loss': ((self(x) - y) ** 2).mean()}
+
+    def validation_step(self, batch, batch_idx):
+        x, y = batch
+        return {'loss': ((self(x) - y) ** 2).mean()}
+
+    def configure_optimizers(self):
+        optimizer = torch.optim.SGD(self.parameters(), lr=0.01, momentum=0.9)
+        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=1, gamma=0.99)
+        return [optimizer], [{'scheduler': scheduler, 'interval': 'step'}]
+
+    def train_dataloader(self):
+        return self.get_dataloader(self.dataset, 'train')
+
+    def val_dataloader(self):
+        return self.get_dataloader(self.dataset, 'val')
+
+
+class _Child(_Regression):
+    pass
+
+
+class _Grandchild(_Child):
+    def validation_step(self, batch, batch_idx):
+        return super().validation_step(batch, batch_idx)
+
+
+def _trainer(root_dir, epochs=1, resume=False, **kwargs):
+    return OL.configure_trainer(
+        root_dir=str(root_dir), run_name='run', epochs=epochs, gpus=0,
+        resume=resume, monitor_metric=kwargs.pop('monitor_metric', 'val/loss'),
+        monitor_metric_mode='min', save_epoch_interval=1, num_sanity_val_steps=0,
+        progress_bar_refresh_rate=0, weights_summary=None, log_file=None, **kwargs
+    )
+
+
+def _module(interrupt_at=None, interrupt=None, module_cls=_Regression, **hparams):
+    hparams = dict(
+        dict(batch_size=8, num_workers=1, seed=3,
+             train_metrics=['loss'], val_metrics=['loss']),
+        **hparams
+    )
+    return module_cls(OmegaConf.create(hparams), interrupt_at=interrupt_at, interrupt=interrupt)
+
+
+def _last_path(root_dir):
+    return os.path.join(str(root_dir), 'run', 'ckpt', 'last.ckpt')
+
+
+def test_step_save_after_optimizer_step(tmp_path):
+    # accumulation window of 2 batches, step 3 ends at batch 5
+    module = _module(interrupt_at=(0, 7))
+    trainer = _trainer(tmp_path, save_step_interval=3, accumulate_grad_batches=2)
+    trainer.fit(module)
+    checkpoint = U.load_checkpoint(_last_path(tmp_path))
+    # written at the start of batch 6, after pl stepped the scheduler and global_step
+    assert checkpoint['global_step'] == 3
+    assert checkpoint['lr_schedulers'][0]['last_epoch'] == 3
+    assert checkpoint['epoch'] == 0
+    assert checkpoint['extended']['train_progress']['sampler']['start_index'] == 6 * 8
+    # batch 6 is in the middle of the next window, no optimizer step since
+    for name, value in module.state_dict().items():
+        assert torch.equal(checkpoint['state_dict'][name], value)
+
+    resumed = _module(interrupt_at=(0, 0))
+    trainer = _trainer(tmp_path, resume='last', save_step_interval=3, accumulate_grad_batches=2)
+    trainer.fit(resumed)
+    # the resumed step is not saved again
+    assert trainer.checkpoint_callback._num_step_saves == 0
+    assert U.load_checkpoint(_last_path(tmp_path))['global_step'] == 3
+
+
+def _fake_trainer(proc_rank):
+    trainer = types.SimpleNamespace(
+        proc_rank=proc_rank, global_step=0, batch_idx=0, current_epoch=0,
+        accumulate_grad_batches=1
+    )
+    trainer.dump_checkpoint = lambda: {
+        'epoch': trainer.current_epoch + 1, 'global_step': trainer.global_step + 1,
+        'state_dict': {'weight': torch.full((4,), float(trainer.global_step))},
+    }
+    return trainer
+
+
+def test_subclass_patched_once(tmp_path):
+    for _ in range(3):
+        _module(module_cls=_Grandchild)
+    # inherited wrappers are not wrapped again
+    assert _Grandchild.training_step is _Regression.training_step
+    assert _Child.validation_step is _Regression.validation_step
+    # overridden ones are wrapped once, around the raw method
+    for cls in [_Regression, _Grandchild]:
+        raw = cls.validation_step.__wrapped__
+        assert cls.validation_step._omlet_patched
+        assert not getattr(raw, '_omlet_patched', False)
+
+    module = _module(module_cls=_Grandchild)
+    trainer = _trainer(tmp_path)
+    trainer.fit(module)
+    updates = []
+    update_epoch_metrics = module._update_epoch_metrics
+
+    def _update(stage, output, batch_size):
+        updates.append(stage)
+        return update_epoch_metrics(stage, output, batch_size)
+
+    module._update_epoch_metrics = _update
+    trainer.test(module)
+    # test_step() -> patched validation_step() -> super().validation_step()
+    assert updates == ['test'] * 8
+
+
+def _best_files(save_dir):
+    return sorted(
+        os.path.join(os.path.basename(root), name)
+        for root, _, files in os.walk(os.path.join(save_dir, 'best')) for name in files
+    )
+
+
+def test_multi_metric_top_k(tmp_path):
+    save_dir = str(tmp_path)
+
+    def _checkpoint_callback():
+        return OL.ExtendedCheckpoint(
+            save_dir, monitor_metric={'val/loss': 'min', 'val/acc1': 'max'},
+            save_top_k=2, save_epoch_interval=0, always_save_last=False
+        )
+
+    def _validate(checkpoint_callback, epoch, loss, acc1):
+        trainer = _fake_trainer(0)
+        trainer.current_epoch = trainer.global_step = epoch
+        trainer.callback_metrics = {'val/loss': loss, 'val/acc1': acc1}
+        checkpoint_callback.on_validation_end(trainer, None)
+
+    checkpoint_callback = _checkpoint_callback()
+    for epoch, (loss, acc1) in enumerate([(0.5, 0.6), (0.4, 0.5), (0.3, 0.4), (0.6, 0.7)]):
+        _validate(checkpoint_callback, epoch, loss, acc1)
+    # epoch 1 left the top-k of val/loss, epoch 2 the one of val/acc1
+    assert _best_files(save_dir) == [
+        'val_acc1/epoch=1.ckpt', 'val_acc1/epoch=4.ckpt',
+        'val_loss/epoch=2.ckpt', 'val_loss/epoch=3.ckpt',
+    ]
+    best = os.path.join(save_dir, 'best')
+    # written once for both metrics, the remaining link keeps the data
+    assert os.stat(os.path.join(best, 'val_acc1/epoch=1.ckpt')).st_nlink == 1
+    weight = U.load_checkpoint(os.path.join(best, 'val_acc1/epoch=1.ckpt'))['state_dict']['weight']
+    assert torch.equal(weight, torch.zeros(4))
+    assert checkpoint_callback.best == 0.3 and checkpoint_callback.kth_value == 0.4
+    manifest = checkpoint_callback.manifest
+    assert {e['value'] for e in manifest.find('best', 'val/acc1').values()} == {0.6, 0.7}
+
+    # the top-k of both metrics are restored from the manifest
+    _validate(_checkpoint_callback(), 4, 0.35, 0.65)
+    assert _best_files(save_dir) == [
+        'val_acc1/epoch=4.ckpt', 'val_acc1/epoch=5.ckpt',
+        'val_loss/epoch=3.ckpt', 'val_loss/epoch=5.ckpt',
+    ]
+    assert os.path.samefile(
+        os.path.join(best, 'val_acc1/epoch=5.ckpt'), os.path.join(best, 'val_loss/epoch=5.ckpt')
+    )
+
+
+class _Logger:
+    def __init__(self):
+        self.logged = []
+
+    def log_metrics(self, metrics, step=None):
+        self.logged.append((step, metrics))
+
+
+def test_step_time_monitor(monkeypatch):
+    monitor = OL.StepTimeMonitor()
+    trainer = _fake_trainer(0)
+    trainer.use_ddp, trainer.logger = False, _Logger()
+
+    def _run_epoch(batch_times):
+        monitor.on_epoch_start(trainer, None)
+        for start, end in batch_times:
+            monkeypatch.setattr(time, 'perf_counter', lambda: start)
+            monitor.on_batch_start(trainer, None)
+            monkeypatch.setattr(time, 'perf_counter', lambda: end)
+            monitor.on_batch_end(trainer, None)
+        monitor.on_epoch_end(trainer, None)
+        return trainer.logger.logged[-1][1]
+
+    log = _run_epoch([(0., 1.), (1.5, 3.5), (4.5, 7.5)])
+    assert log['system/step_time_p50'] == pytest.approx(2., rel=0.02)
+    assert log['system/step_time_max'] == 3. and log['system/step_time_min'] == 1.
+    assert log['system/step_time_mean'] == pytest.approx(2.)
+    assert log['system/inter_step_min'] == 0.5 and log['system/inter_step_max'] == 1.
+    assert log['system/inter_step_p99'] == pytest.approx(1., rel=0.02)
+    # reset every epoch, no inter step time across the epoch boundary
+    log = _run_epoch([(100., 105.)])
+    assert log == pytest.approx({
+        f'system/step_time_{key}': 5. for key in ['mean', 'min', 'max', 'p50', 'p90', 'p99']
+    }, rel=0.02)
+
+
+def _sharded_time_save_worker(rank, world_size, port, save_dir):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    checkpoint = OL.ExtendedCheckpoint(
+        save_dir, sharded=True, save_time_interval=60, sharded_sync_interval=2
+    )
+    # only the clock of rank 0 counts
+    local_conditions = (True, True) if rank == 0 else (False, False)
+    checkpoint._local_save_conditions = lambda: local_conditions
+    trainer = _fake_trainer(rank)
+    saved_steps = []
+    for batch_idx in range(10):
+        trainer.batch_idx = batch_idx
+        checkpoint.on_batch_start(trainer, None)
+        if checkpoint._num_step_saves > len(saved_steps):
+            saved_steps.append(trainer.global_step)
+        checkpoint.on_batch_end(trainer, None)
+        trainer.global_step += 1
+    checkpoint.on_train_end(trainer, None)
+    # decided at step 2, applied at step 4. The decision started at step 4
+    # predates that save and is dropped at step 6
+    assert saved_steps == [4, 8]
+    assert U.load_checkpoint(os.path.join(save_dir, 'last.ckpt'))['global_step'] == 8
+
+
+def test_sharded_time_save_follows_rank_0(tmp_path):
+    mp.spawn(
+        _sharded_time_save_worker,
+        args=(2, dist.random_free_tcp_port(), str(tmp_path)), nprocs=2
+    )
+
+
+@pytest.mark.parametrize('sampler_state', [None, 'num_replicas'])
+def test_resume_restarted_epoch_meters(tmp_path, sampler_state):
+    _trainer(tmp_path, save_step_interval=1).fit(_module(interrupt_at=(0, 3)))
+    path = _last_path(tmp_path)
+    checkpoint = torch.load(path)
+    progress = checkpoint['extended']['train_progress']
+    assert progress['train_meters']['loss']['size'] == 24
+    if sampler_state is None:
+        # e.g. DDP with pl's sampler
+        progress['sampler'] = None
+    else:
+        # e.g. the number of GPUs changed
+        progress['sampler']['num_replicas'] += 1
+    torch.save(checkpoint, path)
+    manifest = U.CheckpointManifest(os.path.dirname(path))
+    entry = manifest.get(path)
+    manifest.add(path, entry['kind'], epoch=entry['epoch'], step=entry['step'])
+
+    resumed = _module()
+    _trainer(tmp_path, resume='auto').fit(resumed)
+    # the epoch restarts from the beginning, without the partial meters
+    assert sorted(i for batch in resumed.seen for i in batch) == list(range(64))
+    assert resumed._metrics_meter['train']['loss'].size == 64
+    assert resumed._resume_progress is None
+
+
+def test_preemption_signal_saves_and_resumes(tmp_path):
+    handled = []
+    previous = signal.signal(signal.SIGUSR1, lambda signum, frame: handled.append(signum))
+    try:
+        module = _module(
+            interrupt_at=(0, 3), interrupt=lambda: os.kill(os.getpid(), signal.SIGUSR1)
+        )
+        trainer = _trainer(tmp_path, handle_preemption=True)
+        trainer.fit(module)
+        # the handler of the test is back and was not called during training
+        assert trainer.interrupted and not handled
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert handled == [signal.SIGUSR1]
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+    # stopped at the start of batch 4
+    assert len(module.seen) == 4
+    checkpoint = U.load_checkpoint(_last_path(tmp_path))
+    assert checkpoint['epoch'] == 0 and checkpoint['global_step'] == 4
+
+    resumed = _module()
+    trainer = _trainer(tmp_path, resume='auto')
+    trainer.fit(resumed)
+    assert not trainer.interrupted
+    # every sample of the epoch exactly once across the two runs
+    samples = [i for batch in module.seen + resumed.seen for i in batch]
+    assert sorted(samples) == list(range(64))
+
+
+def _preemption_worker(rank, world_size, port, save_dir):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    handler = OL.PreemptionHandler(grace_period=120, check_interval=2)
+    trainer = _fake_trainer(rank)
+    trainer.checkpoint_callback = OL.ExtendedCheckpoint(save_dir)
+    if rank == 1:
+        # recent saves too slow for the grace period
+        trainer.checkpoint_callback._save_durations.append(1000.)
+    warnings = []
+    records = logging.Handler(logging.WARNING)
+    records.emit = lambda record: warnings.append(record.getMessage())
+    OL.omlet_logger.addHandler(records)
+    # not an ExtendedModule
+    pl_module = None
+    stopped_at = None
+    for batch_idx in range(10):
+        trainer.batch_idx = batch_idx
+        if rank == 0 and batch_idx == 1:
+            handler._handle_signal(signal.SIGUSR1, None)
+        try:
+            handler.on_batch_start(trainer, pl_module)
+        except KeyboardInterrupt:
+            stopped_at = batch_idx
+            break
+    handler.on_train_end(trainer, pl_module)
+    # started at the check of step 2, read at the check of step 4
+    assert stopped_at == 3
+    assert len(warnings) == 1 and 'not enough time left' in warnings[0]
+    assert not os.path.exists(os.path.join(save_dir, 'last.ckpt'))
+
+
+def test_preemption_flags_distributed(tmp_path):
+    mp.spawn(
+        _preemption_worker,
+        args=(2, dist.random_free_tcp_port(), str(tmp_path)), nprocs=2
+    )
+
+
+def _preemption_interval_worker(rank, world_size, port, save_dir):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    # 10s between checks
+    handler = OL.PreemptionHandler(grace_period=80)
+    trainer = _fake_trainer(rank)
+    trainer.checkpoint_callback = OL.ExtendedCheckpoint(save_dir)
+    # skip the save, only the timing of the stop is tested
+    trainer.checkpoint_callback._save_durations.append(1000.)
+    pl_module = None
+    # steps take 1s on rank 0 and 2s on rank 1
+    now = [0.]
+    time.perf_counter = lambda: now[0]
+    checks, stopped_at = [], None
+    for batch_idx in range(20):
+        trainer.batch_idx = trainer.global_step = batch_idx
+        now[0] += rank + 1
+        if rank == 1 and batch_idx == 8:
+            handler._handle_signal(signal.SIGTERM, None)
+        try:
+            handler.on_batch_start(trainer, pl_module)
+        except KeyboardInterrupt:
+            stopped_at = batch_idx
+            break
+        if handler._steps_since_check == 0:
+            checks.append(batch_idx)
+    handler.on_train_end(trainer, pl_module)
+    # every step until step times are known, then 10s of the slower rank
+    assert checks == [0, 1, 2, 7, 12]
+    # started at the check of step 12, read at the check of step 17
+    assert stopped_at == 17
+
+
+def test_preemption_check_interval_from_step_time(tmp_path):
+    mp.spawn(
+        _preemption_interval_worker,
+        args=(2, dist.random_free_tcp_port(), str(tmp_path)), nprocs=2
+    )
+
+
+def _train_progress_worker(rank, world_size, port, save_dir):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    module = _module()
+    module.trainer = trainer = _fake_trainer(rank)
+    dump_checkpoint = trainer.dump_checkpoint
+    trainer.dump_checkpoint = lambda: dict(
+        dump_checkpoint(), extended={'train_progress': module._get_train_progress()}
+    )
+    # uneven partial epochs: 8 samples of 1 on rank 0, 16 samples of 2 on rank 1
+    for _ in range(rank + 1):
+        module._metrics_meter['train']['loss'].update(torch.tensor(rank + 1.), size=8)
+    OL.ExtendedCheckpoint(save_dir).save_emergency(trainer, module)
+    dist.barrier()
+    progress = U.load_checkpoint(os.path.join(save_dir, 'last.ckpt'))['extended']['train_progress']
+    assert progress['train_meters_reduced']
+    assert progress['train_meters']['loss']['size'] == 24
+
+    resumed = _module()
+    resumed.trainer = trainer
+    resumed._resume_progress = progress
+    resumed.on_epoch_start()
+    # restored on rank 0 only, the epoch-end reduction counts it once
+    assert resumed._metrics_meter['train']['loss'].size == (24 if rank == 0 else 0)
+    loss = dist.reduce_meters(resumed._metrics_meter['train'])['loss']
+    assert loss == pytest.approx(40 / 24)
+
+
+def test_mid_epoch_train_meters_distributed(tmp_path):
+    mp.spawn(
+        _train_progress_worker,
+        args=(2, dist.random_free_tcp_port(), str(tmp_path)), nprocs=2
+    )
+
+
+def test_resume_resolution(tmp_path):
+    def _resume_path(resume, **kwargs):
+        return _trainer(tmp_path, resume=resume, **kwargs).resume_from_checkpoint
+
+    assert _resume_path('auto') is None
+    with pytest.raises(FileNotFoundError):
+        _resume_path('last')
+    trainer = _trainer(tmp_path, epochs=3, save_top_k=2)
+    trainer.fit(_module())
+    manifest = trainer.checkpoint_callback.manifest
+    best = manifest.find('best', 'val/loss')
+    assert len(best) == 2
+
+    assert _resume_path('auto') == _last_path(tmp_path)
+    assert _resume_path('last') == _last_path(tmp_path)
+    assert _resume_path('best') == min(best, key=lambda path: best[path]['value'])
+    assert _resume_path(1) == os.path.join(str(tmp_path), 'run', 'ckpt', 'epoch=1.ckpt')
+    with pytest.raises(FileNotFoundError):
+        _resume_path('best', monitor_metric='val/acc1')
+    # size does not match the manifest
+    with open(_last_path(tmp_path), 'ab') as f:
+        f.write(b'0')
+    with pytest.raises(RuntimeError):
+        _resume_path('last')
+
+
+def test_resume_torch_checkpoint_memory_mapped(tmp_path, monkeypatch):
+    module = _module()
+    _trainer(tmp_path).fit(module)
+    assert U.checkpoint_format(_last_path(tmp_path)) == 'torch'
+
+    torch_load = torch.load
+    mmap_calls = []
+
+    def _load(*args, **kwargs):
+        mmap_calls.append(kwargs.get('mmap', False))
+        return torch_load(*args, **kwargs)
+
+    monkeypatch.setattr(torch, 'load', _load)
+    resumed = _module()
+    trainer = _trainer(tmp_path, epochs=2, resume='last')
+    trainer.fit(resumed)
+    # never a full in-memory load, with old torch not even through torch.load
+    assert all(mmap_calls)
+    assert trainer.current_epoch == 1 and len(resumed.seen) == 8
@@ -0,0 +1,354 @@
+import os
+import numpy as np
+import pytest
+import torch
+import torch.multiprocessing as mp
+import omlet.utils as U
+import omlet.utils.distributed as dist
+
+
+def _init_gloo(rank, world_size, port):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+
+
+def _run_distributed(fn, world_size=2):
+    mp.spawn(fn, args=(world_size, dist.random_free_tcp_port()), nprocs=world_size)
+
+
+def _reference_accuracy(output, target, topk=(1,), scale_100=False):
+    # accuracy() before accuracy_tensor(), one sync per k
+    maxk = max(topk)
+    _, pred = output.topk(maxk, 1, True, True)
+    correct = pred.t().eq(target.view(1, -1).expand(maxk, -1))
+    mult = 100. if scale_100 else 1.
+    return [
+        float(correct[:k].reshape(-1).float().sum() * mult / target.size(0))
+        for k in topk
+    ]
+
+
+@pytest.mark.parametrize('topk', [(1,), (1, 5), (5, 1, 3), (10,)])
+@pytest.mark.parametrize('scale_100', [False, True])
+def test_accuracy_matches_reference(topk, scale_100):
+    g = torch.Generator().manual_seed(0)
+    output = torch.randn(64, 10, generator=g)
+    target = torch.randint(10, (64,), generator=g)
+    expected = _reference_accuracy(output, target, topk=topk, scale_100=scale_100)
+    assert U.accuracy(output, target, topk=topk, scale_100=scale_100) == pytest.approx(expected)
+    values = U.accuracy_tensor(output, target, topk=topk, scale_100=scale_100)
+    assert values.shape == (len(topk),)
+    assert values.tolist() == pytest.approx(expected)
+
+
+def test_accuracy_multi_head():
+    g = torch.Generator().manual_seed(1)
+    target = torch.randint(5, (32,), generator=g)
+    heads = [torch.randn(32, 5, generator=g) for _ in range(3)]
+    expected = [_reference_accuracy(h, target, topk=(1, 3)) for h in heads]
+    # stacked [H, B, C] and list of heads, labels shared by all heads
+    stacked = U.accuracy_tensor(torch.stack(heads), target, topk=(1, 3))
+    assert stacked.shape == (3, 2)
+    assert torch.allclose(stacked, torch.tensor(expected))
+    assert torch.allclose(U.accuracy_tensor(heads, target, topk=(1, 3)), torch.tensor(expected))
+    # per-head labels, heads with different number of classes
+    targets = torch.stack([target, target % 3, target])
+    heads[1] = torch.randn(32, 3, generator=g)
+    expected = [_reference_accuracy(h, t, topk=(1, 3)) for h, t in zip(heads, targets)]
+    assert torch.allclose(U.accuracy_tensor(heads, targets, topk=(1, 3)), torch.tensor(expected))
+
+
+def test_accuracy_single_sync(monkeypatch):
+    tolist = torch.Tensor.tolist
+    calls = []
+
+    def _tolist(self):
+        calls.append(self.shape)
+        return tolist(self)
+
+    def _item(self):
+        raise AssertionError('accuracy() should not sync per k')
+
+    monkeypatch.setattr(torch.Tensor, 'tolist', _tolist)
+    monkeypatch.setattr(torch.Tensor, 'item', _item)
+    values = U.accuracy(torch.randn(16, 10), torch.randint(10, (16,)), topk=(1, 3, 5))
+    assert len(values) == 3
+    assert calls == [(3,)]
+
+
+def test_tensor_meter_matches_average_meter():
+    meter, ref = U.TensorMeter(), U.AverageMeter()
+    for i in range(100):
+        value = torch.tensor(0.1 * i)
+        meter.update(value, size=i % 7 + 1)
+        ref.update(value, size=i % 7 + 1)
+    meter.update(2.5, size=3)  # python numbers are accumulated on host
+    ref.update(2.5, size=3)
+    assert meter.size == ref.size and meter.n == ref.n
+    assert meter.value == pytest.approx(ref.value, rel=1e-6)
+    assert float(meter.value_tensor) == pytest.approx(ref.value, rel=1e-6)
+
+
+def test_tensor_meter_kahan_summation():
+    meter = U.TensorMeter()
+    for _ in range(100000):
+        meter.update(torch.tensor(0.1), size=1)
+    # plain float32 accumulation is off by ~1e-4 relative here
+    assert meter.sum == pytest.approx(10000., rel=1e-6)
+
+
+def test_tensor_meter_state_dict():
+    meter = U.TensorMeter(keep_history=True)
+    for i in range(10):
+        meter.update(torch.tensor(float(i)), size=2)
+    state = meter.state_dict()
+    assert state == {'sum': pytest.approx(90.), 'size': 20, 'n': 10}
+
+    restored = U.TensorMeter()
+    restored.load_state_dict(state)
+    restored.update(torch.tensor(10.), size=2)
+    meter.update(torch.tensor(10.), size=2)
+    assert restored.value == pytest.approx(meter.value)
+    assert restored.size == meter.size and restored.n == meter.n
+    assert len(meter.history) == 11
+
+
+def test_meter_history_accepts_tuples():
+    history = U.MeterHistory()
+    history.append(1., 2)
+    history.append((3., 4))
+    assert history.values.tolist() == [1., 3.]
+    assert history.sizes.tolist() == [2, 4]
+
+
+def test_confusion_matrix_masks_out_of_range():
+    meter = U.ConfusionMatrixMeter(num_classes=3, ignore_index=-1)
+    pred = torch.tensor([0, 1, 2, 5, -1, 1])
+    target = torch.tensor([0, 1, 1, 2, 0, -1])
+    meter.update(pred, target)
+    assert meter.matrix.sum() == 3
+    assert meter.matrix[1, 2] == 1
+    assert float(meter.accuracy()) == pytest.approx(2 / 3)
+
+
+def _exact_auc(scores, positive):
+    # pairwise, ties count as half
+    diff = scores[positive][:, None] - scores[~positive][None, :]
+    return float(((diff > 0).double() + 0.5 * (diff == 0).double()).mean())
+
+
+def _exact_average_precision(scores, positive):
+    hits = positive[torch.argsort(scores, descending=True)].double()
+    precision = hits.cumsum(0) / torch.arange(1, len(hits) + 1)
+    return float((precision * hits).sum() / hits.sum())
+
+
+def test_binned_ranking_matches_exact():
+    g = torch.Generator().manual_seed(0)
+    num_classes = 4
+    target = torch.randint(num_classes, (3000,), generator=g)
+    logits = torch.randn(3000, num_classes, generator=g)
+    logits += 1.5 * torch.nn.functional.one_hot(target, num_classes)
+    scores = logits.softmax(dim=-1)
+    meter = U.BinnedRankingMeter(num_classes)
+    for i in range(0, 3000, 500):
+        meter.update(scores[i:i + 500], target[i:i + 500])
+    auc, ap = meter.auc(), meter.average_precision()
+    for c in range(num_classes):
+        positive = target == c
+        assert float(auc[c]) == pytest.approx(_exact_auc(scores[:, c], positive), abs=1e-3)
+        assert float(ap[c]) == pytest.approx(
+            _exact_average_precision(scores[:, c], positive), abs=1e-3
+        )
+    assert float(meter.mean_auc()) == pytest.approx(float(auc.mean()))
+
+
+def test_meters_before_update():
+    confusion = U.ConfusionMatrixMeter(num_classes=3)
+    assert float(confusion.accuracy()) == 0.
+    assert confusion.precision().tolist() == [0., 0., 0.]
+    assert confusion.f1().tolist() == [0., 0., 0.]
+    assert float(confusion.macro('recall')) == 0.
+    ranking = U.BinnedRankingMeter(num_classes=3, num_bins=10)
+    assert ranking.auc().tolist() == [0., 0., 0.]
+    assert float(ranking.mean_auc()) == 0.
+    # no class has a positive, the mean over no class is not NaN
+    ranking.update(torch.rand(4, 3), torch.zeros(4, 3))
+    assert float(ranking.mean_average_precision()) == 0.
+    assert float(ranking.mean_auc()) == 0.
+    quantile = U.QuantileMeter()
+    assert quantile.summary() == {
+        'mean': 0., 'min': 0., 'max': 0., 'p50': 0., 'p90': 0., 'p99': 0.
+    }
+
+
+def test_quantile_meter_relative_error():
+    rng = np.random.RandomState(0)
+    # heavy-tailed, spans several orders of magnitude
+    values = rng.lognormal(mean=0., sigma=2., size=10001)
+    meter = U.QuantileMeter(relative_accuracy=0.01)
+    for v in values:
+        meter.update(v)
+    for q in (0.1, 0.5, 0.9, 0.99):
+        expected = np.quantile(values, q, method='inverted_cdf')
+        assert abs(meter.quantile(q) - expected) <= 0.01 * expected
+    assert meter.min == values.min() and meter.max == values.max()
+    assert meter.value == pytest.approx(values.mean())
+
+
+def test_quantile_meter_merge():
+    rng = np.random.RandomState(1)
+    values = rng.pareto(1.5, size=2000) - rng.pareto(1.5, size=2000)
+    merged, first, second = U.QuantileMeter(), U.QuantileMeter(), U.QuantileMeter()
+    for i, v in enumerate(values):
+        merged.update(v)
+        (first if i % 3 else second).update(v)
+    first.merge(second)
+    assert first.summary() == pytest.approx(merged.summary())
+    with pytest.raises(AssertionError):
+        first.merge(U.QuantileMeter(relative_accuracy=0.02))
+
+
+def _reduce_quantile_worker(rank, world_size, port):
+    _init_gloo(rank, world_size, port)
+    values = np.random.RandomState(2).lognormal(size=1000)
+    meter, expected = U.QuantileMeter(), U.QuantileMeter()
+    for i, v in enumerate(values):
+        expected.update(v)
+        if i % world_size == rank:
+            meter.update(v)
+    meter.reduce_()
+    assert meter.size == 1000
+    assert meter.summary() == pytest.approx(expected.summary())
+
+
+def test_quantile_meter_reduce_distributed():
+    _run_distributed(_reduce_quantile_worker)
+
+
+def test_meter_history_grows():
+    history = U.MeterHistory(capacity=2)
+    for i in range(100):
+        history.append(float(i), i % 3 + 1)
+    history.extend([100., 101.], 2)
+    assert len(history) == 102
+    assert history[0] == (0., 1) and history[-1] == (101., 2)
+    assert history[1:3] == [(1., 2), (2., 3)]
+    assert list(history)[5] == (5., 3)
+    history.clear()
+    assert len(history) == 0 and history.values.tolist() == []
+
+
+def test_meter_history_means():
+    values = np.array([1., 4., 2., 8., 5.])
+    sizes = np.array([1, 3, 2, 1, 4])
+    history = U.MeterHistory()
+    history.extend(values, sizes)
+    cumulative = np.cumsum(values * sizes) / np.cumsum(sizes)
+    assert np.allclose(history.cumulative_mean(), cumulative)
+    windowed = [
+        np.sum(values[max(i - 1, 0):i + 1] * sizes[max(i - 1, 0):i + 1])
+        / np.sum(sizes[max(i - 1, 0):i + 1])
+        for i in range(5)
+    ]
+    assert np.allclose(history.windowed_mean(2), windowed)
+    assert np.allclose(history.windowed_mean(10), cumulative)
+
+
+def test_meter_history_views_read_only():
+    history = U.MeterHistory()
+    history.append(1., 2)
+    with pytest.raises(ValueError):
+        history.values[0] = 5.
+    with pytest.raises(ValueError):
+        history.sizes[0] = 5
+    values, sizes = history.to_numpy()
+    values[0] = 5.
+    assert history[0] == (1., 2)
+
+
+def test_windowed_meter():
+    meter = U.WindowedMeter(window=3)
+    assert meter.value == 0.
+    values = [1., 2., 3., 4., 5., 6., 7.]
+    for i, v in enumerate(values):
+        meter.update(torch.tensor(v), size=i + 1)
+        window = slice(max(i - 2, 0), i + 1)
+        sizes = np.arange(1, len(values) + 1)[window]
+        expected = np.sum(np.array(values[window]) * sizes) / sizes.sum()
+        assert meter.value == pytest.approx(expected)
+        assert len(meter) == min(i + 1, 3)
+    # python numbers and tensors in the same window
+    meter.update(10., size=2)
+    assert meter.value == pytest.approx((6 * 6 + 7 * 7 + 10 * 2) / 15)
+
+
+def test_windowed_meter_seconds(monkeypatch):
+    now = [0.]
+    monkeypatch.setattr(U.metrics.time, 'monotonic', lambda: now[0])
+    meter = U.WindowedMeter(window=10, window_seconds=5.)
+    meter.update(1.)
+    now[0] = 3.
+    meter.update(3.)
+    assert meter.value == pytest.approx(2.)
+    now[0] = 7.
+    # the first update is older than 5 seconds
+    assert meter.value == pytest.approx(3.)
+    now[0] = 20.
+    assert meter.value == 0. and len(meter) == 0
+
+
+def _reduce_meters_worker(rank, world_size, port):
+    _init_gloo(rank, world_size, port)
+    meter = U.TensorMeter()
+    # uneven number of samples per rank
+    for _ in range(rank + 1):
+        meter.update(torch.tensor(float(rank)), size=10 * (rank + 1))
+    values = dist.reduce_meters({'loss': meter, 'empty': U.TensorMeter()})
+    # rank 0: 10 samples of 0, rank 1: 2 * 20 samples of 1
+    assert values['loss'] == pytest.approx(40 / 50)
+    assert values['empty'] == 0.
+
+
+def test_reduce_meters_distributed():
+    _run_distributed(_reduce_meters_worker)
+
+
+def _reduce_meters_inplace_worker(rank, world_size, port):
+    _init_gloo(rank, world_size, port)
+    loss, acc = U.TensorMeter(), U.AverageMeter()
+    for _ in range(rank + 1):
+        loss.update(torch.tensor(float(rank)), size=10 * (rank + 1))
+    if rank == 0:
+        # rank 1 never updates, contributes zeros
+        acc.update(0.5, size=4)
+    assert U.reduce_meters_({'loss': loss, 'acc': acc}) == {'loss': loss, 'acc': acc}
+    assert loss.size == 50 and loss.value == pytest.approx(40 / 50)
+    assert acc.size == 4 and acc.value == pytest.approx(0.5)
+    # still a regular meter, n stays local
+    assert loss.n == rank + 1
+    loss.update(torch.tensor(1.), size=50)
+    assert loss.value == pytest.approx(90 / 100)
+    meter = U.AverageMeter()
+    meter.update(rank + 1., size=rank + 1)
+    meter.reduce_()
+    assert meter.state_dict() == {'sum': 5., 'size': 3, 'n': 1}
+
+
+def test_reduce_meters_inplace_distributed():
+    _run_distributed(_reduce_meters_inplace_worker)
+
+
+def _reduce_confusion_matrix_worker(rank, world_size, port):
+    _init_gloo(rank, world_size, port)
+    meter = U.ConfusionMatrixMeter(num_classes=2)
+    if rank == 0:
+        # rank 1 never updates, reduce_() starts from zeros
+        meter.update(torch.tensor([0, 1, 1]), torch.tensor([0, 1, 0]))
+    meter.reduce_()
+    assert meter.matrix.tolist() == [[1, 1], [0, 1]]
+
+
+def test_confusion_matrix_reduce_distributed():
+    _run_distributed(_reduce_confusion_matrix_worker)